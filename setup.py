@@ -160,6 +160,9 @@ setup(
     entry_points={
         "lms.djangoapp": [
             "shopify_webhook = shopify_webhook.apps:ShopifyWebhookConfig",
-        ]
+        ],
+        "cms.djangoapp": [
+            "shopify_webhook = shopify_webhook.apps:ShopifyWebhookConfig",
+        ],
     }
 )
@@ -3,17 +3,15 @@ shopify_webhook Django application initialization.
 """
 
 from django.apps import AppConfig
-from django.conf import settings
-from openedx.core.djangoapps.plugins.constants import (
-    ProjectType,
-    SettingsType,
-    PluginSettings,
-)
 
 
 class ShopifyWebhookConfig(AppConfig):
     """
     Configuration for the shopify_webhook Django application.
+
+    The plugin configuration is spelled out with the plain keys of the
+    Open edX plugin framework, so that the app can also be loaded
+    without the LMS, e.g. by the tests.
     """
 
     name = "shopify_webhook"
@@ -26,14 +24,37 @@ class ShopifyWebhookConfig(AppConfig):
                 "relative_path": "urls",
             }
         },
-        PluginSettings.CONFIG: {
-            ProjectType.LMS: {
-                SettingsType.COMMON: {
-                    PluginSettings.RELATIVE_PATH: "settings.common"
+        "settings_config": {
+            "lms.djangoapp": {
+                "common": {
+                    "relative_path": "settings.common"
                 },
-                SettingsType.PRODUCTION: {
-                    PluginSettings.RELATIVE_PATH: "settings.production"
+                "production": {
+                    "relative_path": "settings.production"
                 },
             },
         },
+        # The platform imports the signals module, which connects its
+        # receivers, only when running the LMS or the CMS. Courses are
+        # published in the CMS.
+        "signals_config": {
+            "lms.djangoapp": {
+                "relative_path": "signals",
+            },
+            "cms.djangoapp": {
+                "relative_path": "signals",
+            },
+        },
     }
+
+    def ready(self):
+        from django.core import checks
+
+        from .provisioning import check_default_password
+        from .registry import build_registry
+
+        checks.register(check_default_password, checks.Tags.security)
+
+        # Build the shop registry once, rather than reading the
+        # configuration on every request.
+        build_registry()
@@ -0,0 +1,168 @@
+"""
+Group commit of webhook inserts.
+
+When WEBHOOK_RECEIVER_GROUP_COMMIT is enabled, webhooks received by
+the same process within WEBHOOK_RECEIVER_GROUP_COMMIT_MAX_WAIT seconds
+of each other are inserted together, with one bulk_create() in one
+transaction, in batches of up to
+WEBHOOK_RECEIVER_GROUP_COMMIT_MAX_BATCH_SIZE rows. Every request waits
+until the transaction holding its row has committed, so a webhook is
+never acknowledged before it is durable.
+
+The first request to arrive for a batch (the leader) waits for the
+batch to fill up, and then writes it on behalf of everyone in it.
+Requests that arrive once the batch is full are written by the same
+leader, in the next batch. This needs a threaded server, and a
+database backend that returns primary keys from bulk inserts
+(PostgreSQL, SQLite 3.35+, MariaDB 10.5+). On other backends the rows
+of a batch are saved one by one, but still committed together.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import IntegrityError, connections, router, transaction
+
+from . import metrics
+
+
+DEFAULT_MAX_BATCH_SIZE = 50
+DEFAULT_MAX_WAIT = 0.005
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+logger = logging.getLogger(__name__)
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+
+
+class GroupCommitBuffer:
+    """Collect model instances from concurrent threads, and insert them in
+    batches.
+    """
+
+    def __init__(self, model, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._pending = []
+        # Whether requests were left pending by the last leader, which
+        # then leads them too.
+        self._leftover = False
+
+    def submit(self, instance):
+        """Insert instance as part of a batch.
+
+        Return once the batch has been committed, or raise the exception
+        that prevented inserting instance.
+        """
+        using = router.db_for_write(self.model)
+        if connections[using].in_atomic_block:
+            # Our transaction would commit the whole batch only when the
+            # caller's own transaction does, so don't join one.
+            instance.save()
+            return instance
+
+        future = Future()
+        with self._cond:
+            self._pending.append((instance, future))
+            if len(self._pending) == 1:
+                batch = self._lead()
+            else:
+                batch = None
+                if len(self._pending) >= self.max_batch_size:
+                    self._cond.notify_all()
+
+        while batch is not None:
+            self._flush(batch, using)
+            with self._cond:
+                # Nobody else leads the requests left over from a full
+                # batch, or those that joined them since.
+                batch = self._lead() if self._pending and self._leftover else None
+        return future.result()
+
+    def _lead(self):
+        """Wait until the batch is full or max_wait has passed, and take
+        it, or return None if another leader took it. Must be called with
+        the lock held.
+        """
+        deadline = time.monotonic() + self.max_wait
+        while len(self._pending) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        batch = self._pending[:self.max_batch_size]
+        self._pending = self._pending[self.max_batch_size:]
+        self._leftover = bool(self._pending)
+        return batch or None
+
+    def _flush(self, batch, using):
+        instances = [instance for instance, future in batch]
+        metrics.observe("group_commit.batch_size", len(instances), BATCH_SIZE_BUCKETS)
+        try:
+            self._insert(instances, using)
+        except IntegrityError:
+            # One of the rows conflicts, for example a repeated delivery
+            # of a webhook. Insert them one by one, so that only the
+            # conflicting rows fail.
+            metrics.increment("group_commit.fallbacks")
+            for instance, future in batch:
+                try:
+                    with transaction.atomic(using=using):
+                        instance.save(using=using)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(instance)
+        except BaseException as e:
+            for instance, future in batch:
+                future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            for instance, future in batch:
+                future.set_result(instance)
+
+    def _insert(self, instances, using):
+        with transaction.atomic(using=using):
+            if connections[using].features.can_return_rows_from_bulk_insert:
+                self.model.objects.using(using).bulk_create(
+                    instances, batch_size=self.max_batch_size
+                )
+            else:
+                for instance in instances:
+                    instance.save(using=using)
+
+        for instance in instances:
+            # bulk_create() does not call save(), so bring the FSM
+            # concurrency check up to date ourselves.
+            instance._update_initial_state()
+
+
+def group_commit_enabled():
+    return getattr(settings, "WEBHOOK_RECEIVER_GROUP_COMMIT", False)
+
+
+def get_buffer(model):
+    """Return the process-wide group commit buffer for model."""
+    try:
+        return _buffers[model]
+    except KeyError:
+        pass
+    with _buffers_lock:
+        if model not in _buffers:
+            _buffers[model] = GroupCommitBuffer(
+                model,
+                max_batch_size=getattr(
+                    settings, "WEBHOOK_RECEIVER_GROUP_COMMIT_MAX_BATCH_SIZE", DEFAULT_MAX_BATCH_SIZE
+                ),
+                max_wait=getattr(
+                    settings, "WEBHOOK_RECEIVER_GROUP_COMMIT_MAX_WAIT", DEFAULT_MAX_WAIT
+                ),
+            )
+        return _buffers[model]
@@ -0,0 +1,53 @@
+"""
+JSON encoding and decoding for webhook payloads.
+
+Uses orjson if it is installed, and the standard library json module
+otherwise. The same codec is used to parse incoming webhooks, to
+store JSONField values (through JSONEncoder and JSONDecoder), and,
+optionally, to serialize Celery task arguments (see tasks.py).
+"""
+import json
+
+try:
+    # orjson is optional, and considerably faster than json
+    import orjson
+except ImportError:
+    orjson = None
+
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def loads(data):
+    """Decode JSON from a str, bytes, bytearray or memoryview."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """Encode obj as a JSON str."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=ORJSON_OPTIONS).decode("utf-8")
+        except TypeError:
+            # orjson is stricter about what it accepts than json
+            # (e.g. integers beyond 64 bits); let json have a go.
+            pass
+    return json.dumps(obj)
+
+
+class JSONEncoder(json.JSONEncoder):
+    """JSON encoder class for JSONField, which encodes with dumps()."""
+
+    def encode(self, o):
+        return dumps(o)
+
+
+class JSONDecoder(json.JSONDecoder):
+    """JSON decoder class for JSONField, which decodes with loads()."""
+
+    def decode(self, s, _w=None):
+        return loads(s)
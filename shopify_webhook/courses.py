@@ -0,0 +1,204 @@
+"""
+Caches of course lookups.
+
+Whether a course exists is remembered for
+WEBHOOK_RECEIVER_COURSE_CACHE_TIMEOUT seconds if it does, and for
+WEBHOOK_RECEIVER_COURSE_CACHE_NEGATIVE_TIMEOUT seconds if it does not,
+so that a course created after a failed lookup is soon picked up.
+
+Entries are invalidated when a course is published or deleted, or its
+CourseOverview is changed (see signals.py), which happens in Studio, or
+in whichever process updates the overview. If
+WEBHOOK_RECEIVER_COURSE_CACHE names a Django cache alias, entries are
+kept only in that cache, so that the LMS and Celery workers see such
+invalidations at once. Otherwise they are kept in process memory, and
+other processes only see the change once their own entry expires.
+
+Only a course that is not found is remembered as missing: any other
+error while looking it up is raised, and nothing is cached.
+
+Course modes that are known to exist are remembered in the same way, and
+forgotten when a CourseMode is saved or deleted.
+
+The LMS models are imported when first needed, so that this module can
+be imported without the LMS.
+"""
+import logging
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+
+CACHE_KEY_PREFIX = "shopify_webhook:course_exists:"
+
+DEFAULT_TIMEOUT = 60 * 60
+DEFAULT_NEGATIVE_TIMEOUT = 60
+
+# Entries are dropped wholesale beyond this many, which a real catalog
+# never gets close to.
+MAX_ENTRIES = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def _shared_cache():
+    alias = getattr(settings, "WEBHOOK_RECEIVER_COURSE_CACHE", None)
+    return caches[alias] if alias else None
+
+
+def _timeout(exists):
+    if exists:
+        return getattr(settings, "WEBHOOK_RECEIVER_COURSE_CACHE_TIMEOUT", DEFAULT_TIMEOUT)
+    return getattr(
+        settings, "WEBHOOK_RECEIVER_COURSE_CACHE_NEGATIVE_TIMEOUT", DEFAULT_NEGATIVE_TIMEOUT
+    )
+
+
+def _course_exists(course_id):
+    from common.djangoapps.student.models import NonExistentCourseError
+    from lms.djangoapps.program_enrollments.api.writing import _ensure_course_exists
+    from opaque_keys import InvalidKeyError
+    from opaque_keys.edx.keys import CourseKey
+
+    try:
+        _ensure_course_exists(CourseKey.from_string(course_id), user_key_or_id=None)
+    except (InvalidKeyError, NonExistentCourseError):
+        return False
+    return True
+
+
+class CourseExistenceCache:
+    """Remember which course IDs exist, with expiring positive and negative
+    entries.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (exists, expiry) by course ID
+        self._entries = {}
+        # Bumped on invalidation, so that a lookup that started before
+        # an invalidation does not store its (possibly stale) result.
+        self._generation = 0
+
+    def exists(self, course_id):
+        """Return True if a course with ID course_id exists."""
+        shared = _shared_cache()
+        if shared is not None:
+            # A local entry could not be invalidated from other processes.
+            exists = shared.get(CACHE_KEY_PREFIX + course_id)
+            if exists is not None:
+                metrics.increment("course_cache.shared_hits")
+                return exists
+            metrics.increment("course_cache.misses")
+            exists = _course_exists(course_id)
+            shared.set(CACHE_KEY_PREFIX + course_id, exists, timeout=_timeout(exists))
+            return exists
+
+        entry = self._entries.get(course_id)
+        if entry is not None and entry[1] > time.monotonic():
+            metrics.increment("course_cache.hits")
+            return entry[0]
+
+        generation = self._generation
+        metrics.increment("course_cache.misses")
+        exists = _course_exists(course_id)
+
+        with self._lock:
+            if generation == self._generation:
+                if len(self._entries) >= MAX_ENTRIES:
+                    self._entries.clear()
+                self._entries[course_id] = (exists, time.monotonic() + _timeout(exists))
+        return exists
+
+    def invalidate(self, course_id=None):
+        """Forget about course_id, or about all courses if not given."""
+        with self._lock:
+            self._generation += 1
+            if course_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(course_id, None)
+
+        shared = _shared_cache()
+        if shared is not None and course_id is not None:
+            shared.delete(CACHE_KEY_PREFIX + course_id)
+
+
+course_existence_cache = CourseExistenceCache()
+
+
+def course_exists(course_id):
+    """Return True if a course with ID course_id exists, using the course
+    existence cache.
+    """
+    return course_existence_cache.exists(course_id)
+
+
+class CourseModeCache:
+    """Remember which (course_id, mode_slug) pairs have a CourseMode."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Expiry by (course_id, mode_slug)
+        self._entries = {}
+        self._generation = 0
+
+    def get_or_create(self, course_id, mode):
+        """Make sure course_id has a CourseMode with slug mode, and return
+        the slug.
+        """
+        from common.djangoapps.course_modes.models import CourseMode
+        from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
+
+        key = (str(course_id), mode)
+        expiry = self._entries.get(key)
+        if expiry is not None and expiry > time.monotonic():
+            metrics.increment("course_mode_cache.hits")
+            return mode
+
+        metrics.increment("course_mode_cache.misses")
+        generation = self._generation
+        course = CourseOverview.objects.get(id=course_id)
+        course_mode, created = CourseMode.objects.get_or_create(
+            course=course, mode_slug=mode, mode_display_name=mode
+        )
+
+        with self._lock:
+            if generation == self._generation:
+                if len(self._entries) >= MAX_ENTRIES:
+                    self._entries.clear()
+                self._entries[key] = time.monotonic() + _timeout(True)
+        return course_mode.mode_slug
+
+    def invalidate(self, course_id, mode):
+        """Forget about the mode of course_id with slug mode."""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop((str(course_id), mode), None)
+
+
+course_mode_cache = CourseModeCache()
+
+
+@lru_cache(maxsize=None)
+def _valid_modes():
+    from common.djangoapps.course_modes.models import CourseMode
+
+    return frozenset(CourseMode.ALL_MODES)
+
+
+def is_valid_mode(mode):
+    return mode in _valid_modes()
+
+
+def get_or_create_course_mode(course_id, mode):
+    """
+    Check and return the correct course_mode
+    Create one if it does not exist already
+    """
+    return course_mode_cache.get_or_create(course_id, mode)
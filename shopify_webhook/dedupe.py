@@ -0,0 +1,110 @@
+"""
+Detection of repeated deliveries of the same Shopify webhook.
+
+Shopify sends the same X-Shopify-Webhook-Id header with every delivery
+attempt of a webhook. The unique webhook_id column of JSONWebhookData is
+the authoritative record of which webhooks we have seen.
+
+A delivery is only a duplicate if the webhook it repeats was processed,
+or is still being processed: its row is PROCESSING (or NEW, waiting for
+a fast-ack worker), and was updated less than
+WEBHOOK_RECEIVER_DEDUPE_PROCESSING_TIMEOUT seconds ago. A webhook whose
+processing failed or was abandoned is processed again when Shopify
+retries it.
+
+In front of the database sits an optional hot cache
+(WEBHOOK_RECEIVER_DEDUPE_CACHE) of webhooks that were processed, whose
+entries expire after WEBHOOK_RECEIVER_DEDUPE_TIMEOUT seconds, so that
+most duplicates are answered without a query.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .models import JSONWebhookData
+from . import metrics
+
+
+CACHE_KEY_PREFIX = "shopify_webhook:delivery:"
+
+# Shopify retries a failed delivery for up to 48 hours.
+DEFAULT_TIMEOUT = 48 * 60 * 60
+
+# Webhooks that have been processing for longer than this are assumed to
+# have been abandoned, e.g. by a worker that was killed.
+DEFAULT_PROCESSING_TIMEOUT = 10 * 60
+
+logger = logging.getLogger(__name__)
+
+
+def get_webhook_id(request):
+    return request.headers.get("X-Shopify-Webhook-Id") or None
+
+
+def _cache():
+    alias = getattr(settings, "WEBHOOK_RECEIVER_DEDUPE_CACHE", None)
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def _cache_key(webhook_id):
+    return CACHE_KEY_PREFIX + webhook_id
+
+
+def remember_delivery(webhook_id):
+    """Record webhook_id in the hot cache, if there is one. Only call
+    this once the webhook has been processed.
+    """
+    cache = _cache()
+    if cache is None or not webhook_id:
+        return
+    timeout = getattr(settings, "WEBHOOK_RECEIVER_DEDUPE_TIMEOUT", DEFAULT_TIMEOUT)
+    cache.set(_cache_key(webhook_id), 1, timeout)
+
+
+def is_duplicate_delivery(webhook_id):
+    """Return True if a webhook with this ID has already been processed,
+    or is being processed.
+
+    If an earlier delivery of the webhook failed or was abandoned, its
+    row is kept, but gives up the webhook ID, so that this delivery can
+    be stored and processed.
+    """
+    if not webhook_id:
+        return False
+
+    cache = _cache()
+    if cache is not None and cache.get(_cache_key(webhook_id)):
+        metrics.increment("webhook.duplicate")
+        return True
+
+    previous = JSONWebhookData.objects.filter(webhook_id=webhook_id).values("id", "status", "updated").first()
+    if previous is None:
+        return False
+
+    if previous["status"] == JSONWebhookData.PROCESSED:
+        remember_delivery(webhook_id)
+        metrics.increment("webhook.duplicate")
+        return True
+
+    timeout = getattr(settings, "WEBHOOK_RECEIVER_DEDUPE_PROCESSING_TIMEOUT", DEFAULT_PROCESSING_TIMEOUT)
+    in_flight = previous["status"] in (JSONWebhookData.NEW, JSONWebhookData.PROCESSING)
+    if in_flight and previous["updated"] > timezone.now() - timedelta(seconds=timeout):
+        metrics.increment("webhook.duplicate")
+        return True
+
+    # Only release the row if it has not moved on in the meantime. If
+    # it has, storing this delivery fails on the unique webhook_id, and
+    # it is answered as a duplicate.
+    JSONWebhookData.objects.filter(
+        id=previous["id"], status=previous["status"], updated=previous["updated"]
+    ).update(webhook_id=None)
+    metrics.increment("webhook.redelivered")
+    logger.info(
+        "Processing repeated delivery of webhook %s, which previously failed or was abandoned" % webhook_id
+    )
+    return False
@@ -0,0 +1,330 @@
+"""
+Enrollment backends.
+
+A backend enrolls (or unenrolls) a list of (course_id, email) pairs,
+and reports which of them succeeded. The backend in use is named by
+WEBHOOK_RECEIVER_ENROLLMENT_BACKEND:
+
+* shopify_webhook.enrollment.HTTPEnrollmentBackend (the default) calls
+  the LMS bulk enrollment API, authenticated with
+  WEBHOOK_RECEIVER_EDX_OAUTH2_KEY and WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET.
+* shopify_webhook.enrollment.InProcessEnrollmentBackend calls the same
+  instructor enrollment functions as that API does, directly in the LMS
+  process the plugin runs in, without an OAuth token or a network hop.
+
+Once learners are enrolled, OrderEnrollmentContext applies the course
+modes bought with an order, with the same few queries however many
+items the order has.
+
+The LMS modules are imported when first needed, so that this module can
+be imported without the LMS.
+"""
+import logging
+from abc import ABC, abstractmethod
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.validators import validate_email
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .courses import get_or_create_course_mode, is_valid_mode
+from .lms_client import get_lms_client
+
+
+DEFAULT_BACKEND = "shopify_webhook.enrollment.HTTPEnrollmentBackend"
+
+EDX_BULK_ENROLLMENT_API_PATH = "%s/api/bulk_enroll/v1/bulk_enroll"
+
+logger = logging.getLogger(__name__)
+
+
+class EnrollmentBackend(ABC):
+    """Base class of enrollment backends."""
+
+    @abstractmethod
+    def enroll(self, enrollments, send_email=True, auto_enroll=True, action="enroll"):
+        """Apply action ("enroll" or "unenroll") to an iterable of
+        (course_id, email) pairs.
+
+        Return a dictionary mapping each pair to True if it succeeded,
+        and False otherwise. Raise ValidationError if an email is
+        invalid, and any other exception if the backend is unavailable,
+        so that the order can be retried.
+        """
+
+    @staticmethod
+    def group_by_course(enrollments):
+        """Return a dictionary of the set of emails to enroll in each
+        course, validating every email.
+        """
+        emails_by_course = {}
+        for course_id, email in enrollments:
+            # Raises ValidationError if invalid
+            validate_email(email)
+            emails_by_course.setdefault(course_id, set()).add(email)
+        return emails_by_course
+
+
+class HTTPEnrollmentBackend(EnrollmentBackend):
+    """Enroll through the bulk enrollment API, defined in
+    lms/djangoapps/bulk_enroll.
+    """
+
+    def enroll(self, enrollments, send_email=True, auto_enroll=True, action="enroll"):
+        # The API applies the action to every combination of the courses
+        # and identifiers in a request, so courses are grouped by their
+        # exact set of emails: one request per group never touches a pair
+        # that was not asked for. For a single order, that is one request
+        # in total.
+        courses_by_emails = {}
+        for course_id, emails in self.group_by_course(enrollments).items():
+            courses_by_emails.setdefault(frozenset(emails), []).append(course_id)
+
+        client = get_lms_client()
+        bulk_enroll_url = EDX_BULK_ENROLLMENT_API_PATH % settings.LMS_ROOT_URL
+
+        results = {}
+        for emails, course_ids in courses_by_emails.items():
+            request_params = {
+                "auto_enroll": auto_enroll,
+                "email_students": send_email,
+                "action": action,
+                "courses": ",".join(course_ids),
+                "identifiers": ",".join(sorted(emails)),
+            }
+            logger.debug(
+                "Sending POST request "
+                "to %s with parameters %s" % (bulk_enroll_url, request_params)
+            )
+            response = client.post(bulk_enroll_url, request_params)
+
+            # Throw an exception if we get any error back from the API.
+            # Apart from an HTTP 200, we might also get:
+            #
+            # HTTP 400: if we've sent a malformed request (for example, one
+            #           with a course ID in a format that Open edX can't
+            #           parse)
+            # HTTP 401: if our authentication token has expired
+            # HTTP 403: if our auth token is linked to a user ID that lacks
+            #           staff credentials in one of the courses we want to
+            #           enroll the learner in
+            # HTTP 404: if we've specified a course ID that does not exist
+            #           (although it does follow the format that Open edX expects)
+            # HTTP 500: in case of a server-side issue
+            if response.status_code >= 400:
+                logger.error(
+                    "POST request to %s with parameters %s "
+                    "returned HTTP %s" % (bulk_enroll_url, request_params, response.status_code)
+                )
+            response.raise_for_status()
+
+            response_data = response.json()
+            logger.debug("Received response from %s: %s " % (bulk_enroll_url, response_data))
+            results.update(parse_bulk_enroll_response(response_data, course_ids, emails))
+
+        return results
+
+
+def parse_bulk_enroll_response(response_data, course_ids, emails):
+    """Return a dictionary mapping each (course_id, email) pair of a bulk
+    enrollment request to True if it succeeded.
+
+    The response has a result per course and identifier; a result with
+    an "error" or "invalidIdentifier" flag, or a missing result, means
+    that pair failed.
+    """
+    results = {(course_id, email): False for course_id in course_ids for email in emails}
+    for course_id, course_data in (response_data.get("courses") or {}).items():
+        for result in course_data.get("results", []):
+            key = (course_id, result.get("identifier"))
+            if key in results:
+                results[key] = not (result.get("error") or result.get("invalidIdentifier"))
+    return results
+
+
+class InProcessEnrollmentBackend(EnrollmentBackend):
+    """Enroll by calling the LMS instructor enrollment functions directly.
+
+    This is what the bulk enrollment API does for each course and
+    identifier, minus the HTTP request, OAuth token and JSON
+    serialization. Each course is loaded once per call, however many
+    emails are enrolled in it.
+
+    It is not a bulk operation: like the API, it makes one
+    enroll_email() (or unenroll_email()) call, in its own savepoint, per
+    (course_id, email) pair, so that one failing pair does not undo the
+    others.
+    """
+
+    def enroll(self, enrollments, send_email=True, auto_enroll=True, action="enroll"):
+        from lms.djangoapps.instructor.enrollment import enroll_email, get_email_params, unenroll_email
+        from opaque_keys.edx.keys import CourseKey
+        from openedx.core.lib.courses import get_course_by_id
+
+        results = {}
+        for course_id, emails in self.group_by_course(enrollments).items():
+            try:
+                course_key = CourseKey.from_string(course_id)
+                email_params = {}
+                if send_email:
+                    email_params = get_email_params(
+                        get_course_by_id(course_key),
+                        auto_enroll,
+                        secure=settings.LMS_ROOT_URL.startswith("https"),
+                    )
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Unable to load course %s" % course_id)
+                results.update({(course_id, email): False for email in emails})
+                continue
+
+            for email in sorted(emails):
+                try:
+                    with transaction.atomic():
+                        if action == "unenroll":
+                            unenroll_email(
+                                course_key, email, send_email, dict(email_params)
+                            )
+                        else:
+                            enroll_email(
+                                course_key, email, auto_enroll, send_email, dict(email_params)
+                            )
+                except Exception:  # pylint: disable=broad-except
+                    # Like the bulk enrollment API, report the failure
+                    # for this pair and carry on with the others.
+                    logger.exception("Unable to %s %s in course %s" % (action, email, course_id))
+                    results[(course_id, email)] = False
+                else:
+                    results[(course_id, email)] = True
+
+        return results
+
+
+class OrderEnrollmentContext:
+    """The learner of an order, and their enrollments in the order's
+    courses.
+
+    The user is looked up once. Then the learner's CourseEnrollment rows
+    for all courses are fetched with one query, or, for a learner without
+    an account, their CourseEnrollmentAllowed rows.
+
+    One context serves a whole order: the course modes of its line items
+    are deferred while they are enrolled, and then applied together, with
+    a single reload of the enrollments.
+    """
+
+    def __init__(self, email, course_ids):
+        self.email = email
+        self.course_ids = list(dict.fromkeys(course_ids))
+        self.user = User.objects.filter(email=email).first()
+        self.deferred_modes = {}
+        self.load()
+
+    def load(self):
+        """(Re)load the learner's enrollments in the order's courses."""
+        from common.djangoapps.student.models import CourseEnrollment
+        from common.djangoapps.student.models.course_enrollment import CourseEnrollmentAllowed
+        from opaque_keys import InvalidKeyError
+        from opaque_keys.edx.keys import CourseKey
+
+        course_keys = []
+        for course_id in self.course_ids:
+            try:
+                course_keys.append(CourseKey.from_string(course_id))
+            except InvalidKeyError:
+                # Not a course, so never enrolled in
+                pass
+        self.enrollments = {}
+        self.allowed = {}
+        if self.user is not None:
+            self.enrollments = {
+                str(enrollment.course_id): enrollment for enrollment in
+                CourseEnrollment.objects.filter(user=self.user, course_id__in=course_keys)
+            }
+        else:
+            self.allowed = {
+                str(allowed.course_id): allowed for allowed in
+                CourseEnrollmentAllowed.objects.filter(email=self.email, course_id__in=course_keys)
+            }
+
+    def is_enrolled(self, course_id, mode=None):
+        """Return True if the learner is actively enrolled in course_id, in
+        mode if given.
+        """
+        enrollment = self.enrollments.get(course_id)
+        return (
+            enrollment is not None and enrollment.is_active
+            and (not mode or enrollment.mode == mode)
+        )
+
+    def update_modes(self, modes):
+        """Update the learner's enrollments to the course modes in modes, a
+        dictionary of mode slugs by course ID.
+
+        Enrollments already in the right mode are left alone. Enrollment
+        allowances, for learners without an account, are updated with
+        one query.
+        """
+        from common.djangoapps.student.models.course_enrollment import CourseEnrollmentAllowed
+        from openedx.core.djangoapps.enrollments.api import update_enrollment
+
+        changed_allowances = []
+        for course_id, mode in modes.items():
+            if not is_valid_mode(mode):
+                logger.error(
+                    "Invalid course mode:%s found while updating enrollment for email:%s and course:%s"
+                    % (mode, self.email, course_id)
+                )
+                continue
+
+            mode = get_or_create_course_mode(course_id, mode)
+            if self.user is not None:
+                # If we receive an email with existing user, then update the existing enrollment.
+                enrollment = self.enrollments.get(course_id)
+                if enrollment is None or enrollment.mode != mode:
+                    update_enrollment(username=self.user.username, course_id=course_id, mode=mode)
+            else:
+                # If user does not exist, then it means that CourseEnrollmentAllowed object was created.
+                # So, just get that object and update it with appropriate course_mode.
+                allowed = self.allowed.get(course_id)
+                if allowed is None:
+                    raise CourseEnrollmentAllowed.DoesNotExist(
+                        "No enrollment allowance for %s in course %s" % (self.email, course_id)
+                    )
+                if allowed.mode != mode:
+                    allowed.mode = mode
+                    changed_allowances.append(allowed)
+
+        if changed_allowances:
+            CourseEnrollmentAllowed.objects.bulk_update(changed_allowances, ["mode"])
+
+    def defer_mode(self, course_id, mode):
+        """Update the learner's enrollment in course_id to mode on the next
+        apply_deferred_modes() call, once it has been enrolled.
+        """
+        if course_id not in self.course_ids:
+            self.course_ids.append(course_id)
+        self.deferred_modes[course_id] = mode
+
+    def apply_deferred_modes(self):
+        """Reload the learner's enrollments, which were just enrolled, and
+        update them to the deferred course modes.
+        """
+        if not self.deferred_modes:
+            return
+        modes, self.deferred_modes = self.deferred_modes, {}
+        self.load()
+        self.update_modes(modes)
+
+
+@lru_cache(maxsize=None)
+def _load_backend(path):
+    return import_string(path)()
+
+
+def get_enrollment_backend():
+    """Return the configured enrollment backend."""
+    return _load_backend(
+        getattr(settings, "WEBHOOK_RECEIVER_ENROLLMENT_BACKEND", DEFAULT_BACKEND)
+    )
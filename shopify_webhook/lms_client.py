@@ -0,0 +1,101 @@
+"""
+Process-wide client for the LMS REST APIs.
+
+Building an OAuthAPIClient for every enrollment opens a new connection
+to the LMS for every call. Instead, each process has one client per LMS
+and set of credentials, with one keep-alive session shared by all of
+its threads (and so by all Celery tasks run by a worker process).
+
+Access tokens are fetched with
+edx_rest_api_client.client.get_and_cache_oauth_access_token(), which
+keeps them in the Django cache until shortly before they expire, so
+that all worker processes share them. Every request, including token
+requests, has a timeout of WEBHOOK_RECEIVER_LMS_API_TIMEOUT seconds.
+"""
+import os
+import threading
+
+import requests
+from django.conf import settings
+from edx_rest_api_client.client import get_and_cache_oauth_access_token
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_TIMEOUT = 10
+
+POOL_SIZE = 10
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_timeout():
+    return getattr(settings, "WEBHOOK_RECEIVER_LMS_API_TIMEOUT", DEFAULT_TIMEOUT)
+
+
+class LMSClient:
+    """Send authenticated requests to the LMS.
+
+    Instances are thread-safe, and meant to be shared; use
+    get_lms_client().
+    """
+
+    def __init__(self, base_url, client_id, client_secret):
+        self.base_url = base_url.rstrip("/")
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get_token(self):
+        """Return a valid JWT access token, from the cache if possible."""
+        token, expires = get_and_cache_oauth_access_token(
+            self.base_url,
+            self.client_id,
+            self.client_secret,
+            token_type="jwt",
+            timeout=get_timeout(),
+        )
+        return token
+
+    def request(self, method, url, **kwargs):
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers["Authorization"] = "JWT " + self.get_token()
+        kwargs.setdefault("timeout", get_timeout())
+        return self.session.request(method, url, headers=headers, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+
+def get_lms_client():
+    """Return the process-wide client for the configured LMS and OAuth
+    credentials.
+    """
+    key = (
+        settings.LMS_ROOT_URL,
+        settings.WEBHOOK_RECEIVER_EDX_OAUTH2_KEY,
+        settings.WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET,
+    )
+    try:
+        return _clients[key]
+    except KeyError:
+        pass
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = LMSClient(*key)
+        return _clients[key]
+
+
+def _reset_after_fork():
+    # A forked process (e.g. a Celery prefork worker) must not share
+    # connections, or a lock held at fork time, with its parent.
+    global _clients_lock
+    _clients.clear()
+    _clients_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,63 @@
+"""
+Management command to archive and delete old processed webhook data.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from shopify_webhook import retention
+
+
+class Command(BaseCommand):
+    """
+    Management command to move processed webhooks (and optionally orders)
+    older than a number of days into compressed JSONL segment files, and
+    delete them from the database in bounded batches.
+    """
+
+    help = "Archive processed webhook data older than a number of days, and delete it."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--archive-dir",
+            default=getattr(settings, "WEBHOOK_RECEIVER_ARCHIVE_DIR", None),
+            help="Directory to write segment files to. Defaults to WEBHOOK_RECEIVER_ARCHIVE_DIR.",
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=getattr(settings, "WEBHOOK_RECEIVER_RETENTION_DAYS", retention.DEFAULT_RETENTION_DAYS),
+            help="Archive data received more than this many days ago.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=retention.DEFAULT_BATCH_SIZE,
+            help="Number of rows to archive and delete per transaction.",
+        )
+        parser.add_argument(
+            "--max-batches",
+            type=int,
+            default=None,
+            help="Stop after this many batches (of each kind of row).",
+        )
+        parser.add_argument(
+            "--include-orders",
+            action="store_true",
+            help="Also archive processed orders and their items.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["archive_dir"]:
+            raise CommandError("Please specify --archive-dir, or set WEBHOOK_RECEIVER_ARCHIVE_DIR.")
+
+        archived = retention.archive(
+            options["archive_dir"],
+            days=options["days"],
+            batch_size=options["batch_size"],
+            max_batches=options["max_batches"],
+            include_orders=options["include_orders"],
+        )
+        self.stdout.write(
+            "Archived %s webhooks and %s orders."
+            % (archived[retention.WEBHOOK], archived[retention.ORDER])
+        )
@@ -0,0 +1,94 @@
+"""
+Management command to compare the webhook JSON codec with the standard
+library json module on large orders.
+"""
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from shopify_webhook import codec
+
+
+def make_order(line_items):
+    """Return a synthetic orders/create payload with line_items items."""
+    return {
+        "id": 820982911946154508,
+        "email": "jon@example.com",
+        "tags": "",
+        "customer": {
+            "id": 115310627314723954,
+            "email": "jon@example.com",
+            "first_name": "Jon",
+            "last_name": "Doe",
+        },
+        "line_items": [
+            {
+                "id": 866550311766439000 + i,
+                "sku": "course-v1:Org+CS%03d+2024" % i,
+                "title": "Course %s" % i,
+                "variant_title": "verified",
+                "quantity": 1,
+                "price": "199.00",
+                "properties": [],
+                "tax_lines": [{"price": "13.50", "rate": 0.06, "title": "State tax"}],
+            }
+            for i in range(line_items)
+        ],
+    }
+
+
+def round_trips(loads, dumps, body):
+    """Run the encode/decode passes a webhook goes through: parse the
+    request body, encode the JSONField value, and encode and decode the
+    Celery task arguments.
+    """
+    content = loads(body)
+    dumps(content)
+    loads(dumps([content]))
+
+
+class Command(BaseCommand):
+    """
+    Management command to benchmark JSON parsing and serialization of large
+    orders with the configured codec and with the json module.
+    """
+
+    help = "Benchmark the webhook JSON codec against the json module on large orders."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--line-items",
+            type=int,
+            default=250,
+            help="Number of line items in the synthetic order.",
+        )
+        parser.add_argument(
+            "--iterations",
+            type=int,
+            default=1000,
+            help="Number of times to process the order with each codec.",
+        )
+
+    def handle(self, *args, **options):
+        body = json.dumps(make_order(options["line_items"])).encode("utf-8")
+        iterations = options["iterations"]
+
+        codecs = [("json", json.loads, json.dumps)]
+        if codec.orjson is not None:
+            codecs.append(("orjson", codec.loads, codec.dumps))
+        else:
+            self.stdout.write("orjson is not installed, the codec uses json.")
+
+        self.stdout.write(
+            "Order of %s line items (%s bytes), %s iterations:"
+            % (options["line_items"], len(body), iterations)
+        )
+        baseline = None
+        for name, loads, dumps in codecs:
+            seconds = timeit.timeit(lambda: round_trips(loads, dumps, body), number=iterations)
+            per_order = seconds / iterations * 1000
+            baseline = baseline or per_order
+            self.stdout.write(
+                "%-8s %8.3f ms per order (%.1fx)" % (name, per_order, baseline / per_order)
+            )
@@ -0,0 +1,76 @@
+"""
+Management command to convert stored webhook data to the compact
+storage format.
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from shopify_webhook.models import JSONWebhookData
+from shopify_webhook.storage import compress_body, filter_headers, get_codec
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Management command to compress the body of stored webhooks, drop their
+    stored content and non-Shopify headers.
+
+    Stored content that differs from the body, like the order data added
+    to cancellations, is kept: it could not be decoded from the body.
+
+    Rows are converted in batches, in order of ID, each batch in its own
+    transaction. If interrupted, run the command again (optionally with
+    --start-id) to resume: rows that are already compact are skipped.
+    """
+
+    help = "Convert stored webhook data to the compact storage format, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of rows to convert per transaction.",
+        )
+        parser.add_argument(
+            "--start-id",
+            type=int,
+            default=0,
+            help="Only convert rows with an ID greater than this one.",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_id = options["start_id"]
+        codec = get_codec()
+        converted = 0
+
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    JSONWebhookData.objects.select_for_update()
+                    .filter(body_codec="", id__gt=last_id)
+                    .order_by("id")[:batch_size]
+                )
+                if not batch:
+                    break
+
+                for data in batch:
+                    if data.stored_content == data.body_content():
+                        data.stored_content = None
+                    data.headers = filter_headers(data.headers or {})
+                    data.body = compress_body(data.body, codec)
+                    data.body_codec = codec
+
+                JSONWebhookData.objects.bulk_update(
+                    batch, ["headers", "body", "body_codec", "stored_content"]
+                )
+
+            last_id = batch[-1].id
+            converted += len(batch)
+            logger.info("Converted %s webhooks, up to ID %s" % (converted, last_id))
+
+        self.stdout.write("Converted %s webhooks to compact storage." % converted)
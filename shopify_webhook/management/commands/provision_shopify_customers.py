@@ -0,0 +1,41 @@
+"""
+Management command to create LMS users for existing Shopify customers.
+"""
+from django.core.management.base import BaseCommand
+
+from shopify_webhook.provisioning import DEFAULT_CHUNK_SIZE, bulk_provision_users, read_customers
+
+
+class Command(BaseCommand):
+    """
+    Management command to create LMS users and profiles, in bulk, for the
+    customers in a Shopify customer export. Customers whose email already
+    belongs to a user are skipped.
+    """
+
+    help = "Create LMS users for the customers in a Shopify customer export (CSV or JSONL)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Path to the customer export.")
+        parser.add_argument(
+            "--format",
+            dest="file_format",
+            choices=["csv", "jsonl"],
+            default=None,
+            help="Format of the export. Guessed from the file extension by default.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help="Number of customers to provision per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        counts = bulk_provision_users(
+            read_customers(options["path"], file_format=options["file_format"]),
+            chunk_size=options["chunk_size"],
+        )
+        self.stdout.write(
+            "Created %(created)s users, skipped %(existing)s existing and %(invalid)s invalid customers." % counts
+        )
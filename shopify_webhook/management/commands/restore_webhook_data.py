@@ -0,0 +1,29 @@
+"""
+Management command to restore archived webhook data.
+"""
+from django.core.management.base import BaseCommand
+
+from shopify_webhook import retention
+
+
+class Command(BaseCommand):
+    """
+    Management command to restore webhooks and orders from segment files
+    written by archive_webhook_data.
+    """
+
+    help = "Restore archived webhook data from segment files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("segments", nargs="+", help="Segment files to restore.")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=retention.DEFAULT_BATCH_SIZE,
+            help="Number of records to restore per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        for path in options["segments"]:
+            count = retention.restore(path, batch_size=options["batch_size"])
+            self.stdout.write("Restored %s records from %s." % (count, path))
@@ -0,0 +1,75 @@
+"""
+Cheap counters for webhook processing.
+
+Counters are always kept in process memory. If
+WEBHOOK_RECEIVER_METRICS_CACHE names a Django cache alias, they are
+also incremented in that cache, so that they can be aggregated across
+processes and web nodes.
+"""
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+CACHE_KEY_PREFIX = "shopify_webhook:metrics:"
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_counters = Counter()
+
+
+def increment(name, value=1):
+    """Increment the counter called name by value."""
+    with _lock:
+        _counters[name] += value
+
+    alias = getattr(settings, "WEBHOOK_RECEIVER_METRICS_CACHE", None)
+    if not alias:
+        return
+
+    cache = caches[alias]
+    key = CACHE_KEY_PREFIX + name
+    try:
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            # The key does not exist yet. Another process may create
+            # it concurrently, in which case add() fails and we
+            # increment instead.
+            if not cache.add(key, value, timeout=None):
+                cache.incr(key, value)
+    except Exception as e:
+        # Metrics must never break webhook processing.
+        logger.warning("Unable to update metric %s in cache: %s" % (name, e))
+
+
+def observe(name, value, buckets):
+    """Record value in a histogram of counters.
+
+    Increments name.count, name.sum, and the counter of the smallest
+    bucket that value fits in (name.le_<bucket>, or name.le_inf).
+    """
+    increment(name + ".count")
+    increment(name + ".sum", value)
+    for bucket in buckets:
+        if value <= bucket:
+            increment("%s.le_%s" % (name, bucket))
+            break
+    else:
+        increment(name + ".le_inf")
+
+
+def get_counters():
+    """Return a snapshot of the in-process counters."""
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    """Reset the in-process counters."""
+    with _lock:
+        _counters.clear()
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopify_webhook', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jsonwebhookdata',
+            name='webhook_id',
+            field=models.CharField(max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopify_webhook', '0002_jsonwebhookdata_webhook_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jsonwebhookdata',
+            name='body_codec',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        # The content field becomes stored_content, but keeps its
+        # "content" database column, so this only changes the state.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveField(
+                    model_name='jsonwebhookdata',
+                    name='content',
+                ),
+                migrations.AddField(
+                    model_name='jsonwebhookdata',
+                    name='stored_content',
+                    field=models.JSONField(db_column='content', null=True),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:57
+
+from django.db import migrations, models
+import shopify_webhook.codec
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopify_webhook', '0003_compact_webhook_storage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='jsonwebhookdata',
+            name='headers',
+            field=models.JSONField(decoder=shopify_webhook.codec.JSONDecoder, encoder=shopify_webhook.codec.JSONEncoder),
+        ),
+        migrations.AlterField(
+            model_name='jsonwebhookdata',
+            name='stored_content',
+            field=models.JSONField(db_column='content', decoder=shopify_webhook.codec.JSONDecoder, encoder=shopify_webhook.codec.JSONEncoder, null=True),
+        ),
+    ]
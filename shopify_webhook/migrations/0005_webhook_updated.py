@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopify_webhook', '0004_webhook_json_codec'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jsonwebhookdata',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
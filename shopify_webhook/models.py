@@ -16,6 +16,9 @@ from django_fsm import FSMIntegerField, ConcurrentTransitionMixin, transition
 from django.utils import timezone
 
 from . import STATE
+from . import codec
+from .codec import JSONEncoder, JSONDecoder
+from .storage import decompress_body
 
 import logging
 
@@ -44,11 +47,25 @@ class WebhookData(ConcurrentTransitionMixin, Model):
     status = FSMIntegerField(choices=CHOICES, default=NEW, protected=True)
     source = GenericIPAddressField(null=True)
     received = DateTimeField(default=timezone.now)
-    headers = JSONField()
+    # When the row was last saved, which tells a delivery that is still
+    # being processed from one that was abandoned.
+    updated = DateTimeField(auto_now=True)
+    # The X-Shopify-Webhook-Id header, which is the same for every
+    # delivery attempt of a webhook. The unique index makes redelivery
+    # detection safe across web nodes.
+    webhook_id = CharField(max_length=255, null=True, unique=True)
+    headers = JSONField(encoder=JSONEncoder, decoder=JSONDecoder)
     # This is for storing the webhook payload exactly as received
     # (i.e. from request.body), which comes in handy for signature
-    # verification.
+    # verification. In compact format the body is stored compressed,
+    # with body_codec naming the compression codec.
     body = BinaryField()
+    body_codec = CharField(max_length=16, blank=True, default="")
+
+    @property
+    def raw_body(self):
+        """The webhook payload exactly as received."""
+        return decompress_body(self.body, self.body_codec)
 
     @transition(field=status, source=NEW, target=PROCESSING, on_error=ERROR)
     def start_processing(self):
@@ -76,7 +93,65 @@ class JSONWebhookData(WebhookData):
 
     # In addition to the webhook source and timestamp, we also want
     # the webhook content, which in this case is always JSON data.
-    content = JSONField(null=True)
+    # Rows in compact format only store content that differs from
+    # their body (e.g. the order data added to a cancellation), and
+    # the content property decodes the body otherwise.
+    stored_content = JSONField(
+        null=True, db_column="content", encoder=JSONEncoder, decoder=JSONDecoder
+    )
+
+    @property
+    def content(self):
+        try:
+            return self._content
+        except AttributeError:
+            pass
+
+        content = self.stored_content
+        if content is None and self.body_codec:
+            content = self.body_content()
+        self._content = content
+        return content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        if not self.body_codec or value != self.body_content():
+            self.stored_content = value
+        else:
+            self.stored_content = None
+
+    def body_content(self):
+        """Return the body decoded as JSON, or None if it is not valid
+        JSON.
+        """
+        try:
+            return codec.loads(self.raw_body)
+        except ValueError:
+            logger.warning("Unable to decode content of webhook %s" % self.id)
+            return None
+
+    def parse_body(self, body=None):
+        """Parse the body as the content of the webhook, and return it.
+
+        body is the payload as received, if it is at hand, to save
+        decompressing the stored body. Raise ValueError if it is not
+        valid JSON.
+        """
+        content = codec.loads(self.raw_body if body is None else body)
+        self.set_body_content(content)
+        return content
+
+    def set_body_content(self, content):
+        """Set the content to the already decoded body."""
+        self._content = content
+        # The content is the body itself, which compact rows do not
+        # store twice.
+        self.stored_content = None if self.body_codec else content
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.__dict__.pop("_content", None)
 
 
 class Order(ConcurrentTransitionMixin, Model):
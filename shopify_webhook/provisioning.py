@@ -0,0 +1,290 @@
+"""
+Provisioning of LMS user accounts for Shopify customers.
+"""
+import csv
+import json
+import logging
+from functools import reduce
+from itertools import islice
+from operator import or_
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core import checks
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# How many times to retry creating a user whose allocated username was
+# taken concurrently.
+MAX_USERNAME_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+
+class UsernameAllocator:
+    """Allocate usernames in memory, given the usernames already taken.
+
+    A username based on base_username is the first of base_username,
+    base_username_1, base_username_2, ... that is not taken, regardless
+    of case.
+    """
+
+    def __init__(self, taken=()):
+        self._taken = set()
+        # Numeric suffixes in use, by lowercased base username
+        self._suffixes = {}
+        for username in taken:
+            self.add(username)
+
+    def add(self, username):
+        """Mark username as taken."""
+        username = username.lower()
+        self._taken.add(username)
+        head, separator, tail = username.rpartition("_")
+        if separator and tail.isascii() and tail.isdigit():
+            self._suffixes.setdefault(head, set()).add(int(tail))
+
+    def allocate(self, base_username):
+        """Return a free username based on base_username, and mark it as
+        taken.
+        """
+        username = base_username
+        if base_username.lower() in self._taken:
+            suffixes = self._suffixes.get(base_username.lower(), ())
+            counter = 1
+            while counter in suffixes:
+                counter += 1
+            username = f"{base_username}_{counter}"
+        self.add(username)
+        return username
+
+
+def next_free_username(base_username, taken):
+    """Return the first of base_username, base_username_1,
+    base_username_2, ... that is not in taken.
+    """
+    return UsernameAllocator(taken).allocate(base_username)
+
+
+def allocate_username(base_username):
+    """Return a username based on base_username that is not taken yet.
+
+    This needs a single prefix query, however many suffixed variants of
+    base_username already exist. Usernames are compared without regard
+    to case, as some databases enforce uniqueness that way.
+    """
+    taken = User.objects.filter(
+        username__istartswith=base_username
+    ).values_list("username", flat=True)
+    return next_free_username(base_username, taken)
+
+
+def provision_user(email):
+    """Make sure an LMS user exists for email.
+
+    Return a (user, created) tuple, like get_or_create().
+    """
+    base_username = email.split("@")[0]  # Generate username from email
+
+    for attempt in range(MAX_USERNAME_ATTEMPTS):
+        username = allocate_username(base_username)
+        try:
+            with transaction.atomic():
+                # New users get an unusable password, which costs no
+                # hashing. Any initial password is set by a worker.
+                user, created = User.objects.get_or_create(
+                    email=email,
+                    defaults={"username": username, "password": make_password(None)}
+                )
+
+                if created:
+                    # Create a UserProfile for the user
+                    from common.djangoapps.student.models import UserProfile  # Updated import path
+                    UserProfile.objects.create(user=user, name=username)
+        except IntegrityError:
+            # Someone else took the username between our lookup and our
+            # insert. Allocate again, rather than probing one by one.
+            logger.info(f"Username {username} was taken concurrently, retrying")
+            continue
+        break
+    else:
+        raise IntegrityError(f"Unable to allocate a username for {email}")
+
+    if created:
+        logger.info(f"Created user {username} with email {email} and profile")
+        schedule_initial_password(user.id)
+    else:
+        logger.info(f"User with email {email} already exists. No new user created.")
+
+    return user, created
+
+
+def schedule_initial_password(user_id):
+    """Have a worker set WEBHOOK_RECEIVER_DEFAULT_PASSWORD as the password
+    of a new user, if that setting is configured.
+
+    Without it, new users keep an unusable password, and set their own
+    through the LMS password reset flow.
+    """
+    if not getattr(settings, "WEBHOOK_RECEIVER_DEFAULT_PASSWORD", None):
+        return
+
+    from .tasks import set_initial_password
+    transaction.on_commit(lambda: set_initial_password.delay(user_id))
+
+
+def check_default_password(app_configs, **kwargs):
+    """Warn about WEBHOOK_RECEIVER_DEFAULT_PASSWORD, which gives every new
+    user the same password.
+    """
+    if not getattr(settings, "WEBHOOK_RECEIVER_DEFAULT_PASSWORD", None):
+        return []
+    return [checks.Warning(
+        "WEBHOOK_RECEIVER_DEFAULT_PASSWORD is set, so every user created from a Shopify order "
+        "gets the same password, which lets anyone who knows it log in as them.",
+        hint="Unset it, so that new users set their own password through the password reset flow.",
+        id="shopify_webhook.W001",
+    )]
+
+
+def read_customers(path, file_format=None):
+    """Yield customers from a Shopify customer export.
+
+    The export may be a CSV file (as exported from the Shopify admin)
+    or a JSONL file with one customer object per line. Column and key
+    names are normalized, so that e.g. "First Name" becomes first_name.
+    The file_format ("csv" or "jsonl") is guessed from the file
+    extension if not given.
+    """
+    if file_format is None:
+        file_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+
+    with open(path, encoding="utf-8", newline="") as export:
+        if file_format == "csv":
+            rows = csv.DictReader(export)
+        else:
+            rows = (json.loads(line) for line in export if line.strip())
+        for row in rows:
+            yield {
+                key.strip().lower().replace(" ", "_"): value
+                for key, value in row.items() if key
+            }
+
+
+def bulk_provision_users(customers, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Create LMS users and profiles for an iterable of customers.
+
+    Customers are dictionaries with an email key, and optionally
+    first_name and last_name. They are processed in chunks of
+    chunk_size, each with one query for existing emails, one for
+    existing usernames, and bulk inserts of users and profiles. New users
+    get an unusable password.
+
+    Return a dictionary of counts of created, existing and invalid
+    customers.
+    """
+    counts = {"created": 0, "existing": 0, "invalid": 0}
+    customers = iter(customers)
+    while True:
+        chunk = list(islice(customers, chunk_size))
+        if not chunk:
+            break
+        for key, count in _bulk_provision_chunk(chunk).items():
+            counts[key] += count
+        logger.info("Provisioned users: %s" % counts)
+    return counts
+
+
+def _existing_emails(emails):
+    """Return those of the lowercased emails that users already have,
+    regardless of case.
+    """
+    queryset = User.objects.all()
+    if connections[queryset.db].vendor == "mysql":
+        # The LMS's MySQL collation compares emails without regard to
+        # case, so a plain lookup can use the index on email.
+        queryset = queryset.filter(email__in=emails)
+    else:
+        queryset = queryset.annotate(email_lower=Lower("email")).filter(email_lower__in=emails)
+    return {email.lower() for email in queryset.values_list("email", flat=True)} & set(emails)
+
+
+def _bulk_provision_chunk(customers):
+    counts = {"created": 0, "existing": 0, "invalid": 0}
+
+    # Keep the first customer for each valid email. Emails are compared
+    # without regard to case, as the LMS does when logging in.
+    by_email = {}
+    for customer in customers:
+        email = (customer.get("email") or "").strip()
+        try:
+            validate_email(email)
+        except ValidationError:
+            logger.warning("Skipping customer with invalid email %r" % email)
+            counts["invalid"] += 1
+            continue
+        by_email.setdefault(email.lower(), dict(customer, email=email))
+
+    existing = _existing_emails(list(by_email))
+    counts["existing"] += len(existing)
+    new = {key: customer for key, customer in by_email.items() if key not in existing}
+    if not new:
+        return counts
+
+    bases = {customer["email"].split("@")[0] for customer in new.values()}
+    allocator = UsernameAllocator(
+        User.objects.filter(
+            reduce(or_, (Q(username__istartswith=base) for base in bases))
+        ).values_list("username", flat=True)
+    )
+
+    users = []
+    for customer in new.values():
+        email = customer["email"]
+        users.append(User(
+            username=allocator.allocate(email.split("@")[0]),
+            email=email,
+            first_name=(customer.get("first_name") or "")[:150],
+            last_name=(customer.get("last_name") or "")[:150],
+            password=make_password(None),
+        ))
+
+    from common.djangoapps.student.models import UserProfile
+
+    with transaction.atomic():
+        # Rows that conflict with users created concurrently are skipped,
+        # and provisioned one by one below.
+        User.objects.bulk_create(users, ignore_conflicts=True)
+        created = {
+            email.lower(): (user_id, username) for user_id, username, email in
+            User.objects.filter(
+                username__in=[user.username for user in users]
+            ).values_list("id", "username", "email")
+            if email.lower() in new
+        }
+        UserProfile.objects.bulk_create([
+            UserProfile(
+                user_id=user_id,
+                name=" ".join(filter(None, [
+                    new[key].get("first_name"), new[key].get("last_name")
+                ])) or username,
+            )
+            for key, (user_id, username) in created.items()
+        ], ignore_conflicts=True)
+        for user_id, username in created.values():
+            schedule_initial_password(user_id)
+    counts["created"] += len(created)
+
+    for key, customer in new.items():
+        if key not in created:
+            user, was_created = provision_user(customer["email"])
+            counts["created" if was_created else "existing"] += 1
+
+    return counts
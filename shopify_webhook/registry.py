@@ -0,0 +1,167 @@
+"""
+Registry of the Shopify shops we receive webhooks from.
+
+The registry is built once, when the app is ready, from
+WEBHOOK_RECEIVER_SETTINGS["shopify"]. Each shop is configured under
+"shops", keyed by its myshopify.com domain:
+
+    WEBHOOK_RECEIVER_SETTINGS = {
+        "shopify": {
+            "shops": {
+                "store-a.myshopify.com": {
+                    # Several secrets may be valid at once while one is
+                    # being rotated.
+                    "api_keys": ["new-secret", "old-secret"],
+                    "admin_api_url": "https://store-a.myshopify.com/admin/api/2024-10/graphql.json",
+                    "admin_api_access_token": "shpat_...",
+                },
+            },
+        },
+    }
+
+The single-shop settings ("shop_domain" or "shop_domains" with a shared
+"api_key", and SHOPIFY_ADMIN_API_URL/SHOPIFY_ADMIN_API_ACCESS_TOKEN) are
+still supported. A domain configured both ways uses its "shops" entry.
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+logger = logging.getLogger(__name__)
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+class Shop:
+    """A Shopify shop, with its webhook secrets and Admin API settings."""
+
+    def __init__(self, domain, api_keys, admin_api_url=None, admin_api_access_token=None):
+        self.domain = domain
+        self.api_keys = tuple(api_keys)
+        self.admin_api_url = admin_api_url
+        self.admin_api_access_token = admin_api_access_token
+
+        # Precompute a keyed HMAC object per secret, to be copied for
+        # every message.
+        self._hmac_templates = [
+            hmac.new(key.encode("utf-8"), digestmod=hashlib.sha256)
+            for key in self.api_keys
+        ]
+
+    def __repr__(self):
+        return "<Shop %s>" % self.domain
+
+    def hmac_is_valid(self, body, hmac_to_verify):
+        """Return True if hmac_to_verify is a valid signature of body with
+        any of the shop's secrets.
+        """
+        expected = hmac_to_verify.encode("utf-8")
+        valid = False
+        # Check every secret, rather than stopping at the first match,
+        # so the response time does not depend on which one matched.
+        for template in self._hmac_templates:
+            mac = template.copy()
+            mac.update(body)
+            valid |= hmac.compare_digest(base64.b64encode(mac.digest()), expected)
+        return valid
+
+    @property
+    def admin_api_headers(self):
+        return {
+            'Content-Type': 'application/json',
+            'X-Shopify-Access-Token': self.admin_api_access_token,
+        }
+
+
+class ShopRegistry:
+    """Shops by domain, with O(1) lookup."""
+
+    def __init__(self, shops, default=None):
+        self._shops = {shop.domain: shop for shop in shops}
+        self.default = default
+
+    def __contains__(self, domain):
+        return domain in self._shops
+
+    def __iter__(self):
+        return iter(self._shops.values())
+
+    def get(self, domain):
+        return self._shops.get(domain)
+
+    @classmethod
+    def from_settings(cls):
+        # The app may be loaded (e.g. for migrations) before the plugin
+        # has been configured, so don't insist on any settings here.
+        conf = getattr(settings, "WEBHOOK_RECEIVER_SETTINGS", {}).get("shopify", {})
+        default_url = getattr(settings, "SHOPIFY_ADMIN_API_URL", None)
+        default_token = getattr(settings, "SHOPIFY_ADMIN_API_ACCESS_TOKEN", None)
+
+        shops = []
+        for domain, shop_conf in (conf.get("shops") or {}).items():
+            api_keys = shop_conf.get("api_keys") or [_api_key(shop_conf, domain)]
+            shops.append(Shop(
+                domain,
+                api_keys,
+                admin_api_url=shop_conf.get("admin_api_url", default_url),
+                admin_api_access_token=shop_conf.get("admin_api_access_token", default_token),
+            ))
+
+        # Single-shop settings, for domains without an entry of their own
+        configured = {shop.domain for shop in shops}
+        legacy_domains = list(conf.get("shop_domains") or [])
+        if conf.get("shop_domain"):
+            legacy_domains.append(conf["shop_domain"])
+        for domain in dict.fromkeys(legacy_domains):
+            if domain in configured:
+                continue
+            shops.append(Shop(
+                domain,
+                [_api_key(conf, domain)],
+                admin_api_url=default_url,
+                admin_api_access_token=default_token,
+            ))
+
+        # The default shop is used for Admin API calls that cannot be
+        # tied to a shop, e.g. for webhooks stored before this registry
+        # existed.
+        default = None
+        if default_url:
+            default = Shop(None, [], admin_api_url=default_url, admin_api_access_token=default_token)
+        elif shops:
+            default = shops[0]
+
+        return cls(shops, default=default)
+
+
+def _api_key(conf, domain):
+    try:
+        return conf["api_key"]
+    except KeyError:
+        raise ImproperlyConfigured(
+            'No "api_keys" or "api_key" configured for Shopify shop %s' % domain
+        )
+
+
+def build_registry():
+    """Build the shop registry from settings. Called when the app is
+    ready.
+    """
+    global _registry
+    with _registry_lock:
+        _registry = ShopRegistry.from_settings()
+        logger.debug("Registered Shopify shops: %s" % list(_registry))
+    return _registry
+
+
+def get_registry():
+    if _registry is None:
+        return build_registry()
+    return _registry
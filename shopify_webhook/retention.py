@@ -0,0 +1,281 @@
+"""
+Retention and archival of webhook and order data.
+
+Processed webhooks older than a given number of days are written to
+gzip-compressed JSONL segment files, and then deleted from the
+database. Each batch of rows is archived in its own short transaction,
+and its segment file is durably written before the rows are deleted,
+so an interrupted run can simply be started again. Archived rows can be
+restored from their segment files.
+
+Webhooks are only archived if every order recorded from them has been
+processed, so that process_failed_orders can still retry failed orders.
+Processed orders, and their items, can optionally be archived too.
+"""
+import base64
+import gzip
+import logging
+import os
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import codec
+from .models import JSONWebhookData
+from .models import ShopifyOrder as Order
+from .models import ShopifyOrderItem as OrderItem
+
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_RETENTION_DAYS = 90
+
+WEBHOOK = "jsonwebhookdata"
+ORDER = "shopifyorder"
+
+logger = logging.getLogger(__name__)
+
+
+def archive(archive_dir, days=DEFAULT_RETENTION_DAYS, batch_size=DEFAULT_BATCH_SIZE,
+            max_batches=None, include_orders=False):
+    """Archive and delete processed data older than days.
+
+    Process at most max_batches batches of batch_size rows (of each
+    kind), if given. Return a dictionary with the number of archived
+    webhooks and orders.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    cutoff = timezone.now() - timedelta(days=days)
+    archived = {WEBHOOK: 0, ORDER: 0}
+
+    if include_orders:
+        archived[ORDER] = _archive_batches(
+            _archive_order_batch, archive_dir, cutoff, batch_size, max_batches
+        )
+    archived[WEBHOOK] = _archive_batches(
+        _archive_webhook_batch, archive_dir, cutoff, batch_size, max_batches
+    )
+    return archived
+
+
+def _archive_batches(archive_batch, archive_dir, cutoff, batch_size, max_batches):
+    total = 0
+    batches = 0
+    last_id = None
+    while max_batches is None or batches < max_batches:
+        count, last_id = archive_batch(archive_dir, cutoff, batch_size, last_id)
+        if not count:
+            break
+        total += count
+        batches += 1
+    return total
+
+
+def _archive_webhook_batch(archive_dir, cutoff, batch_size, last_id):
+    unprocessed_orders = Order.objects.filter(webhook=OuterRef("pk")).exclude(
+        status=Order.PROCESSED
+    )
+    queryset = JSONWebhookData.objects.filter(
+        status=JSONWebhookData.PROCESSED, received__lt=cutoff
+    ).exclude(Exists(unprocessed_orders))
+    if last_id is not None:
+        queryset = queryset.filter(id__gt=last_id)
+
+    with transaction.atomic():
+        batch = list(queryset.select_for_update().order_by("id")[:batch_size])
+        if not batch:
+            return 0, last_id
+
+        ids = [data.id for data in batch]
+        order_ids = {}
+        for order_id, webhook_id in Order.objects.filter(webhook_id__in=ids).values_list("id", "webhook_id"):
+            order_ids.setdefault(webhook_id, []).append(order_id)
+
+        path = _write_segment(
+            archive_dir, WEBHOOK, ids,
+            (_webhook_record(data, order_ids.get(data.id, [])) for data in batch),
+        )
+        # Deleting sets the webhook of any (processed) order to NULL;
+        # restore() links them up again.
+        JSONWebhookData.objects.filter(id__in=ids).delete()
+
+    logger.info("Archived %s webhooks to %s" % (len(batch), path))
+    return len(batch), ids[-1]
+
+
+def _archive_order_batch(archive_dir, cutoff, batch_size, last_id):
+    queryset = Order.objects.filter(status=Order.PROCESSED, received__lt=cutoff)
+    if last_id is not None:
+        queryset = queryset.filter(id__gt=last_id)
+
+    with transaction.atomic():
+        batch = list(queryset.select_for_update().order_by("id")[:batch_size])
+        if not batch:
+            return 0, last_id
+
+        ids = [order.id for order in batch]
+        items = {}
+        for item in OrderItem.objects.filter(order_id__in=ids).order_by("id"):
+            items.setdefault(item.order_id, []).append(item)
+
+        path = _write_segment(
+            archive_dir, ORDER, ids,
+            (_order_record(order, items.get(order.id, [])) for order in batch),
+        )
+        OrderItem.objects.filter(order_id__in=ids).delete()
+        Order.objects.filter(id__in=ids).delete()
+
+    logger.info("Archived %s orders to %s" % (len(batch), path))
+    return len(batch), ids[-1]
+
+
+def _write_segment(archive_dir, kind, ids, records):
+    """Write records to a new segment file, and return its path.
+
+    The file is only moved into place once it has been synced to disk.
+    """
+    name = "%s-%s-%s-%s.jsonl.gz" % (
+        kind, ids[0], ids[-1], timezone.now().strftime("%Y%m%dT%H%M%S%f")
+    )
+    path = os.path.join(archive_dir, name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as segment:
+            for record in records:
+                segment.write(codec.dumps(record).encode("utf-8"))
+                segment.write(b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _webhook_record(data, order_ids):
+    return {
+        "model": WEBHOOK,
+        "id": data.id,
+        "status": data.status,
+        "source": data.source,
+        "received": data.received.isoformat(),
+        "webhook_id": data.webhook_id,
+        "headers": data.headers,
+        "body": base64.b64encode(bytes(data.body)).decode("ascii"),
+        "body_codec": data.body_codec,
+        "content": data.stored_content,
+        "order_ids": order_ids,
+    }
+
+
+def _order_record(order, items):
+    return {
+        "model": ORDER,
+        "id": order.id,
+        "email": order.email,
+        "first_name": order.first_name,
+        "last_name": order.last_name,
+        "received": order.received.isoformat(),
+        "status": order.status,
+        "webhook_id": order.webhook_id,
+        "items": [
+            {"id": item.id, "sku": item.sku, "email": item.email, "status": item.status}
+            for item in items
+        ],
+    }
+
+
+def read_segment(path):
+    """Yield the records of a segment file."""
+    with gzip.open(path, "rb") as segment:
+        for line in segment:
+            if line.strip():
+                yield codec.loads(line)
+
+
+def restore(path, batch_size=DEFAULT_BATCH_SIZE):
+    """Restore the rows archived in a segment file.
+
+    Rows that already exist are left alone, so restoring a segment twice
+    is harmless. Webhooks whose webhook_id has since been taken by a
+    redelivery are skipped, with a warning. Return the number of records read.
+    """
+    count = 0
+    batch = []
+    for record in read_segment(path):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            _restore_batch(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        _restore_batch(batch)
+        count += len(batch)
+    logger.info("Restored %s records from %s" % (count, path))
+    return count
+
+
+def _restore_batch(records):
+    webhooks = [r for r in records if r["model"] == WEBHOOK]
+    orders = [r for r in records if r["model"] == ORDER]
+
+    with transaction.atomic():
+        if webhooks:
+            JSONWebhookData.objects.bulk_create([
+                JSONWebhookData(
+                    id=r["id"],
+                    status=r["status"],
+                    source=r["source"],
+                    received=parse_datetime(r["received"]),
+                    webhook_id=r["webhook_id"],
+                    headers=r["headers"],
+                    body=base64.b64decode(r["body"]),
+                    body_codec=r["body_codec"],
+                    stored_content=r["content"],
+                )
+                for r in webhooks
+            ], ignore_conflicts=True)
+            # A webhook is not restored if it was delivered again since
+            # it was archived, as its webhook_id is then taken.
+            restored = set(JSONWebhookData.objects.filter(
+                id__in=[r["id"] for r in webhooks]
+            ).values_list("id", flat=True))
+            for r in webhooks:
+                if r["id"] not in restored:
+                    logger.warning(
+                        "Webhook %s was not restored: webhook ID %s is already in use"
+                        % (r["id"], r["webhook_id"])
+                    )
+            # Link orders back to their webhooks.
+            for r in webhooks:
+                if r["order_ids"] and r["id"] in restored:
+                    Order.objects.filter(id__in=r["order_ids"], webhook__isnull=True).update(
+                        webhook_id=r["id"]
+                    )
+
+        if orders:
+            webhook_ids = set(JSONWebhookData.objects.filter(
+                id__in=[r["webhook_id"] for r in orders if r["webhook_id"]]
+            ).values_list("id", flat=True))
+            Order.objects.bulk_create([
+                Order(
+                    id=r["id"],
+                    email=r["email"],
+                    first_name=r["first_name"],
+                    last_name=r["last_name"],
+                    received=parse_datetime(r["received"]),
+                    status=r["status"],
+                    webhook_id=r["webhook_id"] if r["webhook_id"] in webhook_ids else None,
+                )
+                for r in orders
+            ], ignore_conflicts=True)
+            OrderItem.objects.bulk_create([
+                OrderItem(
+                    id=item["id"],
+                    order_id=r["id"],
+                    sku=item["sku"],
+                    email=item["email"],
+                    status=item["status"],
+                )
+                for r in orders for item in r["items"]
+            ], ignore_conflicts=True)
@@ -0,0 +1,388 @@
+"""
+Client for the Shopify Admin GraphQL API.
+
+Each shop gets one keep-alive session, shared by all threads of a
+process, and one httpx.AsyncClient per event loop for async views. Every request has a timeout of
+WEBHOOK_RECEIVER_SHOPIFY_ADMIN_API_TIMEOUT seconds, and requests that
+fail with HTTP 429 or 5xx, or with a connection error, are retried up to
+WEBHOOK_RECEIVER_SHOPIFY_ADMIN_API_MAX_RETRIES times, with exponential
+backoff (or after the delay asked for by a Retry-After header).
+
+Shopify limits GraphQL requests by their calculated cost, with a leaky
+bucket per shop whose state is reported in extensions.cost.throttleStatus
+of every response. A CostLimiter mirrors that bucket, so that requests
+wait for enough of it to be restored instead of being THROTTLED. It is
+kept in the Django cache named by WEBHOOK_RECEIVER_SHOPIFY_RATE_LIMIT_CACHE,
+so that it is shared by all worker processes, or in process memory
+otherwise. Requests that are THROTTLED anyway are retried once enough
+of the bucket has been restored.
+"""
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import threading
+import time
+import weakref
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_MAX_RETRIES = 3
+
+# Seconds to wait before the first retry, doubled for every retry after
+# that, up to MAX_BACKOFF.
+BACKOFF_FACTOR = 0.5
+MAX_BACKOFF = 10
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+POOL_SIZE = 10
+
+# Assumed cost of a query that was never sent, and bucket assumed for a
+# shop we have no throttle status for (that of a standard plan).
+DEFAULT_QUERY_COST = 50
+DEFAULT_BUCKET_SIZE = 1000
+DEFAULT_RESTORE_RATE = 50
+
+CACHE_KEY_PREFIX = "shopify_webhook:graphql_cost:"
+
+# How long a process may hold the lock of a shared bucket, and how often
+# the others check whether it is free.
+LOCK_TIMEOUT = 1
+LOCK_POLL_INTERVAL = 0.01
+
+logger = logging.getLogger(__name__)
+
+_clients = {}
+_clients_lock = threading.Lock()
+# Async clients by shop, for each event loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_timeout():
+    return getattr(settings, "WEBHOOK_RECEIVER_SHOPIFY_ADMIN_API_TIMEOUT", DEFAULT_TIMEOUT)
+
+
+def get_max_retries():
+    return getattr(settings, "WEBHOOK_RECEIVER_SHOPIFY_ADMIN_API_MAX_RETRIES", DEFAULT_MAX_RETRIES)
+
+
+def retry_delay(attempt, retry_after=None):
+    """Return how many seconds to wait before retry number attempt
+    (counting from 0).
+    """
+    if retry_after:
+        try:
+            return min(MAX_BACKOFF, max(0.0, float(retry_after)))
+        except ValueError:
+            # An HTTP date, which Shopify does not send
+            pass
+    return min(MAX_BACKOFF, BACKOFF_FACTOR * 2 ** attempt)
+
+
+def _log_retry(shop, attempt, delay, reason):
+    metrics.increment("shopify_admin.retries")
+    logger.warning(
+        "Shopify Admin API request for %s failed (%s), retrying in %.1fs (attempt %s)"
+        % (shop.domain, reason, delay, attempt + 1)
+    )
+
+
+class ThrottledError(Exception):
+    """A GraphQL request was still THROTTLED after all retries."""
+
+
+class AdminAPIError(Exception):
+    """A GraphQL request failed, or its response could not be read."""
+
+
+def is_throttled(data):
+    return any(
+        (error.get("extensions") or {}).get("code") == "THROTTLED"
+        for error in (data.get("errors") or [])
+    )
+
+
+class CostLimiter:
+    """A token bucket mirroring the GraphQL cost budget of a shop.
+
+    The bucket state is (available, restore rate, size, time), and is
+    updated from the throttle status of every response. Updates of a
+    shared bucket are made under a lock taken with cache.add(), so that
+    concurrent processes do not overwrite each other's reservations.
+    """
+
+    _local_states = {}
+    _local_lock = threading.Lock()
+
+    def __init__(self, shop):
+        self.key = CACHE_KEY_PREFIX + (shop.domain or "default")
+        # Last requested cost, by query
+        self._costs = {}
+
+    def _cache(self):
+        alias = getattr(settings, "WEBHOOK_RECEIVER_SHOPIFY_RATE_LIMIT_CACHE", None)
+        return caches[alias] if alias else None
+
+    def _get_state(self):
+        cache = self._cache()
+        state = cache.get(self.key) if cache is not None else self._local_states.get(self.key)
+        return state or (DEFAULT_BUCKET_SIZE, DEFAULT_RESTORE_RATE, DEFAULT_BUCKET_SIZE, time.time())
+
+    def _set_state(self, state):
+        cache = self._cache()
+        if cache is not None:
+            # The bucket is fully restored after this long anyway
+            cache.set(self.key, state, timeout=int(state[2] / state[1]) + 1)
+        else:
+            self._local_states[self.key] = state
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """Lock the bucket against other threads, and other processes if
+        it is shared.
+
+        A lock that is not released within LOCK_TIMEOUT seconds (e.g.
+        because its process died) expires, and is then ignored.
+        """
+        with self._local_lock:
+            cache = self._cache()
+            if cache is None:
+                yield
+                return
+            lock_key = self.key + ":lock"
+            deadline = time.monotonic() + LOCK_TIMEOUT
+            locked = cache.add(lock_key, 1, timeout=LOCK_TIMEOUT)
+            while not locked and time.monotonic() < deadline:
+                time.sleep(LOCK_POLL_INTERVAL)
+                locked = cache.add(lock_key, 1, timeout=LOCK_TIMEOUT)
+            try:
+                yield
+            finally:
+                if locked:
+                    cache.delete(lock_key)
+
+    @staticmethod
+    def query_key(payload):
+        return hashlib.sha1(payload["query"].encode("utf-8")).hexdigest()
+
+    def acquire(self, payload):
+        """Take the expected cost of payload from the bucket, and return
+        how many seconds to wait before sending it.
+        """
+        cost = self._costs.get(self.query_key(payload), DEFAULT_QUERY_COST)
+        with self._lock():
+            available, rate, size, updated = self._get_state()
+            now = time.time()
+            available = min(size, available + rate * max(0.0, now - updated))
+            # Take the cost now, even if we have to wait for it, so that
+            # concurrent requests queue up behind this one.
+            self._set_state((available - cost, rate, size, now))
+        if available >= cost:
+            return 0
+        return (cost - available) / rate
+
+    def update(self, payload, data):
+        """Update the bucket from the cost extension of a response.
+
+        Return how many seconds to wait before retrying if the request
+        was THROTTLED, and None otherwise.
+        """
+        cost = (data.get("extensions") or {}).get("cost")
+        if not cost:
+            return None
+        status = cost["throttleStatus"]
+        requested = cost.get("requestedQueryCost") or DEFAULT_QUERY_COST
+        self._costs[self.query_key(payload)] = requested
+        with self._lock():
+            self._set_state((
+                status["currentlyAvailable"],
+                status["restoreRate"],
+                status["maximumAvailable"],
+                time.time(),
+            ))
+        if is_throttled(data):
+            metrics.increment("shopify_admin.throttled")
+            return max(0, requested - status["currentlyAvailable"]) / status["restoreRate"]
+        return None
+
+
+def _response_data(response):
+    if response.status_code != 200:
+        return {}
+    try:
+        return response.json()
+    except ValueError:
+        return {}
+
+
+def _log_throttle(shop, attempt, delay):
+    logger.warning(
+        "Shopify Admin API request for %s was throttled, retrying in %.1fs (attempt %s)"
+        % (shop.domain, delay, attempt + 1)
+    )
+
+
+class AdminClient:
+    """Send GraphQL requests to the Admin API of a shop."""
+
+    def __init__(self, shop):
+        self.shop = shop
+        self.limiter = CostLimiter(shop)
+        self.session = requests.Session()
+        self.session.headers.update(shop.admin_api_headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post(self, payload):
+        """POST a GraphQL request body, and return the response.
+
+        Wait for the shop's cost budget before sending it. Raise
+        ThrottledError if it is still THROTTLED after all retries, and
+        requests.RequestException if it still fails with a connection
+        error. Responses with an error status are returned once retries
+        are exhausted.
+        """
+        attempt = 0
+        while True:
+            delay = self.limiter.acquire(payload)
+            if delay:
+                time.sleep(delay)
+            response = self._post(payload)
+            delay = self.limiter.update(payload, _response_data(response))
+            if delay is None:
+                return response
+            if attempt >= get_max_retries():
+                raise ThrottledError("Shopify Admin API request for %s was throttled" % self.shop.domain)
+            _log_throttle(self.shop, attempt, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _post(self, payload):
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(
+                    self.shop.admin_api_url, json=payload, timeout=get_timeout()
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= get_max_retries():
+                    raise
+                delay = retry_delay(attempt)
+                _log_retry(self.shop, attempt, delay, e)
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= get_max_retries():
+                    return response
+                delay = retry_delay(attempt, response.headers.get("Retry-After"))
+                _log_retry(self.shop, attempt, delay, "HTTP %s" % response.status_code)
+            time.sleep(delay)
+            attempt += 1
+
+
+class AsyncAdminClient:
+    """Send GraphQL requests to the Admin API of a shop, with an
+    httpx.AsyncClient.
+    """
+
+    def __init__(self, shop, client):
+        self.shop = shop
+        self.client = client
+        self.limiter = get_admin_client(shop).limiter
+
+    async def post(self, payload):
+        """Async variant of AdminClient.post()."""
+        attempt = 0
+        while True:
+            # The limiter may wait for the lock of a shared bucket, so
+            # it is not called from the event loop.
+            delay = await sync_to_async(self.limiter.acquire)(payload)
+            if delay:
+                await asyncio.sleep(delay)
+            response = await self._post(payload)
+            delay = await sync_to_async(self.limiter.update)(payload, _response_data(response))
+            if delay is None:
+                return response
+            if attempt >= get_max_retries():
+                raise ThrottledError("Shopify Admin API request for %s was throttled" % self.shop.domain)
+            _log_throttle(self.shop, attempt, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _post(self, payload):
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.post(
+                    self.shop.admin_api_url,
+                    headers=self.shop.admin_api_headers,
+                    json=payload,
+                    timeout=get_timeout(),
+                )
+            except httpx.TransportError as e:
+                if attempt >= get_max_retries():
+                    raise
+                delay = retry_delay(attempt)
+                _log_retry(self.shop, attempt, delay, e)
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= get_max_retries():
+                    return response
+                delay = retry_delay(attempt, response.headers.get("Retry-After"))
+                _log_retry(self.shop, attempt, delay, "HTTP %s" % response.status_code)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def get_admin_client(shop):
+    """Return the process-wide Admin API client of shop."""
+    try:
+        return _clients[shop]
+    except KeyError:
+        pass
+    with _clients_lock:
+        if shop not in _clients:
+            _clients[shop] = AdminClient(shop)
+        return _clients[shop]
+
+
+def get_async_admin_client(shop):
+    """Return the Admin API client of shop for the running event loop.
+
+    Its httpx.AsyncClient, and so its keep-alive connections, are shared
+    by all requests served by the loop, which under an ASGI server is
+    one per process. Connections belong to the loop they were opened in,
+    so other loops get clients of their own.
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        if shop not in clients:
+            clients[shop] = AsyncAdminClient(shop, httpx.AsyncClient(timeout=get_timeout()))
+        return clients[shop]
+
+
+def _reset_after_fork():
+    # A forked process (e.g. a Celery prefork worker) must not share
+    # connections, or a lock held at fork time, with its parent.
+    global _clients_lock
+    _clients.clear()
+    _async_clients.clear()
+    _clients_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,11 +1,39 @@
-from django.db.models.signals import post_save
+"""
+Signal handlers for the shopify_webhook app.
+
+Courses are published and deleted in Studio, so the app is also
+installed in the CMS, where the course_published and course_deleted
+receivers run. The CourseOverview receivers run in whichever process
+updates the overview of a course, which is the LMS when it loads an
+outdated overview.
+"""
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from common.djangoapps.student.models.course_enrollment import CourseEnrollmentAllowed
-from .models import CourseEnrollmentAllowedMode
+from common.djangoapps.course_modes.models import CourseMode
+from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
+from xmodule.modulestore.django import SignalHandler
+
+from .courses import course_existence_cache, course_mode_cache
+
+
+@receiver(SignalHandler.course_published)
+@receiver(SignalHandler.course_deleted)
+def invalidate_course_existence(sender, course_key, **kwargs):
+    """Forget whether a course exists, when it is published or deleted."""
+    course_existence_cache.invalidate(str(course_key))
+
+
+@receiver(post_save, sender=CourseOverview)
+@receiver(post_delete, sender=CourseOverview)
+def invalidate_course_overview(sender, instance, **kwargs):
+    """Forget whether a course exists, when its overview is changed or
+    deleted.
+    """
+    course_existence_cache.invalidate(str(instance.id))
 
 
-@receiver(post_save, sender=CourseEnrollmentAllowed)
-def course_enrollment_updated(sender, instance, **kwargs):
-    # Custom logic when CourseEnrollmentAllowed is updated
-    print(f'CourseEnrollmentAllowed updated: {instance}')
-    
+@receiver(post_save, sender=CourseMode)
+@receiver(post_delete, sender=CourseMode)
+def invalidate_course_mode(sender, instance, **kwargs):
+    """Forget about a course mode, when it is changed or deleted."""
+    course_mode_cache.invalidate(instance.course_id, instance.mode_slug)
@@ -0,0 +1,82 @@
+"""
+Compact storage format for webhook payloads.
+
+In compact format, the webhook body is stored compressed, the parsed
+content is not stored at all (it is decoded from the body when needed),
+and only the Shopify headers are kept.
+"""
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    # zstandard is optional, and only needed for the "zstd" codec
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+ZLIB = "zlib"
+ZSTD = "zstd"
+
+CODECS = (ZLIB, ZSTD)
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def compact_storage_enabled():
+    return getattr(settings, "WEBHOOK_RECEIVER_COMPACT_STORAGE", False)
+
+
+def get_codec():
+    """Return the codec configured for compact storage."""
+    codec = getattr(settings, "WEBHOOK_RECEIVER_BODY_COMPRESSION", ZLIB)
+    if codec not in CODECS:
+        raise ImproperlyConfigured(
+            "Unknown WEBHOOK_RECEIVER_BODY_COMPRESSION %r, expected one of %s"
+            % (codec, ", ".join(CODECS))
+        )
+    if codec == ZSTD and zstandard is None:
+        raise ImproperlyConfigured(
+            "WEBHOOK_RECEIVER_BODY_COMPRESSION is %r, but zstandard is not installed" % codec
+        )
+    return codec
+
+
+def compress_body(body, codec):
+    body = bytes(body)
+    if codec == ZLIB:
+        return zlib.compress(body, ZLIB_LEVEL)
+    elif codec == ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    raise ValueError("Unknown body codec %r" % codec)
+
+
+def decompress_body(body, codec):
+    """Return the body as received, given its stored form and codec.
+
+    An empty codec means the body is stored uncompressed.
+    """
+    # Some database backends return BinaryField values as memoryview.
+    body = bytes(body)
+    if not codec:
+        return body
+    elif codec == ZLIB:
+        return zlib.decompress(body)
+    elif codec == ZSTD:
+        if zstandard is None:
+            raise ImproperlyConfigured(
+                "Unable to decompress a zstd webhook body, zstandard is not installed"
+            )
+        return zstandard.ZstdDecompressor().decompress(body)
+    raise ValueError("Unknown body codec %r" % codec)
+
+
+def filter_headers(headers):
+    """Return only the Shopify headers from a dictionary of HTTP headers."""
+    return {
+        name: value for name, value in headers.items()
+        if name.lower().startswith("x-shopify-")
+    }
@@ -1,12 +1,36 @@
 from celery import Task, shared_task
 from celery.utils.log import get_task_logger
-from django.db import transaction
-from requests.exceptions import HTTPError
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import OperationalError, transaction
+from kombu.serialization import register
+from requests.exceptions import HTTPError, RequestException
+from . import codec
+from . import retention
+from .dedupe import remember_delivery
 from .models import ShopifyOrder as Order
+from .models import JSONWebhookData
+from .shopify_admin import AdminAPIError, ThrottledError
 from .utils import process_order
+from .utils import start_webhook_processing, fail_and_save
+from .utils import handle_order_create, handle_order_cancel
 
 logger = get_task_logger(__name__)
 
+# A Celery serializer that uses the same JSON codec as webhook parsing.
+# Set WEBHOOK_RECEIVER_TASK_SERIALIZER to "shopify_webhook_json" to use it
+# for our tasks; Celery workers must then also accept it, e.g. with
+# CELERY_ACCEPT_CONTENT = ["json", "shopify_webhook_json"].
+register(
+    "shopify_webhook_json",
+    codec.dumps,
+    codec.loads,
+    content_type="application/x-shopify-webhook-json",
+    content_encoding="utf-8",
+)
+
+TASK_SERIALIZER = getattr(settings, "WEBHOOK_RECEIVER_TASK_SERIALIZER", "json")
+
 
 class OrderTask(Task):
     """Process a newly received order.
@@ -58,6 +82,7 @@ class OrderTask(Task):
     base=OrderTask,
     autoretry_for=(HTTPError,),
     name="shopify_webhook.process",
+    serializer=TASK_SERIALIZER,
 )
 def process(self, data, retrying_order=False):
     """Parse input data for line items, and create enrollments.
@@ -70,3 +95,124 @@ def process(self, data, retrying_order=False):
     self.order = Order.objects.get(id=data["id"])
 
     process_order(self.order, data, retrying_order=retrying_order)
+
+
+def schedule_order(order, data):
+    """Schedule a recorded order for processing, unless that has
+    already happened.
+    """
+    if order.status == Order.NEW:
+        logger.info("Scheduling order %s for processing" % order.id)
+        process.delay(data)
+    else:
+        logger.info("Order %s already processed, nothing to do" % order.id)
+
+
+class WebhookTask(Task):
+    """Process a webhook stored in fast-ack mode.
+
+    On failure, store the webhook in an ERROR state.
+    """
+
+    @staticmethod
+    def webhook_id(args, kwargs):
+        return args[0] if args else kwargs["webhook_id"]
+
+    def on_retry(self, exc, task_id, args, kwargs, einfo):
+        """Retry handler: log a prose message."""
+        logger.warning(
+            "Failed to process webhook %s "
+            "(task ID %s), retrying: %s" % (self.webhook_id(args, kwargs), task_id, exc)
+        )
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        """Failure handler: log a prose message, then save the webhook
+        with an ERROR status, so that process_failed_orders picks it up.
+        """
+        logger.error(
+            "Failed to process webhook %s "
+            "(task ID %s): %s" % (self.webhook_id(args, kwargs), task_id, exc)
+        )
+        data = JSONWebhookData.objects.filter(id=self.webhook_id(args, kwargs)).first()
+        if data is not None and data.status == JSONWebhookData.PROCESSING:
+            fail_and_save(data)
+
+
+@shared_task(
+    max_retries=3,
+    base=WebhookTask,
+    # Errors that are likely to go away: the Shopify Admin API or the
+    # LMS being unavailable, or a database hiccup.
+    autoretry_for=(RequestException, AdminAPIError, ThrottledError, OperationalError),
+    retry_backoff=True,
+    name="shopify_webhook.process_webhook",
+    serializer=TASK_SERIALIZER,
+)
+def process_webhook(webhook_id, cancellation=False):
+    """Process a webhook that was stored in fast-ack mode.
+
+    This does everything the views would otherwise have done before
+    responding: parse the payload, create the customer's user, record
+    the order, and schedule it for processing.
+    """
+    data = JSONWebhookData.objects.get(id=webhook_id)
+    if data.status == JSONWebhookData.NEW:
+        start_webhook_processing(data)
+    elif data.status == JSONWebhookData.PROCESSING:
+        # A previous attempt of this task failed before recording the
+        # order.
+        logger.warning("Webhook %s is already being processed, retrying" % data.id)
+    else:
+        logger.warning("Webhook %s has already been processed, ignoring" % data.id)
+        return
+
+    if cancellation:
+        order = handle_order_cancel(data)
+    else:
+        order = handle_order_create(data)
+    remember_delivery(data.webhook_id)
+
+    if order:
+        schedule_order(order, data.content)
+
+
+@shared_task(name="shopify_webhook.archive_webhook_data")
+def archive_webhook_data():
+    """Archive and delete old processed webhook data.
+
+    Meant to be run periodically, e.g. from CELERYBEAT_SCHEDULE, with
+    WEBHOOK_RECEIVER_ARCHIVE_DIR set.
+    """
+    archive_dir = getattr(settings, "WEBHOOK_RECEIVER_ARCHIVE_DIR", None)
+    if not archive_dir:
+        logger.warning("WEBHOOK_RECEIVER_ARCHIVE_DIR is not set, not archiving webhook data")
+        return
+
+    archived = retention.archive(
+        archive_dir,
+        days=getattr(settings, "WEBHOOK_RECEIVER_RETENTION_DAYS", retention.DEFAULT_RETENTION_DAYS),
+        max_batches=getattr(settings, "WEBHOOK_RECEIVER_ARCHIVE_MAX_BATCHES", None),
+        include_orders=getattr(settings, "WEBHOOK_RECEIVER_ARCHIVE_ORDERS", False),
+    )
+    logger.info("Archived %s webhooks and %s orders" % (archived[retention.WEBHOOK], archived[retention.ORDER]))
+
+
+@shared_task(name="shopify_webhook.set_initial_password")
+def set_initial_password(user_id):
+    """Set WEBHOOK_RECEIVER_DEFAULT_PASSWORD as the password of a user
+    created from a Shopify order.
+
+    Password hashing is expensive on purpose, so this is done here rather
+    than while responding to the webhook.
+    """
+    password = getattr(settings, "WEBHOOK_RECEIVER_DEFAULT_PASSWORD", None)
+    if not password:
+        return
+
+    user = User.objects.get(id=user_id)
+    if user.has_usable_password():
+        logger.info("User %s already has a password, leaving it alone" % user_id)
+        return
+
+    user.set_password(password)
+    user.save(update_fields=["password"])
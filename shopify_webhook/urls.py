@@ -1,8 +1,17 @@
+from django.conf import settings
 from django.urls import re_path
 from .views import order_create, order_cancel
+from .views import order_create_async, order_cancel_async
+
+
+if getattr(settings, "WEBHOOK_RECEIVER_ASYNC_VIEWS", False):
+    # Native async views, for deployments running under an ASGI server
+    order_create_view, order_cancel_view = order_create_async, order_cancel_async
+else:
+    order_create_view, order_cancel_view = order_create, order_cancel
 
 
 urlpatterns = [
-    re_path(r"^shopify/order/create$", order_create, name="shopify_order_create"),
-    re_path(r"^shopify/order/cancel$", order_cancel, name="shopify_order_cancel")
+    re_path(r"^shopify/order/create$", order_create_view, name="shopify_order_create"),
+    re_path(r"^shopify/order/cancel$", order_cancel_view, name="shopify_order_cancel")
 ]
@@ -1,42 +1,77 @@
 from __future__ import unicode_literals
-import base64
-import hashlib
-import hmac
-import json
 import logging
+import queue
 import re
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from datetime import datetime
 
-from django.core.validators import validate_email
 from django.conf import settings
-from django.db import transaction
+from django.db import connections, router, transaction
+from django_fsm import ConcurrentTransition
+from django_fsm.signals import post_transition
 
-from edx_rest_api_client.client import OAuthAPIClient
+from asgiref.sync import sync_to_async
 from ipware import get_client_ip
 
+try:
+    # httpx is optional, and only used by the async views
+    import httpx
+except ImportError:
+    httpx = None
+
+from . import codec, metrics
 from .models import ShopifyOrder as Order
 from .models import ShopifyOrderItem as OrderItem
 from .models import JSONWebhookData
+from .provisioning import provision_user
+from .batching import get_buffer, group_commit_enabled
+from .courses import course_exists
+from .dedupe import get_webhook_id
+from .enrollment import (  # noqa: F401
+    EDX_BULK_ENROLLMENT_API_PATH,
+    OrderEnrollmentContext,
+    get_enrollment_backend,
+)
+from .registry import get_registry
+from .shopify_admin import AdminAPIError, AsyncAdminClient, get_admin_client, get_async_admin_client
+from .storage import compact_storage_enabled, compress_body, filter_headers, get_codec
 
-from openedx.core.djangoapps.enrollments.api import update_enrollment
-from common.djangoapps.course_modes.models import CourseMode
-from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
-from common.djangoapps.student.models.course_enrollment import CourseEnrollmentAllowed
-from lms.djangoapps.program_enrollments.api.writing import _ensure_course_exists
-from django.contrib.auth.models import User
 
+logger = logging.getLogger(__name__)
 
-EDX_BULK_ENROLLMENT_API_PATH = "%s/api/bulk_enroll/v1/bulk_enroll"
 
-logger = logging.getLogger(__name__)
+def build_webhook_data(request, **fields):
+    """Return an unsaved JSONWebhookData for the request, with any other
+    fields given.
+
+    In compact storage mode, the body is compressed and only the
+    Shopify headers are kept.
+    """
+    headers = dict(request.headers)
+    body = request.body
+    body_codec = ""
+    if compact_storage_enabled():
+        headers = filter_headers(headers)
+        body_codec = get_codec()
+        body = compress_body(body, body_codec)
+
+    return JSONWebhookData(
+        headers=headers,
+        body=body,
+        body_codec=body_codec,
+        webhook_id=get_webhook_id(request),
+        **fields
+    )
 
 
 def receive_json_webhook(request):
+    if getattr(settings, "WEBHOOK_RECEIVER_SINGLE_WRITE_INGESTION", False):
+        return receive_json_webhook_single_write(request)
+
     # Grab data from the request, and save it to the database right
     # away.
-    data = JSONWebhookData(headers=dict(request.headers), body=request.body)
+    data = build_webhook_data(request)
     with transaction.atomic():
         data.save()
 
@@ -55,11 +90,7 @@ def receive_json_webhook(request):
 
     # Parse the payload as JSON
     try:
-        try:
-            data.content = json.loads(data.body)
-        except TypeError:
-            # Python <3.6 can't call json.loads() on a byte string
-            data.content = json.loads(data.body.decode("utf-8"))
+        data.parse_body()
     except Exception:
         # For any other exception, set the state to ERROR and then
         # throw the exception up the stack.
@@ -69,6 +100,116 @@ def receive_json_webhook(request):
     return data
 
 
+def insert_webhook_data(data):
+    """INSERT a new webhook, as part of a group commit if enabled."""
+    if group_commit_enabled():
+        get_buffer(JSONWebhookData).submit(data)
+    else:
+        with transaction.atomic():
+            data.save()
+
+
+def receive_json_webhook_single_write(request):
+    """Receive a webhook with a single INSERT.
+
+    The source IP is looked up and the payload parsed first, so that the
+    row is written in its final state: PROCESSING, or ERROR if the
+    payload is not valid JSON. The NEW->PROCESSING(->ERROR) transitions
+    this skips are then recorded with the ID of the row, see
+    record_transitions().
+    """
+    ip, is_routable = get_client_ip(request)
+
+    try:
+        content = codec.loads(request.body)
+    except Exception:
+        # Record the failed delivery in the same INSERT, then throw
+        # the exception up the stack.
+        data = build_webhook_data(request, source=ip, status=JSONWebhookData.ERROR)
+        insert_webhook_data(data)
+        record_transitions(data, [
+            ("start_processing", JSONWebhookData.NEW, JSONWebhookData.PROCESSING),
+            ("fail", JSONWebhookData.PROCESSING, JSONWebhookData.ERROR),
+        ])
+        raise
+
+    data = build_webhook_data(request, source=ip, status=JSONWebhookData.PROCESSING)
+    data.set_body_content(content)
+    insert_webhook_data(data)
+    record_transitions(data, [
+        ("start_processing", JSONWebhookData.NEW, JSONWebhookData.PROCESSING),
+    ])
+    if ip is None:
+        logger.warning("Unable to get client IP for webhook %s" % data.id)
+
+    return data
+
+
+def record_transitions(data, transitions):
+    """Record (name, source, target) transitions of data that were
+    applied before it was first saved.
+
+    Each is logged with the ID of the row, and sent as the django_fsm
+    post_transition signal, like a transition of a saved row.
+    """
+    field = data._meta.get_field("status")
+    for name, source, target in transitions:
+        logger.info(
+            "Webhook %s transitioned from %s to %s (%s)" % (data.id, source, target, name)
+        )
+        post_transition.send(
+            sender=data.__class__,
+            instance=data,
+            name=name,
+            field=field,
+            source=source,
+            target=target,
+            method_args=(),
+            method_kwargs={},
+        )
+
+
+def receive_raw_webhook(request):
+    """Store a webhook as received, for processing by a worker.
+
+    This is the fast-ack ingestion path: the delivery is stored in the
+    NEW state with a single INSERT, and its payload is neither parsed
+    nor acted upon until start_webhook_processing() is called from a
+    worker.
+    """
+    data = build_webhook_data(request)
+
+    ip, is_routable = get_client_ip(request)
+    if ip is None:
+        logger.warning("Unable to get client IP for webhook received at %s" % data.received)
+    data.source = ip
+
+    insert_webhook_data(data)
+
+    return data
+
+
+def start_webhook_processing(data):
+    """Transition a webhook stored by receive_raw_webhook to PROCESSING,
+    and parse its payload.
+    """
+    data.start_processing()
+    try:
+        data.parse_body()
+    except Exception:
+        data.fail()
+        with transaction.atomic():
+            data.save()
+        raise
+
+    with transaction.atomic():
+        data.save()
+
+
+def fast_ack_enabled():
+    return getattr(settings, "WEBHOOK_RECEIVER_FAST_ACK", False)
+
+
 def fail_and_save(data):
     data.fail()
     with transaction.atomic():
@@ -81,15 +222,6 @@ def finish_and_save(data):
         data.save()
 
 
-def get_hmac(key, body):
-    digest = hmac.new(key.encode("utf-8"), body, hashlib.sha256).digest()
-    return base64.b64encode(digest).decode()
-
-
-def hmac_is_valid(key, body, hmac_to_verify):
-    return get_hmac(key, body) == hmac_to_verify
-
-
 def lookup_course_id(sku):
     """Look up the course ID for a SKU"""
     course_id_regex = "course-v1:[^/]+"
@@ -104,15 +236,13 @@ def lookup_course_id(sku):
     # If the SKU we're given matches the regex from the beginning of
     # its string, great. It looks like a course ID, use it verbatim.
     elif re.match(course_id_regex, sku):
-        try:
-            _ensure_course_exists(sku, user_key_or_id=None)
+        if course_exists(sku):
             return sku
-        except Exception as e:
-            logger.error(
-                "Course key:%s does not exist. Please set correct 'course id' as 'sku'."
-                % sku
-            )
-            return None
+        logger.error(
+            "Course key:%s does not exist. Please set correct 'course id' as 'sku'."
+            % sku
+        )
+        return None
     else:
         logger.error(
             "Course key:%s is not in valid format. Please set correct 'course id' as 'sku'."
@@ -127,106 +257,123 @@ def enroll_in_course(
     mode=None,
     send_email=getattr(settings, 'WEBHOOK_RECEIVER_SEND_ENROLLMENT_EMAIL', True),
     auto_enroll=getattr(settings, 'WEBHOOK_RECEIVER_AUTO_ENROLL', True),
-    action='enroll'
+    action='enroll',
+    context=None,
 ):
     """
     Auto-enroll email in course.
 
-    Uses the bulk enrollment API, defined in lms/djangoapps/bulk_enroll
+    Uses the configured enrollment backend; by default, the bulk
+    enrollment API, defined in lms/djangoapps/bulk_enroll. With the
+    OrderEnrollmentContext of an order, the course mode is deferred
+    until all its line items are enrolled.
     """
+    results = get_enrollment_backend().enroll(
+        [(course_id, email)],
+        send_email=send_email,
+        auto_enroll=auto_enroll,
+        action=action,
+    )
 
-    # Raises ValidationError if invalid
-    validate_email(email)
+    if results.get((course_id, email)) and mode:
+        update_course_mode_for_enrollment(email, course_id, mode, context=context)
 
-    client = OAuthAPIClient(
-        settings.LMS_ROOT_URL,
-        settings.WEBHOOK_RECEIVER_EDX_OAUTH2_KEY,
-        settings.WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET,
-    )
 
-    bulk_enroll_url = EDX_BULK_ENROLLMENT_API_PATH % settings.LMS_ROOT_URL  # noqa: E501
-
-    # The bulk enrollment API allows us to enroll multiple identifiers
-    # at once, using a comma-separated list for the courses and
-    # identifiers parameters. We deliberately want to process
-    # enrollments one by one, so we use a single request for each
-    # course/identifier combination.
-    request_params = {
-        "auto_enroll": auto_enroll,
-        "email_students": send_email,
-        "action": action,
-        "courses": course_id,
-        "identifiers": email,
-    }
+def enroll_in_courses(
+    enrollments,
+    send_email=getattr(settings, 'WEBHOOK_RECEIVER_SEND_ENROLLMENT_EMAIL', True),
+    auto_enroll=getattr(settings, 'WEBHOOK_RECEIVER_AUTO_ENROLL', True),
+    action='enroll'
+):
+    """
+    Enroll (or unenroll) a list of (course_id, email) pairs, with the
+    configured enrollment backend.
 
-    logger.debug(
-        "Sending POST request "
-        "to %s with parameters %s" % (bulk_enroll_url, request_params)
+    Return a dictionary mapping each (course_id, email) pair to True if
+    the backend reported success for it, and False otherwise.
+    """
+    return get_enrollment_backend().enroll(
+        enrollments,
+        send_email=send_email,
+        auto_enroll=auto_enroll,
+        action=action,
     )
-    response = client.post(bulk_enroll_url, request_params)
-
-    if response.status_code == 200 and mode:
-        update_course_mode_for_enrollment(email, course_id, mode)
-
-    # Throw an exception if we get any error back from the API.
-    # Apart from an HTTP 200, we might also get:
-    #
-    # HTTP 400: if we've sent a malformed request (for example, one
-    #           with a course ID in a format that Open edX can't
-    #           parse)
-    # HTTP 401: if our authentication token has expired
-    # HTTP 403: if our auth token is linked to a user ID that lacks
-    #           staff credentials in one of the courses we want to
-    #           enroll the learner in
-    # HTTP 404: if we've specified a course ID that does not exist
-    #           (although it does follow the format that Open edX expects)
-    # HTTP 500: in case of a server-side issue
-    if response.status_code >= 400:
-        logger.error(
-            "POST request to %s with parameters %s "
-            "returned HTTP %s" % (bulk_enroll_url, request_params, response.status_code)
-        )
-    response.raise_for_status()
-
-    # If all is well, log the response at the debug level.
-    logger.debug("Received response from %s: %s " % (bulk_enroll_url, response.json()))
 
 
-def update_course_mode_for_enrollment(email, course_id, mode):
+def update_course_mode_for_enrollment(email, course_id, mode, context=None):
     """
     Update the enrollment with the appropriate course_mode received from shopify
+
+    With the OrderEnrollmentContext of an order, the update is deferred
+    until its apply_deferred_modes() is called.
     """
-    if mode in CourseMode.ALL_MODES:
-        mode = get_or_create_course_mode(course_id, mode)
-        try:
-            # If we receive an email with existing user, then update the existing enrollment.
-            username = User.objects.get(email=email)
-            update_enrollment(username=username, course_id=course_id, mode=mode)
-        except User.DoesNotExist:
-            # If user does not exist, then it means that CourseEnrollmentAllowed object was created.
-            # So, just get that object and update it with appropriate course_mode.
-            course_enrollment_allowed = CourseEnrollmentAllowed.objects.get(
-                email=email, course_id=course_id
-            )
-            course_enrollment_allowed.mode = mode
-            course_enrollment_allowed.save()
+    if context is None:
+        OrderEnrollmentContext(email, [course_id]).update_modes({course_id: mode})
     else:
-        logger.error(
-            "Invalid course mode:%s found while updating enrollment for email:%s and course:%s"
-            % (mode, email, course_id)
-        )
+        context.defer_mode(course_id, mode)
+
 
+def handle_order_create(data):
+    """Handle an orders/create webhook that has passed all checks.
 
-def get_or_create_course_mode(course_id, mode):
+    Create the customer's user if needed, and record the order. Return
+    the order, or None if the webhook was for a subscription purchase,
+    which needs no further processing.
+
+    The webhook is only marked as processed once the order is recorded,
+    so that it can be processed again if anything before that fails.
     """
-    Check and return the correct course_mode
-    Create one if it does not exist already
+    tags = data.content.get("tags")
+    subscription_purchase = 'subscription'.lower() in tags.lower()
+    if subscription_purchase:
+        finish_and_save(data)
+        return None
+
+    # Extract email from order data
+    email = data.content.get("email")
+    if email:
+        provision_user(email)
+
+    # Record order
+    order, created = record_order(data)
+    if created:
+        logger.info("Created order %s" % order.id)
+    else:
+        logger.info("Retrieved order %s" % order.id)
+
+    finish_and_save(data)
+    return order
+
+
+def handle_order_cancel(data, customer=None):
+    """Handle a subscription cancellation webhook that has passed all
+    checks, and return the resulting cancellation order.
+
+    customer is the customer's email and the SKUs they ordered, if they
+    have already been fetched from Shopify. Like for handle_order_create,
+    the webhook is only marked as processed once the order is recorded.
+    """
+    # Record order
+    order, created = record_cancellation_order(data, customer)
+    if created:
+        logger.info("Created cancellation order %s" % order.id)
+    else:
+        logger.info("Retrieved cancellation order %s" % order.id)
+
+    finish_and_save(data)
+    return order
+
+
+async def ahandle_order_cancel(data):
+    """Async variant of handle_order_cancel.
+
+    The Shopify Admin API requests are made from the event loop, and the
+    rest of the work is done by handle_order_cancel in a thread.
     """
-    course = CourseOverview.objects.get(id=course_id)
-    mode, created = CourseMode.objects.get_or_create(
-        course=course, mode_slug=mode, mode_display_name=mode
+    customer = await aget_shopify_customer_email_and_order_skus(
+        data.content.get("customerId"), get_webhook_shop(data)
     )
-    return mode.mode_slug
+    return await sync_to_async(handle_order_cancel)(data, customer)
 
 
 def record_order(data):
@@ -241,24 +388,13 @@ def record_order(data):
     )
 
 
-def record_cancellation_order(data):
-    customer_id = data.content.get("customerId")
-    email = get_shopify_customer_email_from_customer_id(customer_id)
-    iso_string = str(data.content.get("occurredAt"))
-    dt = datetime.fromisoformat(iso_string.replace("Z", "+00:00"))
-    timestamp = int(dt.timestamp() * 1000)  # Convert to milliseconds
-    data.content["id"] = timestamp
-    data.content["email"] = email
-    data.content["subscription_cancellation"] = True
-    course_ids = get_shopify_customer_order_product_skus(customer_id)
-    data.content["line_items"] = []
-    for idx, course_id in enumerate(course_ids, start=1):
-        line_item = {
-            "id": idx,
-            "sku": course_id,
-            "variant_title": ""
-        }
-        data.content["line_items"].append(line_item)
+def record_cancellation_order(data, customer=None):
+    if customer is None:
+        customer_id = data.content.get("customerId")
+        shop = get_webhook_shop(data)
+        customer = get_shopify_customer_email_and_order_skus(customer_id, shop)
+    email, course_ids = customer
+    _set_cancellation_content(data, email, course_ids)
 
     return Order.objects.get_or_create(
         id=data.content["id"],
@@ -269,6 +405,30 @@ def record_cancellation_order(data):
     )
 
 
+def _set_cancellation_content(data, email, course_ids):
+    """Turn the content of a cancellation webhook into order data.
+
+    The content is replaced rather than updated in place, so that
+    compact rows store it too.
+    """
+    content = dict(data.content)
+    iso_string = str(content.get("occurredAt"))
+    dt = datetime.fromisoformat(iso_string.replace("Z", "+00:00"))
+    timestamp = int(dt.timestamp() * 1000)  # Convert to milliseconds
+    content["id"] = timestamp
+    content["email"] = email
+    content["subscription_cancellation"] = True
+    content["line_items"] = []
+    for idx, course_id in enumerate(course_ids, start=1):
+        line_item = {
+            "id": idx,
+            "sku": course_id,
+            "variant_title": ""
+        }
+        content["line_items"].append(line_item)
+    data.content = content
+
+
 def process_order(order, data, retrying_order=False):
     if order.status == Order.PROCESSED:
         logger.warning("Order %s has already been processed, ignoring" % order.id)
@@ -295,14 +455,20 @@ def process_order(order, data, retrying_order=False):
 
     subscription_cancellation = data.get("subscription_cancellation")
 
-    # Process line items
-    for item in data["line_items"]:
-        # Process the line item. If the enrollment throws
-        # an exception, we throw that exception up the stack so we can
-        # attempt to retry order processing.
-        process_line_item(order, item, subscription_cancellation=subscription_cancellation)
-        logger.debug(
-            "Successfully processed line item %s for order %s" % (item, order.id)
+    # Process line items. If an enrollment throws an exception, we
+    # throw that exception up the stack so we can attempt to retry
+    # order processing.
+    if getattr(settings, "WEBHOOK_RECEIVER_BATCH_ENROLLMENT", False):
+        process_line_items_batched(
+            order, data["line_items"], subscription_cancellation=subscription_cancellation
+        )
+    elif line_item_concurrency() > 1 and len(data["line_items"]) > 1:
+        process_line_items_concurrently(
+            order, data["line_items"], subscription_cancellation=subscription_cancellation
+        )
+    else:
+        process_line_items(
+            order, data["line_items"], subscription_cancellation=subscription_cancellation
         )
 
     # Mark the order status
@@ -320,190 +486,588 @@ def process_order(order, data, retrying_order=False):
     return order
 
 
-def process_line_item(order, item, subscription_cancellation=False):
-    """Process a line item of an order.
+def resolve_line_item(order_item, item, subscription_cancellation=False, context=None):
+    """Enroll (or unenroll) the learner for a started OrderItem, and move
+    it to PROCESSED or ERROR, without saving it.
 
-    Extract sku and properties.email, create an OrderItem, create an
-    enrollment, and mark the OrderItem as processed. Propagate any
-    errors, to be handled up the stack.
+    With the OrderEnrollmentContext of the order, the course mode is
+    deferred, and the item must not be saved before the context's
+    apply_deferred_modes() has been called.
     """
-
     # Fetch relevant fields from the item
     sku = item.get("sku")
     mode = item.get("variant_title")
-    email = order.email
-
-    # Store line item, prop
-    order_item, created = OrderItem.objects.get_or_create(
-        order=order, sku=sku, email=email
-    )
-
-    if order_item.status == OrderItem.PROCESSED:
-        logger.warning(
-            "Order item %s has already been processed, ignoring" % order_item.id
-        )
-        return
-    elif order_item.status == OrderItem.PROCESSING:
-        logger.warning(
-            "Order item %s is already being processed, retrying" % order_item.id
-        )
-    else:
-        order_item.start_processing()
-        with transaction.atomic():
-            order_item.save()
+    email = order_item.email
 
     course_id = lookup_course_id(sku)
 
     if course_id:
         if subscription_cancellation:
-            enroll_in_course(course_id, email, mode, action='unenroll')
+            enroll_in_course(course_id, email, mode, action='unenroll', context=context)
         else:
             # Create an enrollment for the line item. If the enrollment throws
             # an exception, we throw that exception up the stack so we can
             # attempt to retry order processing.
-            enroll_in_course(course_id, email, mode)
+            enroll_in_course(course_id, email, mode, context=context)
 
         # Mark the item as processed
         order_item.finish_processing()
-        with transaction.atomic():
-            order_item.save()
 
     elif not course_id and subscription_cancellation:
         # Mark the item as processed
         order_item.finish_processing()
-        with transaction.atomic():
-            order_item.save()
 
     else:
         # Mark the item as failed
         order_item.fail()
-        with transaction.atomic():
-            order_item.save()
 
-    return order_item
 
+def process_line_items(order, items, subscription_cancellation=False):
+    """Process the line items of an order, one after the other.
+
+    The OrderItems are created and started together, and the final state
+    of every item that was processed is saved together, even if a later
+    item raised an exception. The course modes of the items are applied
+    together beforehand.
+    """
+    started = start_line_items(order, items)
+    context = enrollment_context(order, started, subscription_cancellation)
+    started, skipped = skip_enrolled_line_items(order, started, context)
+    done = []
+    try:
+        for item, order_item in started:
+            resolve_line_item(
+                order_item, item, subscription_cancellation=subscription_cancellation, context=context
+            )
+            done.append(order_item)
+            logger.debug(
+                "Successfully processed line item %s for order %s" % (item, order.id)
+            )
+    finally:
+        save_resolved_line_items(context, skipped, done)
+
+
+def line_item_concurrency():
+    return getattr(settings, "WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY", 1)
 
-def get_shopify_customer_email_from_customer_id(customer_id):
-    access_token = settings.SHOPIFY_ADMIN_API_ACCESS_TOKEN
-    url = settings.SHOPIFY_ADMIN_API_URL
 
-    # GraphQL query
-    query = f"""
-        query {{
-            customer(id: "{customer_id}") {{
-                id
-                email
-            }}
-        }}
+def process_line_items_concurrently(order, items, subscription_cancellation=False):
+    """Process the line items of an order in a pool of up to
+    WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY threads.
+
+    Every line item is given a chance to finish before the first
+    exception raised by any of them is propagated, to be handled up the
+    stack. The states of the items that finished are saved even if this
+    thread is interrupted (e.g. by a soft time limit) while waiting for
+    the others.
     """
+    using = router.db_for_write(OrderItem)
+    if connections[using].in_atomic_block:
+        # Other threads could not see the uncommitted order, so process
+        # the items in this thread.
+        process_line_items(order, items, subscription_cancellation=subscription_cancellation)
+        return
+
+    started = start_line_items(order, items)
+    context = enrollment_context(order, started, subscription_cancellation)
+    started, skipped = skip_enrolled_line_items(order, started, context)
+    if not started:
+        save_line_item_states(skipped)
+        return
+
+    pending = queue.SimpleQueue()
+    for item, order_item in started:
+        pending.put((item, order_item))
+    done = []
+    errors = []
+
+    def worker():
+        try:
+            while True:
+                try:
+                    item, order_item = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    resolve_line_item(
+                        order_item, item, subscription_cancellation=subscription_cancellation, context=context
+                    )
+                except Exception as e:  # pylint: disable=broad-except
+                    errors.append(e)
+                else:
+                    logger.debug(
+                        "Successfully processed line item %s for order %s" % (item, order.id)
+                    )
+                    done.append(order_item)
+        finally:
+            # Each thread has its own database connections.
+            connections.close_all()
+
+    max_workers = min(line_item_concurrency(), len(started))
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in range(max_workers):
+                executor.submit(worker)
+    finally:
+        save_resolved_line_items(context, skipped, list(done))
+
+    if errors:
+        # Re-raise the first exception
+        raise errors[0]
 
-    headers = {
-        'Content-Type': 'application/json',
-        'X-Shopify-Access-Token': access_token
-    }
 
-    payload = {
-        'query': query
+def start_line_items(order, items):
+    """Store all line items of an order, and start processing them.
+
+    This takes one bulk insert and one query to fetch the OrderItems,
+    however many items the order has, and one bulk update to start the
+    new ones. Line items with the same SKU share an OrderItem, and only
+    the first of them is processed. Return a list of (item, OrderItem)
+    pairs to process, leaving out the items already processed.
+    """
+    email = order.email
+    items_by_sku = {}
+    for item in items:
+        items_by_sku.setdefault(item.get("sku") or "", item)
+
+    # Rows that already exist are left alone, thanks to the
+    # unique_shopify_order_sku_email constraint.
+    OrderItem.objects.bulk_create(
+        [OrderItem(order=order, sku=sku, email=email) for sku in items_by_sku],
+        ignore_conflicts=True,
+    )
+    order_items = {
+        order_item.sku: order_item for order_item in
+        OrderItem.objects.filter(order=order, email=email, sku__in=list(items_by_sku))
     }
 
-    response = requests.post(url, headers=headers, json=payload)
+    started = []
+    new_items = []
+    for sku, item in items_by_sku.items():
+        order_item = order_items[sku]
+        # Save a query per item when the transitions log the order ID
+        order_item.order = order
+        if order_item.status == OrderItem.PROCESSED:
+            logger.warning(
+                "Order item %s has already been processed, ignoring" % order_item.id
+            )
+            continue
+        elif order_item.status == OrderItem.PROCESSING:
+            logger.warning(
+                "Order item %s is already being processed, retrying" % order_item.id
+            )
+        else:
+            order_item.start_processing()
+            new_items.append(order_item)
+        started.append((item, order_item))
 
-    if response.status_code == 200:
-        data = response.json()
-        customer_email = data["data"]['customer'].get("email")
-        return customer_email
-    else:
-        logging.error("Error while getting customer email from shopify admin API.")
-        logging.error("{response.status_code}: response.text")
-
-
-def get_shopify_customer_order_product_skus(customer_id):
-    access_token = settings.SHOPIFY_ADMIN_API_ACCESS_TOKEN
-    url = settings.SHOPIFY_ADMIN_API_URL
-
-    # GraphQL query with customerId as a variable
-    query = """
-    query getOrders($customerId: ID!, $cursor: String) {
-        customer(id: $customerId) {
-            orders(first: 250, after: $cursor) {
-                edges {
-                    node {
-                        id
-                        createdAt
-                        lineItems(first: 250) {
-                            edges {
-                                node {
-                                    title
-                                    quantity
-                                    variant {
-                                        sku
-                                    }
+    _bulk_transition(new_items, OrderItem.NEW)
+    return started
+
+
+def enrollment_context(order, started, subscription_cancellation=False):
+    """Return the OrderEnrollmentContext of an order, for the courses of
+    its started (item, OrderItem) pairs.
+
+    Return None if there are none, or for a cancellation, which only
+    unenrolls.
+    """
+    if subscription_cancellation or not started:
+        return None
+    return OrderEnrollmentContext(
+        order.email, [item.get("sku") for item, order_item in started if item.get("sku")]
+    )
+
+
+def skip_enrolled_line_items(order, started, context):
+    """Leave out the line items the learner is already enrolled for.
+
+    Orders are resent by Shopify, replayed by process_failed_orders, and
+    bought again, so their learner is often enrolled already. Compare
+    the (course, mode) pair of each started item with the learner's
+    active enrollments, as loaded by the order's OrderEnrollmentContext,
+    and finish the items that need nothing done, without saving them.
+
+    Return the list of (item, OrderItem) pairs still to process, and
+    the list of skipped OrderItems. Without a context, as for a
+    cancellation, nothing is skipped.
+    """
+    if context is None:
+        return started, []
+
+    remaining = []
+    skipped = []
+    for item, order_item in started:
+        if context.is_enrolled(item.get("sku"), item.get("variant_title")):
+            logger.info(
+                "%s is already enrolled in %s, skipping order item %s"
+                % (order.email, item.get("sku"), order_item.id)
+            )
+            order_item.finish_processing()
+            skipped.append(order_item)
+        else:
+            remaining.append((item, order_item))
+
+    if skipped:
+        metrics.increment("enrollment.skipped", len(skipped))
+    return remaining, skipped
+
+
+def save_line_item_states(order_items):
+    """Save the final state of processed OrderItems, with one query."""
+    _bulk_transition(order_items, OrderItem.PROCESSING)
+
+
+def save_resolved_line_items(context, skipped, done):
+    """Apply the course modes deferred while resolving the done
+    OrderItems, and save the final state of those and of the skipped
+    ones.
+
+    If the modes cannot be applied, the done items are left in
+    PROCESSING, to be processed again.
+    """
+    resolved = list(skipped)
+    try:
+        if context is not None:
+            context.apply_deferred_modes()
+        resolved.extend(done)
+    finally:
+        save_line_item_states(resolved)
+
+
+def _bulk_transition(order_items, source):
+    """Save the new status of order_items, which must all have been in
+    the source status.
+
+    Like ConcurrentTransitionMixin does for a single save(), raise
+    ConcurrentTransition and roll back if any of them was moved out of
+    that status concurrently. This takes one UPDATE per target status.
+    """
+    if not order_items:
+        return
+
+    ids_by_status = {}
+    for order_item in order_items:
+        ids_by_status.setdefault(order_item.status, []).append(order_item.pk)
+
+    with transaction.atomic():
+        # bulk_update() only returns the number of rows it matched from
+        # Django 4.0 on, so count them with plain updates.
+        updated = sum(
+            OrderItem.objects.filter(pk__in=ids, status=source).update(status=status)
+            for status, ids in ids_by_status.items()
+        )
+        if updated != len(order_items):
+            raise ConcurrentTransition(
+                "Cannot save %s order items: %s of them changed state concurrently"
+                % (len(order_items), len(order_items) - updated)
+            )
+
+    for order_item in order_items:
+        # update() does not call save(), so bring the FSM concurrency
+        # check up to date ourselves.
+        order_item._update_initial_state()
+
+
+def process_line_items_batched(order, items, subscription_cancellation=False):
+    """Process the line items of an order, with as few bulk enrollment
+    API requests as possible.
+
+    Each OrderItem is still marked PROCESSED or ERROR on its own,
+    according to the API's result for its course. HTTP errors are
+    propagated, to be handled up the stack.
+    """
+    email = order.email
+    action = 'unenroll' if subscription_cancellation else 'enroll'
+
+    started = start_line_items(order, items)
+    context = enrollment_context(order, started, subscription_cancellation)
+    started, resolved = skip_enrolled_line_items(order, started, context)
+    enrollments = []
+    for item, order_item in started:
+        course_id = lookup_course_id(item.get("sku"))
+        if course_id:
+            enrollments.append((order_item, course_id, item.get("variant_title")))
+            continue
+        elif subscription_cancellation:
+            order_item.finish_processing()
+        else:
+            order_item.fail()
+        resolved.append(order_item)
+
+    try:
+        if enrollments:
+            results = enroll_in_courses(
+                [(course_id, email) for order_item, course_id, mode in enrollments],
+                action=action,
+            )
+            for order_item, course_id, mode in enrollments:
+                if mode and results.get((course_id, email)):
+                    update_course_mode_for_enrollment(email, course_id, mode, context=context)
+            if context is not None:
+                context.apply_deferred_modes()
+
+            for order_item, course_id, mode in enrollments:
+                if results.get((course_id, email)):
+                    order_item.finish_processing()
+                else:
+                    logger.error(
+                        "Failed to %s %s in course %s for order %s"
+                        % (action, email, course_id, order.id)
+                    )
+                    order_item.fail()
+                resolved.append(order_item)
+    finally:
+        save_line_item_states(resolved)
+
+
+# Page sizes keep the requested cost of a query (about orders times line
+# items) under Shopify's limit of 1000 for a single query. The rare order
+# with more line items than fit in a page of orders has the rest fetched
+# by larger pages of its own.
+ORDERS_PAGE_SIZE = 25
+LINE_ITEMS_PAGE_SIZE = 25
+ORDER_LINE_ITEMS_PAGE_SIZE = 250
+
+# The customer's email, and a page of the SKUs they bought. Only the
+# fields we use are requested, to keep the query cost down.
+CUSTOMER_ORDERS_QUERY = """
+query getCustomerOrderSkus($customerId: ID!, $cursor: String) {
+    customer(id: $customerId) {
+        email
+        orders(first: %(orders)s, after: $cursor) {
+            edges {
+                node {
+                    id
+                    lineItems(first: %(line_items)s) {
+                        edges {
+                            node {
+                                variant {
+                                    sku
                                 }
                             }
                         }
+                        pageInfo {
+                            hasNextPage
+                            endCursor
+                        }
                     }
                 }
-                pageInfo {
-                    hasNextPage
-                    endCursor
+            }
+            pageInfo {
+                hasNextPage
+                endCursor
+            }
+        }
+    }
+}
+""" % {"orders": ORDERS_PAGE_SIZE, "line_items": LINE_ITEMS_PAGE_SIZE}
+
+# The SKUs of the line items of an order after the first page.
+ORDER_LINE_ITEMS_QUERY = """
+query getOrderLineItemSkus($orderId: ID!, $cursor: String) {
+    order(id: $orderId) {
+        lineItems(first: %(line_items)s, after: $cursor) {
+            edges {
+                node {
+                    variant {
+                        sku
+                    }
                 }
             }
+            pageInfo {
+                hasNextPage
+                endCursor
+            }
         }
     }
+}
+""" % {"line_items": ORDER_LINE_ITEMS_PAGE_SIZE}
+
+
+def get_webhook_shop(data):
+    """Return the shop a webhook was received from.
+
+    Fall back to the default shop if the webhook has no known
+    X-Shopify-Shop-Domain header.
     """
+    registry = get_registry()
+    shop_domain = (data.headers or {}).get("X-Shopify-Shop-Domain")
+    return registry.get(shop_domain) or registry.default
 
-    headers = {
-        'Content-Type': 'application/json',
-        'X-Shopify-Access-Token': access_token
+
+def _customer_orders_payload(customer_id, cursor):
+    return {
+        'query': CUSTOMER_ORDERS_QUERY,
+        'variables': {
+            'customerId': customer_id,
+            'cursor': cursor
+        }
     }
 
-    skus = set()
-    cursor = None
-
-    while True:
-        payload = {
-            'query': query,
-            'variables': {
-                'customerId': customer_id,
-                'cursor': cursor
-            }
+
+def _order_line_items_payload(order_id, cursor):
+    return {
+        'query': ORDER_LINE_ITEMS_QUERY,
+        'variables': {
+            'orderId': order_id,
+            'cursor': cursor
         }
+    }
 
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
-        if response.status_code == 200:
-            try:
-                data = response.json()
-
-                orders = data['data']['customer']['orders']['edges']
-
-                # Extract SKUs and email from the order line items
-                for order in orders:
-                    # Safely get 'node' from the order, ensuring it is not None
-                    node = order.get('node')
-                    if node:
-                        line_items = node.get('lineItems', {}).get('edges', [])
-                        for item in line_items:
-                            # Safely get 'variant' from item, ensuring it is not None
-                            variant = item.get('node', {}).get('variant')
-                            if variant:
-                                sku = variant.get('sku')
-                                if sku:
-                                    skus.add(sku)
-
-                # Check if there are more orders to fetch
-                page_info = data['data']['customer']['orders']['pageInfo']
-                if page_info['hasNextPage']:
-                    cursor = page_info['endCursor']  # Update cursor for next page
-                else:
-                    break  # No more pages, exit the loop
 
-            except Exception as e:
-                logging.error(f"Error while parsing response: {e}")
-                logging.error(f"Response content: {response.text}")
-                break
-        else:
-            logging.error("Error while getting customer orders from Shopify admin API.")
-            logging.error(f"{response.status_code}: {response.text}")
-            break
+def _response_data(response):
+    """Return the data of a GraphQL response.
+
+    Raise AdminAPIError if the request failed, rather than go on with
+    the SKUs of the pages before it.
+    """
+    if response.status_code != 200:
+        raise AdminAPIError(
+            "Error while getting customer orders from Shopify admin API: %s: %s"
+            % (response.status_code, response.text)
+        )
+    try:
+        data = response.json()
+    except ValueError as e:
+        raise AdminAPIError("Error while parsing response: %s: %s" % (e, response.text)) from e
+    if data.get('errors'):
+        raise AdminAPIError(
+            "Error while getting customer orders from Shopify admin API: %s" % data['errors']
+        )
+    return data
+
+
+def _collect_line_item_skus(line_items, skus):
+    """Add the SKUs of a page of line items to skus.
+
+    Return the cursor of the next page, or None if this was the last
+    page.
+    """
+    for item in line_items.get('edges', []):
+        # Safely get 'variant' from item, ensuring it is not None
+        variant = item.get('node', {}).get('variant')
+        if variant:
+            sku = variant.get('sku')
+            if sku:
+                skus.add(sku)
+    page_info = line_items.get('pageInfo', {})
+    if page_info.get('hasNextPage'):
+        return page_info['endCursor']
+    return None
+
+
+def _collect_order_skus(data, skus, more_line_items):
+    """Add the SKUs of a page of customer orders to skus, and the
+    (order ID, cursor) of orders with more line items to
+    more_line_items.
+
+    Return the cursor of the next page, or None if this was the last
+    page.
+    """
+    orders = data['data']['customer']['orders']['edges']
+
+    # Extract SKUs and email from the order line items
+    for order in orders:
+        # Safely get 'node' from the order, ensuring it is not None
+        node = order.get('node')
+        if node:
+            cursor = _collect_line_item_skus(node.get('lineItems', {}), skus)
+            if cursor is not None:
+                more_line_items.append((node['id'], cursor))
+
+    # Check if there are more orders to fetch
+    page_info = data['data']['customer']['orders']['pageInfo']
+    if page_info['hasNextPage']:
+        return page_info['endCursor']
+    return None
+
+
+def _handle_customer_orders_page(response, skus, more_line_items):
+    """Collect the SKUs of a page of customer orders.
+
+    Return the customer's email and the cursor of the next page. Raise
+    AdminAPIError if the page could not be read.
+    """
+    data = _response_data(response)
+    try:
+        email = data['data']['customer'].get('email')
+        return email, _collect_order_skus(data, skus, more_line_items)
+    except (AttributeError, KeyError, TypeError) as e:
+        raise AdminAPIError("Unexpected response: %r: %s" % (e, response.text)) from e
+
+
+def _handle_order_line_items_page(response, skus):
+    """Collect the SKUs of a page of the line items of an order.
+
+    Return the cursor of the next page. Raise AdminAPIError if the page
+    could not be read.
+    """
+    data = _response_data(response)
+    try:
+        return _collect_line_item_skus(data['data']['order']['lineItems'], skus)
+    except (AttributeError, KeyError, TypeError) as e:
+        raise AdminAPIError("Unexpected response: %r: %s" % (e, response.text)) from e
+
+
+def get_shopify_customer_email_and_order_skus(customer_id, shop=None):
+    """Return the email of a Shopify customer, and the SKUs of all the
+    products they ordered.
+
+    The first page of orders comes with the email, in the same request.
+    Further pages, of orders or of the line items of an order, are only
+    requested if there are more of them.
+    """
+    shop = shop or get_registry().default
+    client = get_admin_client(shop)
+
+    skus = set()
+    more_line_items = []
+    email, cursor = _handle_customer_orders_page(
+        client.post(_customer_orders_payload(customer_id, None)), skus, more_line_items
+    )
+    while cursor is not None:
+        _, cursor = _handle_customer_orders_page(
+            client.post(_customer_orders_payload(customer_id, cursor)), skus, more_line_items
+        )
+    for order_id, cursor in more_line_items:
+        while cursor is not None:
+            cursor = _handle_order_line_items_page(
+                client.post(_order_line_items_payload(order_id, cursor)), skus
+            )
+
+    return email, list(skus)
+
+
+async def aget_shopify_customer_email_and_order_skus(customer_id, shop=None, client=None):
+    """Async variant of get_shopify_customer_email_and_order_skus.
+
+    Uses httpx if it is installed, with the shop's shared async client
+    unless an httpx.AsyncClient is given, and otherwise runs the sync
+    variant in a thread.
+    """
+    shop = shop or get_registry().default
+    if httpx is None:
+        return await sync_to_async(get_shopify_customer_email_and_order_skus)(customer_id, shop)
+
+    if client is None:
+        admin_client = get_async_admin_client(shop)
+    else:
+        admin_client = AsyncAdminClient(shop, client)
+
+    skus = set()
+    more_line_items = []
+    email, cursor = _handle_customer_orders_page(
+        await admin_client.post(_customer_orders_payload(customer_id, None)), skus, more_line_items
+    )
+    while cursor is not None:
+        _, cursor = _handle_customer_orders_page(
+            await admin_client.post(_customer_orders_payload(customer_id, cursor)), skus, more_line_items
+        )
+    for order_id, cursor in more_line_items:
+        while cursor is not None:
+            cursor = _handle_order_line_items_page(
+                await admin_client.post(_order_line_items_payload(order_id, cursor)), skus
+            )
 
-    return list(skus)
+    return email, list(skus)
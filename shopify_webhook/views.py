@@ -1,59 +1,160 @@
 from __future__ import unicode_literals
 
 import logging
+from functools import wraps
 
-from django.conf import settings
-from django.http import HttpResponse
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, HttpResponseNotAllowed
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
-from django.contrib.auth.models import User
+from asgiref.sync import sync_to_async
 
-from .utils import receive_json_webhook, hmac_is_valid
-from .utils import fail_and_save, finish_and_save
+from .utils import receive_json_webhook, receive_raw_webhook
+from .utils import fail_and_save, fast_ack_enabled
 
-from .utils import record_order, record_cancellation_order
-from .models import Order
-from .tasks import process
+from .utils import handle_order_create, handle_order_cancel, ahandle_order_cancel
+from .models import JSONWebhookData
+from .registry import get_registry
+from .dedupe import get_webhook_id, is_duplicate_delivery, remember_delivery
+from .tasks import process_webhook, schedule_order
+from . import metrics
 
 
 logger = logging.getLogger(__name__)
 
+
+def verify_request(request):
+    """Verify the shop domain and HMAC signature of a webhook request.
+
+    This only looks at the request headers and body, and never touches
+    the database. Return None if the request is valid, or a tuple of
+    (HTTP status, rejection reason) otherwise. For valid requests, the
+    shop is set as request.shop.
+    """
+    try:
+        shop_domain = request.headers["X-Shopify-Shop-Domain"]
+    except KeyError:
+        logger.error("Request is missing X-Shopify-Shop-Domain header")
+        return 400, "missing_shop_domain"
+
+    shop = get_registry().get(shop_domain)
+    if shop is None:
+        logger.error("Unknown shop domain %s" % shop_domain)
+        return 403, "unknown_shop_domain"
+
+    try:
+        hmac = request.headers["X-Shopify-Hmac-Sha256"]
+    except KeyError:
+        logger.error("Request is missing X-Shopify-Hmac-Sha256 header")
+        return 400, "missing_hmac"
+
+    if not shop.hmac_is_valid(request.body, hmac):
+        logger.error("Failed to verify HMAC signature")
+        return 403, "invalid_hmac"
+
+    request.shop = shop
+    return None
+
+
 def checks(func):
+    @wraps(func)
     def inner(request):
-        # Load configuration
-        conf = settings.WEBHOOK_RECEIVER_SETTINGS["shopify"]
+        # Reject forged or misrouted requests before anything is
+        # written to the database. Rejections are only counted.
+        rejection = verify_request(request)
+        if rejection:
+            status, reason = rejection
+            metrics.increment("webhook.rejected")
+            metrics.increment("webhook.rejected.%s" % reason)
+            return HttpResponse(status=status)
+
+        # Answer repeated deliveries of a webhook that was, or is being,
+        # processed right away.
+        webhook_id = get_webhook_id(request)
+        if is_duplicate_delivery(webhook_id):
+            logger.info("Ignoring repeated delivery of webhook %s" % webhook_id)
+            return HttpResponse(status=200)
 
         try:
-            data = receive_json_webhook(request)
+            if fast_ack_enabled():
+                data = receive_raw_webhook(request)
+            else:
+                data = receive_json_webhook(request)
             request.data = data
+        except IntegrityError:
+            # A concurrent delivery of the same webhook, possibly on
+            # another web node, was stored first.
+            metrics.increment("webhook.duplicate")
+            logger.info("Ignoring repeated delivery of webhook %s" % webhook_id)
+            return HttpResponse(status=200)
         except Exception:
             return HttpResponse(status=400)
 
         try:
-            shop_domain = request.headers["X-Shopify-Shop-Domain"]
-        except KeyError:
-            logger.error("Request is missing X-Shopify-Shop-Domain header")
-            fail_and_save(data)
-            return HttpResponse(status=400)
+            response = func(request)
+        except Exception:
+            abandon_webhook(data)
+            raise
+        if data.status == JSONWebhookData.PROCESSED:
+            remember_delivery(webhook_id)
+        return response
+    return inner
+
+
+def abandon_webhook(data):
+    """Mark a webhook whose processing raised an exception as failed, so
+    that Shopify's retry of its delivery is processed again.
+    """
+    if data.status == JSONWebhookData.PROCESSING:
+        fail_and_save(data)
+
+
+def async_checks(func):
+    """Async counterpart of checks, for the async views.
 
-        if not ((conf.get("shop_domains") and shop_domain in conf["shop_domains"]) or (
-            conf.get("shop_domain") and shop_domain == conf["shop_domain"])):
-            logger.error("Unknown shop domain %s" % shop_domain)
-            fail_and_save(data)
-            return HttpResponse(status=403)
+    Django's csrf_exempt and require_POST decorators only support
+    async views from Django 5.0 on, so this decorator also takes care
+    of the request method and of CSRF exemption.
+    """
+    @wraps(func)
+    async def inner(request):
+        if request.method != "POST":
+            return HttpResponseNotAllowed(["POST"])
+
+        rejection = verify_request(request)
+        if rejection:
+            status, reason = rejection
+            metrics.increment("webhook.rejected")
+            metrics.increment("webhook.rejected.%s" % reason)
+            return HttpResponse(status=status)
+
+        webhook_id = get_webhook_id(request)
+        if await sync_to_async(is_duplicate_delivery)(webhook_id):
+            logger.info("Ignoring repeated delivery of webhook %s" % webhook_id)
+            return HttpResponse(status=200)
 
         try:
-            hmac = request.headers["X-Shopify-Hmac-Sha256"]
-        except KeyError:
-            logger.error("Request is missing X-Shopify-Hmac-Sha256 header")
-            fail_and_save(data)
+            if fast_ack_enabled():
+                data = await sync_to_async(receive_raw_webhook)(request)
+            else:
+                data = await sync_to_async(receive_json_webhook)(request)
+            request.data = data
+        except IntegrityError:
+            metrics.increment("webhook.duplicate")
+            logger.info("Ignoring repeated delivery of webhook %s" % webhook_id)
+            return HttpResponse(status=200)
+        except Exception:
             return HttpResponse(status=400)
 
-        if not hmac_is_valid(conf["api_key"], request.body, hmac):
-            logger.error("Failed to verify HMAC signature")
-            fail_and_save(data)
-            return HttpResponse(status=403)
-        return func(request)
+        try:
+            response = await func(request)
+        except Exception:
+            await sync_to_async(abandon_webhook)(data)
+            raise
+        if data.status == JSONWebhookData.PROCESSED:
+            await sync_to_async(remember_delivery)(webhook_id)
+        return response
+    inner.csrf_exempt = True
     return inner
 
 
@@ -62,79 +163,60 @@ def checks(func):
 @checks
 def order_create(request):
     data = request.data
-    tags = data.content.get("tags")
-    subscription_purchase = 'subscription'.lower() in tags.lower()
-    if subscription_purchase:
-        finish_and_save(data)
+    if fast_ack_enabled():
+        # Don't let the worker look for the webhook before it is
+        # committed.
+        transaction.on_commit(lambda: process_webhook.delay(data.id))
         return HttpResponse(status=200)
 
-    finish_and_save(data)
+    order = handle_order_create(data)
+    if order:
+        schedule_order(order, data.content)
 
-    # Extract email from order data
-    email = data.content.get("email")
-    if email:
-        username = email.split("@")[0]  # Generate username from email
-        default_password = "passunibooks"  # Set a default password
+    return HttpResponse(status=200)
 
-        # Check if user exists, if not, create one
-        base_username = username
-        counter = 1
-        while User.objects.filter(username=username).exists():
-            username = f"{base_username}_{counter}"
-            counter += 1
 
-        user, created = User.objects.get_or_create(
-            email=email,
-            defaults={"username": username}
-        )
+@csrf_exempt
+@require_POST
+@checks
+def order_cancel(request):
+    data = request.data
+    if fast_ack_enabled():
+        transaction.on_commit(lambda: process_webhook.delay(data.id, cancellation=True))
+        return HttpResponse(status=200)
 
-        if created:
-            user.set_password(default_password)  # Hash the password before saving
-            user.save()
+    order = handle_order_cancel(data)
+    schedule_order(order, data.content)
 
-            # Create a UserProfile for the user
-            from common.djangoapps.student.models import UserProfile  # Updated import path
-            UserProfile.objects.create(user=user, name=username)
+    return HttpResponse(status=200)
 
-            logger.info(f"Created user {username} with email {email} and profile")
-        else:
-            logger.info(f"User with email {email} already exists. No new user created.")
 
-    # Record order
-    order, created = record_order(data)
-    if created:
-        logger.info("Created order %s" % order.id)
-    else:
-        logger.info("Retrieved order %s" % order.id)
+@async_checks
+async def order_create_async(request):
+    """Async variant of order_create, for ASGI deployments."""
+    data = request.data
+    if fast_ack_enabled():
+        await sync_to_async(transaction.on_commit)(lambda: process_webhook.delay(data.id))
+        return HttpResponse(status=200)
 
-    # Process order
-    if order.status == Order.NEW:
-        logger.info("Scheduling order %s for processing" % order.id)
-        process.delay(data.content)
-    else:
-        logger.info("Order %s already processed, nothing to do" % order.id)
+    order = await sync_to_async(handle_order_create)(data)
+    if order:
+        await sync_to_async(schedule_order)(order, data.content)
 
     return HttpResponse(status=200)
 
 
-@csrf_exempt
-@require_POST
-@checks
-def order_cancel(request):
+@async_checks
+async def order_cancel_async(request):
+    """Async variant of order_cancel, for ASGI deployments."""
     data = request.data
-    finish_and_save(data)
-
-    # Record order
-    order, created = record_cancellation_order(data)
-    if created:
-        logger.info("Created cancellation order %s" % order.id)
-    else:
-        logger.info("Retrieved cancellation order %s" % order.id)
-    # Process order
-    if order.status == Order.NEW:
-        logger.info("Scheduling cancellation order %s for processing" % order.id)
-        process.delay(data.content)
-    else:
-        logger.info("Cancellation order %s already processed, nothing to do" % order.id)
+    if fast_ack_enabled():
+        await sync_to_async(transaction.on_commit)(
+            lambda: process_webhook.delay(data.id, cancellation=True)
+        )
+        return HttpResponse(status=200)
+
+    order = await ahandle_order_cancel(data)
+    await sync_to_async(schedule_order)(order, data.content)
 
     return HttpResponse(status=200)
@@ -0,0 +1,114 @@
+"""
+Fixtures shared by the `shopify_webhook` tests.
+"""
+import sys
+import types
+from unittest import mock
+
+import pytest
+
+from shopify_webhook import courses
+
+
+class InvalidKeyError(Exception):
+    pass
+
+
+class CourseKey:
+    """Stand in for opaque_keys.edx.keys.CourseKey, with course keys as
+    plain strings.
+    """
+
+    @staticmethod
+    def from_string(course_id):
+        if not course_id or not course_id.startswith("course-v1:"):
+            raise InvalidKeyError(course_id)
+        return course_id
+
+
+class FakeLMS:
+    """The enrollments and enrollment allowances of an LMS, in memory,
+    with the model managers and functions that OrderEnrollmentContext
+    uses.
+
+    Every model query is counted in queries; update_enrollment() calls,
+    which the LMS API makes one by one, are not.
+    """
+
+    def __init__(self):
+        self.enrollments = []
+        self.allowed = []
+        self.queries = 0
+        self.CourseEnrollment = type("CourseEnrollment", (), {"objects": mock.Mock()})
+        self.CourseEnrollment.objects.filter.side_effect = self._filter_enrollments
+        self.CourseEnrollmentAllowed = type("CourseEnrollmentAllowed", (), {
+            "objects": mock.Mock(),
+            "DoesNotExist": type("DoesNotExist", (Exception,), {}),
+        })
+        self.CourseEnrollmentAllowed.objects.filter.side_effect = self._filter_allowed
+        self.CourseEnrollmentAllowed.objects.bulk_update.side_effect = self._count
+        self.CourseMode = type("CourseMode", (), {"ALL_MODES": ["audit", "verified", "professional"]})
+        self.update_enrollment = mock.Mock(side_effect=self._update_enrollment)
+
+    def _count(self, *args, **kwargs):
+        self.queries += 1
+
+    def _filter_enrollments(self, user, course_id__in):
+        self.queries += 1
+        return [e for e in self.enrollments if e.user == user and e.course_id in course_id__in]
+
+    def _filter_allowed(self, email, course_id__in):
+        self.queries += 1
+        return [a for a in self.allowed if a.email == email and a.course_id in course_id__in]
+
+    def _update_enrollment(self, username, course_id, mode):
+        for enrollment in self.enrollments:
+            if enrollment.user.username == username and enrollment.course_id == course_id:
+                enrollment.mode = mode
+
+    def enroll(self, user, course_id, mode="audit", is_active=True):
+        """Add an enrollment of user in course_id."""
+        self.enrollments.append(
+            types.SimpleNamespace(user=user, course_id=course_id, mode=mode, is_active=is_active)
+        )
+
+    def allow(self, email, course_id, mode="audit"):
+        """Add an enrollment allowance of email in course_id."""
+        self.allowed.append(types.SimpleNamespace(email=email, course_id=course_id, mode=mode))
+
+    def modules(self):
+        def module(name, **attributes):
+            result = types.ModuleType(name)
+            result.__dict__.update(attributes)
+            return result
+
+        return {
+            "common.djangoapps.course_modes.models": module(
+                "common.djangoapps.course_modes.models", CourseMode=self.CourseMode
+            ),
+            "common.djangoapps.student.models": module(
+                "common.djangoapps.student.models", CourseEnrollment=self.CourseEnrollment
+            ),
+            "common.djangoapps.student.models.course_enrollment": module(
+                "common.djangoapps.student.models.course_enrollment",
+                CourseEnrollmentAllowed=self.CourseEnrollmentAllowed,
+            ),
+            "opaque_keys": module("opaque_keys", InvalidKeyError=InvalidKeyError),
+            "opaque_keys.edx.keys": module("opaque_keys.edx.keys", CourseKey=CourseKey),
+            "openedx.core.djangoapps.enrollments.api": module(
+                "openedx.core.djangoapps.enrollments.api", update_enrollment=self.update_enrollment
+            ),
+        }
+
+
+@pytest.fixture
+def fake_lms():
+    """Stand in for the LMS enrollment models, with every course mode
+    known to exist.
+    """
+    lms = FakeLMS()
+    courses._valid_modes.cache_clear()
+    with mock.patch.dict(sys.modules, lms.modules()), \
+            mock.patch("shopify_webhook.enrollment.get_or_create_course_mode", side_effect=lambda course_id, mode: mode):
+        yield lms
+    courses._valid_modes.cache_clear()
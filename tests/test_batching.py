@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` batching module.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+from django.db import IntegrityError, connections
+
+from shopify_webhook.batching import GroupCommitBuffer
+from shopify_webhook.models import JSONWebhookData
+
+
+def webhook(webhook_id):
+    return JSONWebhookData(headers={}, body=b"{}", webhook_id=webhook_id)
+
+
+@pytest.fixture
+def inserts():
+    """Record the size of every batch inserted."""
+    sizes = []
+    insert = GroupCommitBuffer._insert
+
+    def record(self, instances, using):
+        sizes.append(len(instances))
+        return insert(self, instances, using)
+
+    with mock.patch.object(GroupCommitBuffer, "_insert", record):
+        yield sizes
+
+
+def submit_all(buffer, instances):
+    """Submit instances from a thread each, and return their results or
+    exceptions, in order.
+    """
+    def submit(instance):
+        try:
+            return buffer.submit(instance)
+        except Exception as e:  # pylint: disable=broad-except
+            return e
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=len(instances)) as executor:
+        return list(executor.map(submit, instances))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_batch(inserts):
+    # A long wait, cut short once the batch is full
+    buffer = GroupCommitBuffer(JSONWebhookData, max_batch_size=3, max_wait=10)
+    instances = [webhook(str(i)) for i in range(3)]
+
+    start = time.monotonic()
+    results = submit_all(buffer, instances)
+
+    assert time.monotonic() - start < 5
+    assert results == instances
+    # One leader inserted the batch on behalf of the others
+    assert inserts == [3]
+    assert all(instance.id for instance in instances)
+    assert JSONWebhookData.objects.count() == 3
+
+
+@pytest.mark.django_db(transaction=True)
+def test_max_batch_size(inserts):
+    buffer = GroupCommitBuffer(JSONWebhookData, max_batch_size=2, max_wait=0.5)
+    submit_all(buffer, [webhook(str(i)) for i in range(5)])
+
+    assert sum(inserts) == 5
+    assert max(inserts) <= 2
+    assert JSONWebhookData.objects.count() == 5
+
+
+@pytest.mark.django_db(transaction=True)
+def test_max_wait(inserts):
+    buffer = GroupCommitBuffer(JSONWebhookData, max_batch_size=50, max_wait=0.05)
+    instance = webhook("1")
+
+    start = time.monotonic()
+    assert buffer.submit(instance) is instance
+
+    # The leader gave up waiting for followers
+    assert 0.05 <= time.monotonic() - start < 5
+    assert inserts == [1]
+    assert JSONWebhookData.objects.get().id == instance.id
+
+
+@pytest.mark.django_db(transaction=True)
+def test_integrity_error_fallback():
+    buffer = GroupCommitBuffer(JSONWebhookData, max_batch_size=3, max_wait=10)
+    instances = [webhook("1"), webhook("2"), webhook("1")]
+
+    results = submit_all(buffer, instances)
+
+    # Only the repeated delivery fails
+    assert [isinstance(result, IntegrityError) for result in results].count(True) == 1
+    assert sorted(JSONWebhookData.objects.values_list("webhook_id", flat=True)) == ["1", "2"]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_leader_exception():
+    buffer = GroupCommitBuffer(JSONWebhookData, max_batch_size=3, max_wait=10)
+    error = RuntimeError("database unavailable")
+    with mock.patch.object(buffer, "_insert", side_effect=error):
+        results = submit_all(buffer, [webhook(str(i)) for i in range(3)])
+
+    # Every waiting request gets the exception
+    assert results == [error, error, error]
+    assert not JSONWebhookData.objects.exists()
+
+
+@pytest.mark.django_db
+def test_in_transaction(inserts):
+    buffer = GroupCommitBuffer(JSONWebhookData, max_batch_size=3, max_wait=10)
+    instance = webhook("1")
+    # The test's transaction would hold up the whole batch
+    assert buffer.submit(instance) is instance
+    assert inserts == []
+    assert JSONWebhookData.objects.get().id == instance.id
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` codec module.
+"""
+import json
+
+import pytest
+
+from shopify_webhook import codec
+from shopify_webhook.models import JSONWebhookData
+
+ORDER = {
+    "id": 820982911946154508,
+    "email": "jöns@example.com",
+    "total_price": "199.00",
+    "tags": "",
+    "line_items": [{"sku": "course-v1:org+course+run", "quantity": 1, "properties": []}],
+    "customer": None,
+}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def json_codec(request, monkeypatch):
+    if request.param == "orjson":
+        if codec.orjson is None:
+            pytest.skip("orjson is not installed")
+    else:
+        monkeypatch.setattr(codec, "orjson", None)
+    return request.param
+
+
+def test_round_trip(json_codec):
+    encoded = codec.dumps(ORDER)
+    assert isinstance(encoded, str)
+    assert json.loads(encoded) == ORDER
+    assert codec.loads(encoded) == ORDER
+
+
+@pytest.mark.parametrize("wrap", [bytes, bytearray, memoryview])
+def test_loads_binary(json_codec, wrap):
+    assert codec.loads(wrap(json.dumps(ORDER).encode("utf-8"))) == ORDER
+
+
+def test_loads_invalid(json_codec):
+    with pytest.raises(ValueError):
+        codec.loads(b"{")
+
+
+def test_dumps_big_integer(json_codec):
+    # Beyond what orjson can encode, so json takes over
+    assert codec.loads(codec.dumps({"id": 2 ** 70})) == {"id": 2 ** 70}
+
+
+@pytest.mark.django_db
+def test_json_field_round_trip(json_codec):
+    data = JSONWebhookData(headers={"X-Shopify-Topic": "orders/create"}, body=b"")
+    data.content = ORDER
+    data.save()
+
+    stored = JSONWebhookData.objects.get(id=data.id)
+    assert stored.content == ORDER
+    assert stored.headers == {"X-Shopify-Topic": "orders/create"}
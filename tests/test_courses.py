@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` courses module.
+"""
+import importlib
+import sys
+import types
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal
+from django.test import override_settings
+
+from shopify_webhook import courses
+from shopify_webhook.courses import CourseExistenceCache, CourseModeCache, is_valid_mode
+
+COURSE_ID = "course-v1:org+course+run"
+
+
+def test_course_exists_cached():
+    cache = CourseExistenceCache()
+    with mock.patch("shopify_webhook.courses._course_exists", return_value=False) as lookup:
+        assert not cache.exists(COURSE_ID)
+        assert not cache.exists(COURSE_ID)
+        cache.invalidate(COURSE_ID)
+        assert not cache.exists(COURSE_ID)
+    assert lookup.call_count == 2
+
+
+def test_course_lookup_error_not_cached():
+    cache = CourseExistenceCache()
+    with mock.patch("shopify_webhook.courses._course_exists", side_effect=ConnectionError):
+        with pytest.raises(ConnectionError):
+            cache.exists(COURSE_ID)
+    with mock.patch("shopify_webhook.courses._course_exists", return_value=True) as lookup:
+        assert cache.exists(COURSE_ID)
+    lookup.assert_called_once_with(COURSE_ID)
+
+
+@override_settings(WEBHOOK_RECEIVER_COURSE_CACHE="default")
+def test_course_exists_shared():
+    cache.clear()
+    lms, cms = CourseExistenceCache(), CourseExistenceCache()
+    with mock.patch("shopify_webhook.courses._course_exists", return_value=True) as lookup:
+        assert lms.exists(COURSE_ID)
+        assert cms.exists(COURSE_ID)
+        lookup.assert_called_once()
+
+        # The course is deleted in another process
+        lookup.return_value = False
+        cms.invalidate(COURSE_ID)
+        assert not lms.exists(COURSE_ID)
+    assert lookup.call_count == 2
+
+
+def module(name, **attributes):
+    result = types.ModuleType(name)
+    result.__dict__.update(attributes)
+    return result
+
+
+@pytest.fixture
+def lms_models():
+    """Stand in for the LMS models, and connect the signal receivers to
+    them.
+    """
+    course_mode = type("CourseMode", (), {"ALL_MODES": ["audit", "verified"], "objects": mock.Mock()})
+    course_overview = type("CourseOverview", (), {"objects": mock.Mock()})
+    signal_handler = type("SignalHandler", (), {"course_published": Signal(), "course_deleted": Signal()})
+    course_mode.objects.get_or_create.side_effect = lambda course, mode_slug, **kwargs: (
+        mock.Mock(mode_slug=mode_slug), True
+    )
+    with mock.patch.dict(sys.modules, {
+        "common.djangoapps.course_modes.models": module("course_modes", CourseMode=course_mode),
+        "openedx.core.djangoapps.content.course_overviews.models": module(
+            "course_overviews", CourseOverview=course_overview
+        ),
+        "xmodule.modulestore.django": module("modulestore", SignalHandler=signal_handler),
+    }), mock.patch.object(courses, "course_mode_cache", CourseModeCache()):
+        sys.modules.pop("shopify_webhook.signals", None)
+        importlib.import_module("shopify_webhook.signals")
+        courses._valid_modes.cache_clear()
+        yield types.SimpleNamespace(CourseMode=course_mode, course_mode_cache=courses.course_mode_cache)
+    courses._valid_modes.cache_clear()
+
+
+def test_is_valid_mode(lms_models):
+    assert is_valid_mode("verified")
+    assert not is_valid_mode("platinum")
+    # Read once
+    lms_models.CourseMode.ALL_MODES = []
+    assert is_valid_mode("audit")
+
+
+def test_course_mode_cache(lms_models):
+    mode_cache = lms_models.course_mode_cache
+    assert mode_cache.get_or_create(COURSE_ID, "verified") == "verified"
+    assert mode_cache.get_or_create(COURSE_ID, "verified") == "verified"
+    assert lms_models.CourseMode.objects.get_or_create.call_count == 1
+
+    # Another mode, or another course
+    mode_cache.get_or_create(COURSE_ID, "audit")
+    mode_cache.get_or_create("course-v1:org+other+run", "verified")
+    assert lms_models.CourseMode.objects.get_or_create.call_count == 3
+
+    for signal in [post_save, post_delete]:
+        signal.send(sender=lms_models.CourseMode, instance=mock.Mock(course_id=COURSE_ID, mode_slug="verified"))
+        mode_cache.get_or_create(COURSE_ID, "verified")
+    assert lms_models.CourseMode.objects.get_or_create.call_count == 5
+    # The other entries are kept
+    mode_cache.get_or_create(COURSE_ID, "audit")
+    assert lms_models.CourseMode.objects.get_or_create.call_count == 5
+
+
+def test_course_mode_cache_invalidated_during_lookup(lms_models):
+    mode_cache = lms_models.course_mode_cache
+
+    def get_or_create(course, mode_slug, **kwargs):
+        # Changed by someone else while we look it up
+        mode_cache.invalidate(COURSE_ID, mode_slug)
+        return mock.Mock(mode_slug=mode_slug), False
+
+    lms_models.CourseMode.objects.get_or_create.side_effect = get_or_create
+    mode_cache.get_or_create(COURSE_ID, "verified")
+    mode_cache.get_or_create(COURSE_ID, "verified")
+
+    # The result of the first lookup was not remembered
+    assert lms_models.CourseMode.objects.get_or_create.call_count == 2
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` dedupe module.
+"""
+import base64
+import hashlib
+import hmac
+from datetime import timedelta
+
+import pytest
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+
+from shopify_webhook.dedupe import is_duplicate_delivery, remember_delivery
+from shopify_webhook.models import JSONWebhookData
+from shopify_webhook.registry import build_registry
+from shopify_webhook.views import checks
+
+WEBHOOK_ID = "b54557e4-bdd9-4b37-8a5f-bf7d70bcd043"
+
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "default"},
+    "dedupe": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "dedupe"},
+}
+
+
+@pytest.fixture(autouse=True)
+def dedupe_cache():
+    with override_settings(CACHES=CACHES, WEBHOOK_RECEIVER_DEDUPE_CACHE="dedupe"):
+        yield caches["dedupe"]
+        caches["dedupe"].clear()
+
+
+def store_webhook(status, age=0):
+    data = JSONWebhookData(status=status, headers={}, body=b"{}", webhook_id=WEBHOOK_ID)
+    data.save()
+    if age:
+        JSONWebhookData.objects.filter(id=data.id).update(updated=timezone.now() - timedelta(seconds=age))
+    return data
+
+
+def test_no_webhook_id():
+    assert not is_duplicate_delivery(None)
+
+
+@pytest.mark.django_db
+def test_first_delivery():
+    assert not is_duplicate_delivery(WEBHOOK_ID)
+
+
+@pytest.mark.django_db
+def test_processed(dedupe_cache):
+    store_webhook(JSONWebhookData.PROCESSED)
+    assert is_duplicate_delivery(WEBHOOK_ID)
+    # Later deliveries are answered from the cache.
+    JSONWebhookData.objects.all().delete()
+    assert is_duplicate_delivery(WEBHOOK_ID)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("status", [JSONWebhookData.NEW, JSONWebhookData.PROCESSING])
+def test_in_flight(status, dedupe_cache):
+    store_webhook(status)
+    assert is_duplicate_delivery(WEBHOOK_ID)
+    # Not cached, since processing may still fail.
+    assert not dedupe_cache.get("shopify_webhook:delivery:" + WEBHOOK_ID)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("status, age", [
+    (JSONWebhookData.ERROR, 0),
+    (JSONWebhookData.NEW, 3600),
+    (JSONWebhookData.PROCESSING, 3600),
+])
+def test_redelivered(status, age):
+    previous = store_webhook(status, age)
+    assert not is_duplicate_delivery(WEBHOOK_ID)
+    # The failed delivery is kept, without its webhook ID, so that the
+    # new delivery can be stored.
+    assert JSONWebhookData.objects.get(id=previous.id).webhook_id is None
+    store_webhook(JSONWebhookData.NEW)
+
+
+@pytest.mark.django_db
+def test_remember_delivery():
+    remember_delivery(WEBHOOK_ID)
+    assert is_duplicate_delivery(WEBHOOK_ID)
+
+
+@pytest.mark.django_db
+def test_redelivery_after_failure():
+    body = b'{"id": 1}'
+    request_factory = RequestFactory()
+
+    def deliver():
+        return request_factory.post(
+            "/webhooks/shopify/order/create",
+            data=body,
+            content_type="application/json",
+            HTTP_X_SHOPIFY_SHOP_DOMAIN="store-a.myshopify.com",
+            HTTP_X_SHOPIFY_HMAC_SHA256=base64.b64encode(hmac.new(b"secret", body, hashlib.sha256).digest()).decode(),
+            HTTP_X_SHOPIFY_WEBHOOK_ID=WEBHOOK_ID,
+        )
+
+    calls = []
+
+    @checks
+    def view(request):
+        calls.append(request.data.id)
+        if len(calls) == 1:
+            raise RuntimeError("LMS unavailable")
+        request.data.finish_processing()
+        request.data.save()
+        return HttpResponse(status=200)
+
+    settings = {"shopify": {"shops": {"store-a.myshopify.com": {"api_keys": ["secret"]}}}}
+    with override_settings(WEBHOOK_RECEIVER_SETTINGS=settings):
+        build_registry()
+        try:
+            with pytest.raises(RuntimeError):
+                view(deliver())
+            assert JSONWebhookData.objects.get(id=calls[0]).status == JSONWebhookData.ERROR
+
+            # Shopify's retry is processed again, and only then is the
+            # webhook a duplicate.
+            assert view(deliver()).status_code == 200
+            assert view(deliver()).status_code == 200
+        finally:
+            build_registry()
+
+    assert len(calls) == 2
+    assert JSONWebhookData.objects.get(webhook_id=WEBHOOK_ID).status == JSONWebhookData.PROCESSED
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` enrollment module.
+"""
+import sys
+import types
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.test import override_settings
+
+from shopify_webhook.enrollment import (
+    EnrollmentBackend,
+    HTTPEnrollmentBackend,
+    InProcessEnrollmentBackend,
+    OrderEnrollmentContext,
+    parse_bulk_enroll_response,
+)
+
+COURSE_A = "course-v1:org+a+run"
+COURSE_B = "course-v1:org+b+run"
+COURSE_C = "course-v1:org+c+run"
+
+
+def result(identifier, **flags):
+    return dict({"identifier": identifier, "before": {}, "after": {}}, **flags)
+
+
+def test_parse_bulk_enroll_response():
+    response_data = {
+        "action": "enroll",
+        "courses": {
+            COURSE_A: {
+                "action": "enroll",
+                "results": [
+                    result("ada@example.com"),
+                    result("grace@example.com", error=True),
+                ],
+            },
+            COURSE_B: {
+                "action": "enroll",
+                "results": [
+                    result("ada@example.com", invalidIdentifier=True),
+                    # Not part of the request
+                    result("eve@example.com"),
+                ],
+            },
+        },
+    }
+    assert parse_bulk_enroll_response(
+        response_data, [COURSE_A, COURSE_B], {"ada@example.com", "grace@example.com"}
+    ) == {
+        (COURSE_A, "ada@example.com"): True,
+        (COURSE_A, "grace@example.com"): False,
+        (COURSE_B, "ada@example.com"): False,
+        # Missing from the response
+        (COURSE_B, "grace@example.com"): False,
+    }
+
+
+@pytest.mark.parametrize("response_data", [{}, {"courses": None}, {"courses": {COURSE_A: {}}}])
+def test_parse_empty_bulk_enroll_response(response_data):
+    assert parse_bulk_enroll_response(response_data, [COURSE_A], {"ada@example.com"}) == {
+        (COURSE_A, "ada@example.com"): False,
+    }
+
+
+@override_settings(LMS_ROOT_URL="https://lms.example.com")
+def test_http_backend_groups_requests():
+    def post(url, params):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {"courses": {
+            course_id: {"results": [result(email) for email in params["identifiers"].split(",")]}
+            for course_id in params["courses"].split(",")
+        }}
+        return response
+
+    client = mock.Mock()
+    client.post.side_effect = post
+    enrollments = [
+        (COURSE_A, "ada@example.com"),
+        (COURSE_B, "ada@example.com"),
+        (COURSE_A, "grace@example.com"),
+        (COURSE_B, "grace@example.com"),
+        (COURSE_C, "eve@example.com"),
+    ]
+    with mock.patch("shopify_webhook.enrollment.get_lms_client", return_value=client):
+        results = HTTPEnrollmentBackend().enroll(enrollments)
+
+    assert results == {enrollment: True for enrollment in enrollments}
+    # One request for the two courses with the same learners, and one
+    # for the other course, so that no other pair is ever enrolled.
+    requests = sorted(
+        (call.args[1]["courses"], call.args[1]["identifiers"]) for call in client.post.call_args_list
+    )
+    assert requests == [
+        (",".join([COURSE_A, COURSE_B]), "ada@example.com,grace@example.com"),
+        (COURSE_C, "eve@example.com"),
+    ]
+    assert client.post.call_args.args[0] == "https://lms.example.com/api/bulk_enroll/v1/bulk_enroll"
+
+
+def test_invalid_email():
+    with pytest.raises(ValidationError):
+        HTTPEnrollmentBackend().enroll([(COURSE_A, "not an email")])
+
+
+def test_backend_must_enroll():
+    with pytest.raises(TypeError):
+        EnrollmentBackend()  # pylint: disable=abstract-class-instantiated
+
+
+def module(name, **attributes):
+    result = types.ModuleType(name)
+    result.__dict__.update(attributes)
+    return result
+
+
+class CourseKey:
+    """Stand in for opaque_keys.edx.keys.CourseKey."""
+
+    @staticmethod
+    def from_string(course_id):
+        if not course_id.startswith("course-v1:"):
+            raise ValueError(course_id)
+        return "key:" + course_id
+
+
+@pytest.fixture
+def instructor():
+    """Stand in for the LMS instructor enrollment functions."""
+    enrollment = module(
+        "lms.djangoapps.instructor.enrollment",
+        enroll_email=mock.Mock(),
+        unenroll_email=mock.Mock(),
+        get_email_params=mock.Mock(return_value={"site_name": "lms.example.com"}),
+    )
+    courses = module("openedx.core.lib.courses", get_course_by_id=mock.Mock(side_effect=lambda key: "course " + key))
+    with mock.patch.dict(sys.modules, {
+        "lms.djangoapps.instructor.enrollment": enrollment,
+        "opaque_keys.edx.keys": module("opaque_keys.edx.keys", CourseKey=CourseKey),
+        "openedx.core.lib.courses": courses,
+    }):
+        yield types.SimpleNamespace(**vars(enrollment), get_course_by_id=courses.get_course_by_id)
+
+
+@pytest.mark.django_db
+@override_settings(LMS_ROOT_URL="https://lms.example.com")
+def test_in_process_backend(instructor):
+    enrollments = [(COURSE_A, "ada@example.com"), (COURSE_A, "grace@example.com"), (COURSE_B, "ada@example.com")]
+
+    results = InProcessEnrollmentBackend().enroll(enrollments)
+
+    assert results == {enrollment: True for enrollment in enrollments}
+    # One call per pair, not one per course
+    assert sorted(call.args[:4] for call in instructor.enroll_email.call_args_list) == [
+        ("key:" + COURSE_A, "ada@example.com", True, True),
+        ("key:" + COURSE_A, "grace@example.com", True, True),
+        ("key:" + COURSE_B, "ada@example.com", True, True),
+    ]
+    assert instructor.enroll_email.call_args.args[4] == {"site_name": "lms.example.com"}
+    # Each course is loaded once
+    assert sorted(call.args[0] for call in instructor.get_email_params.call_args_list) == [
+        "course key:" + COURSE_A, "course key:" + COURSE_B,
+    ]
+    assert instructor.get_email_params.call_args.kwargs == {"secure": True}
+    instructor.unenroll_email.assert_not_called()
+
+
+@pytest.mark.django_db
+@override_settings(LMS_ROOT_URL="https://lms.example.com")
+def test_in_process_backend_unenroll(instructor):
+    results = InProcessEnrollmentBackend().enroll(
+        [(COURSE_A, "ada@example.com")], send_email=False, action="unenroll"
+    )
+
+    assert results == {(COURSE_A, "ada@example.com"): True}
+    instructor.unenroll_email.assert_called_once_with("key:" + COURSE_A, "ada@example.com", False, {})
+    instructor.enroll_email.assert_not_called()
+    # No email, so the course is not loaded
+    instructor.get_course_by_id.assert_not_called()
+
+
+@pytest.mark.django_db
+@override_settings(LMS_ROOT_URL="https://lms.example.com")
+def test_in_process_backend_errors(instructor):
+    def enroll_email(course_key, email, *args):
+        if email == "grace@example.com":
+            raise RuntimeError("unable to enroll")
+
+    instructor.enroll_email.side_effect = enroll_email
+
+    results = InProcessEnrollmentBackend().enroll([
+        (COURSE_A, "ada@example.com"),
+        (COURSE_A, "grace@example.com"),
+        ("not a course", "ada@example.com"),
+    ])
+
+    # A failure only affects its own pair, or the pairs of its course
+    assert results == {
+        (COURSE_A, "ada@example.com"): True,
+        (COURSE_A, "grace@example.com"): False,
+        ("not a course", "ada@example.com"): False,
+    }
+
+
+@pytest.mark.django_db
+def test_order_enrollment_context(fake_lms):
+    user = User.objects.create(username="ada", email="ada@example.com")
+    fake_lms.enroll(user, COURSE_A, mode="verified")
+    fake_lms.enroll(user, COURSE_B, mode="audit")
+
+    context = OrderEnrollmentContext("ada@example.com", [COURSE_A, COURSE_B, COURSE_A, "not a course"])
+
+    assert context.is_enrolled(COURSE_A)
+    assert context.is_enrolled(COURSE_A, "verified")
+    assert not context.is_enrolled(COURSE_B, "verified")
+    assert not context.is_enrolled(COURSE_C)
+    assert not context.is_enrolled("not a course")
+
+    context.update_modes({COURSE_A: "verified", COURSE_B: "verified", COURSE_C: "platinum"})
+    # Only the enrollment in another mode is updated, and the invalid
+    # mode is ignored
+    fake_lms.update_enrollment.assert_called_once_with(username="ada", course_id=COURSE_B, mode="verified")
+    assert fake_lms.queries == 1
+
+
+@pytest.mark.django_db
+def test_order_enrollment_context_deferred_modes(fake_lms):
+    user = User.objects.create(username="ada", email="ada@example.com")
+    context = OrderEnrollmentContext("ada@example.com", [COURSE_A])
+
+    # Enrolled since the context was loaded
+    fake_lms.enroll(user, COURSE_A, mode="audit")
+    fake_lms.enroll(user, COURSE_B, mode="audit")
+    context.defer_mode(COURSE_A, "verified")
+    context.defer_mode(COURSE_B, "verified")
+    fake_lms.update_enrollment.assert_not_called()
+
+    context.apply_deferred_modes()
+    assert [enrollment.mode for enrollment in fake_lms.enrollments] == ["verified", "verified"]
+    # Reloaded once
+    assert fake_lms.queries == 2
+    context.apply_deferred_modes()
+    assert fake_lms.queries == 2
+
+
+@pytest.mark.django_db
+def test_order_enrollment_context_no_account(fake_lms):
+    fake_lms.allow("ada@example.com", COURSE_A, mode="audit")
+    fake_lms.allow("ada@example.com", COURSE_B, mode="verified")
+
+    context = OrderEnrollmentContext("ada@example.com", [COURSE_A, COURSE_B])
+
+    assert not context.is_enrolled(COURSE_A)
+    context.update_modes({COURSE_A: "verified", COURSE_B: "verified"})
+    # The changed allowances, in one query
+    fake_lms.CourseEnrollmentAllowed.objects.bulk_update.assert_called_once_with([fake_lms.allowed[0]], ["mode"])
+    assert fake_lms.allowed[0].mode == "verified"
+
+    with pytest.raises(fake_lms.CourseEnrollmentAllowed.DoesNotExist):
+        context.update_modes({COURSE_C: "verified"})
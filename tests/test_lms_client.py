@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` lms_client module.
+"""
+from unittest import mock
+
+from django.test import override_settings
+
+from shopify_webhook.lms_client import DEFAULT_TIMEOUT, get_lms_client
+
+LMS_SETTINGS = {
+    "LMS_ROOT_URL": "https://lms.example.com",
+    "WEBHOOK_RECEIVER_EDX_OAUTH2_KEY": "key",
+    "WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET": "secret",
+}
+
+
+@override_settings(**LMS_SETTINGS)
+def test_post():
+    client = get_lms_client()
+    with mock.patch(
+        "shopify_webhook.lms_client.get_and_cache_oauth_access_token", return_value=("token", None)
+    ) as get_token, mock.patch.object(client.session, "request") as request:
+        client.post("https://lms.example.com/api", data={"a": 1}, headers={"Accept": "application/json"})
+
+    get_token.assert_called_once_with(
+        "https://lms.example.com", "key", "secret", token_type="jwt", timeout=DEFAULT_TIMEOUT
+    )
+    request.assert_called_once_with(
+        "POST",
+        "https://lms.example.com/api",
+        headers={"Accept": "application/json", "Authorization": "JWT token"},
+        data={"a": 1},
+        timeout=DEFAULT_TIMEOUT,
+    )
+
+
+@override_settings(WEBHOOK_RECEIVER_LMS_API_TIMEOUT=3, **LMS_SETTINGS)
+def test_timeout():
+    client = get_lms_client()
+    with mock.patch(
+        "shopify_webhook.lms_client.get_and_cache_oauth_access_token", return_value=("token", None)
+    ) as get_token, mock.patch.object(client.session, "request") as request:
+        client.post("https://lms.example.com/api")
+
+    assert get_token.call_args.kwargs["timeout"] == 3
+    assert request.call_args.kwargs["timeout"] == 3
+
+
+def test_shared_client():
+    with override_settings(**LMS_SETTINGS):
+        client = get_lms_client()
+        assert get_lms_client() is client
+    with override_settings(**dict(LMS_SETTINGS, WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET="rotated")):
+        assert get_lms_client() is not client
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` provisioning module.
+"""
+import sys
+import types
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from shopify_webhook.provisioning import (
+    UsernameAllocator,
+    allocate_username,
+    bulk_provision_users,
+    check_default_password,
+    next_free_username,
+    provision_user,
+    read_customers,
+)
+from shopify_webhook.tasks import set_initial_password
+
+
+@pytest.fixture
+def user_profile():
+    """Stand in for the LMS UserProfile model."""
+    model = mock.Mock()
+    module = types.ModuleType("common.djangoapps.student.models")
+    module.UserProfile = model
+    with mock.patch.dict(sys.modules, {"common.djangoapps.student.models": module}):
+        yield model
+
+
+@pytest.mark.parametrize("taken, expected", [
+    ([], "learner"),
+    (["other"], "learner"),
+    (["learner"], "learner_1"),
+    (["learner", "learner_1", "learner_2"], "learner_3"),
+    # The first free suffix, not the next after the highest
+    (["learner", "learner_1", "learner_3"], "learner_2"),
+    # Regardless of case
+    (["Learner", "LEARNER_1"], "learner_2"),
+    # Suffixes of other base usernames, and suffixes that are not numbers
+    (["learner", "learner_x", "learner_1_1", "learner_²"], "learner_1"),
+])
+def test_next_free_username(taken, expected):
+    assert next_free_username("learner", taken) == expected
+
+
+def test_allocate_several():
+    allocator = UsernameAllocator(["learner"])
+    assert allocator.allocate("learner") == "learner_1"
+    assert allocator.allocate("learner") == "learner_2"
+    assert allocator.allocate("Learner") == "Learner_3"
+    assert allocator.allocate("learner_1") == "learner_1_1"
+    assert allocator.allocate("other") == "other"
+
+
+@pytest.mark.django_db
+def test_allocate_username(django_assert_num_queries):
+    for username in ["learner", "learner_1", "learner_2", "learner_3", "learners"]:
+        User.objects.create(username=username, email=username + "@example.com")
+
+    with django_assert_num_queries(1):
+        assert allocate_username("learner") == "learner_4"
+    assert allocate_username("newcomer") == "newcomer"
+
+
+@pytest.mark.django_db
+def test_bulk_provision_existing_users():
+    User.objects.create(username="ada", email="Ada@Example.com")
+    User.objects.create(username="grace", email="grace@example.com")
+
+    counts = bulk_provision_users([
+        {"email": "ada@example.com"},
+        {"email": "ADA@example.com"},
+        {"email": "Grace@Example.com "},
+        {"email": "not an email"},
+    ])
+
+    assert counts == {"created": 0, "existing": 2, "invalid": 1}
+    assert User.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_bulk_provision_users(user_profile):
+    User.objects.create(username="ada", email="Ada@Example.com")
+    User.objects.create(username="grace_1", email="grace.hopper@example.com")
+
+    counts = bulk_provision_users([
+        {"email": "ADA@example.com"},
+        {"email": "grace@example.com", "first_name": "Grace", "last_name": "Hopper"},
+        {"email": "Grace@Example.com"},
+        {"email": "katherine@example.com"},
+    ])
+
+    assert counts == {"created": 2, "existing": 1, "invalid": 0}
+    created = dict(User.objects.exclude(username__in=["ada", "grace_1"]).values_list("email", "username"))
+    assert created == {"grace@example.com": "grace", "katherine@example.com": "katherine"}
+    assert not any(user.has_usable_password() for user in User.objects.filter(email__in=created))
+    # One profile for each, in one insert
+    user_profile.objects.bulk_create.assert_called_once()
+    assert sorted(call.kwargs["name"] for call in user_profile.call_args_list) == ["Grace Hopper", "katherine"]
+
+
+@pytest.mark.django_db
+def test_bulk_provision_users_mysql(user_profile):
+    User.objects.create(username="ada", email="ada@example.com")
+    connection = connections[User.objects.db]
+
+    # The emails are looked up without lowercasing them in the database
+    with mock.patch.object(connection, "vendor", "mysql"), \
+            CaptureQueriesContext(connection) as queries:
+        counts = bulk_provision_users([{"email": "ADA@Example.com"}, {"email": "grace@example.com"}])
+
+    assert counts == {"created": 1, "existing": 1, "invalid": 0}
+    assert not any("LOWER" in query["sql"] for query in queries.captured_queries)
+
+
+def test_read_customers_csv(tmp_path):
+    path = tmp_path / "customers.csv"
+    path.write_text("First Name,Last Name,Email\nAda,Lovelace,ada@example.com\n", encoding="utf-8")
+    assert list(read_customers(str(path))) == [
+        {"first_name": "Ada", "last_name": "Lovelace", "email": "ada@example.com"},
+    ]
+
+
+def test_read_customers_jsonl(tmp_path):
+    path = tmp_path / "customers.export"
+    path.write_text('{"Email": "ada@example.com"}\n\n{"Email": "grace@example.com"}\n', encoding="utf-8")
+    assert list(read_customers(str(path), file_format="jsonl")) == [
+        {"email": "ada@example.com"},
+        {"email": "grace@example.com"},
+    ]
+
+
+@pytest.mark.django_db
+def test_provision_user_unusable_password(user_profile):
+    with mock.patch("shopify_webhook.tasks.set_initial_password.delay") as delay:
+        user, created = provision_user("ada@example.com")
+
+    assert created
+    assert User.objects.get(id=user.id).username == "ada"
+    assert not User.objects.get(id=user.id).has_usable_password()
+    user_profile.objects.create.assert_called_once_with(user=user, name="ada")
+    # Without WEBHOOK_RECEIVER_DEFAULT_PASSWORD
+    delay.assert_not_called()
+
+
+@pytest.mark.django_db
+@override_settings(WEBHOOK_RECEIVER_DEFAULT_PASSWORD="shared")
+def test_provision_user_default_password(user_profile):
+    with mock.patch("shopify_webhook.tasks.set_initial_password.delay", side_effect=set_initial_password) as delay, \
+            mock.patch("shopify_webhook.provisioning.transaction.on_commit", side_effect=lambda func: func()):
+        user, created = provision_user("ada@example.com")
+
+    delay.assert_called_once_with(user.id)
+    assert User.objects.get(id=user.id).check_password("shared")
+
+
+@pytest.mark.django_db
+@override_settings(WEBHOOK_RECEIVER_DEFAULT_PASSWORD="shared")
+def test_set_initial_password_keeps_password():
+    user = User.objects.create_user(username="ada", email="ada@example.com", password="own password")
+
+    set_initial_password(user.id)
+
+    assert User.objects.get(id=user.id).check_password("own password")
+
+
+def test_check_default_password():
+    assert check_default_password(None) == []
+    with override_settings(WEBHOOK_RECEIVER_DEFAULT_PASSWORD="shared"):
+        assert [warning.id for warning in check_default_password(None)] == ["shopify_webhook.W001"]
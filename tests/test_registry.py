@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` registry module.
+"""
+import base64
+import hashlib
+import hmac
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+
+from shopify_webhook.registry import Shop, ShopRegistry
+
+ADMIN_API_URL = "https://store-a.myshopify.com/admin/api/2024-10/graphql.json"
+
+
+def sign(body, key):
+    return base64.b64encode(hmac.new(key.encode("utf-8"), body, hashlib.sha256).digest()).decode()
+
+
+def registry(conf, **settings):
+    with override_settings(WEBHOOK_RECEIVER_SETTINGS={"shopify": conf}, **settings):
+        return ShopRegistry.from_settings()
+
+
+def test_hmac_is_valid():
+    shop = Shop("store-a.myshopify.com", ["new-secret", "old-secret"])
+    body = b'{"id": 1}'
+    assert shop.hmac_is_valid(body, sign(body, "new-secret"))
+    assert shop.hmac_is_valid(body, sign(body, "old-secret"))
+    assert not shop.hmac_is_valid(body, sign(body, "other-secret"))
+    assert not shop.hmac_is_valid(body + b" ", sign(body, "new-secret"))
+    assert not Shop("store-b.myshopify.com", []).hmac_is_valid(body, sign(body, "new-secret"))
+
+
+def test_shops():
+    shops = registry(
+        {
+            "shops": {
+                "store-a.myshopify.com": {
+                    "api_keys": ["a"],
+                    "admin_api_url": ADMIN_API_URL,
+                    "admin_api_access_token": "token-a",
+                },
+                "store-b.myshopify.com": {"api_key": "b"},
+            },
+        },
+        SHOPIFY_ADMIN_API_ACCESS_TOKEN="default-token",
+    )
+    assert shops.get("store-a.myshopify.com").api_keys == ("a",)
+    assert shops.get("store-a.myshopify.com").admin_api_access_token == "token-a"
+    assert shops.get("store-b.myshopify.com").api_keys == ("b",)
+    assert shops.get("store-b.myshopify.com").admin_api_access_token == "default-token"
+    assert shops.get("store-c.myshopify.com") is None
+    assert shops.default.domain == "store-a.myshopify.com"
+
+
+def test_legacy_settings():
+    shops = registry(
+        {"shop_domains": ["store-a.myshopify.com"], "shop_domain": "store-b.myshopify.com", "api_key": "secret"},
+        SHOPIFY_ADMIN_API_URL=ADMIN_API_URL,
+    )
+    assert {shop.domain for shop in shops} == {"store-a.myshopify.com", "store-b.myshopify.com"}
+    assert shops.get("store-b.myshopify.com").api_keys == ("secret",)
+    assert shops.default.domain is None
+    assert shops.default.admin_api_url == ADMIN_API_URL
+
+
+def test_shops_take_precedence():
+    shops = registry({
+        "shops": {"store-a.myshopify.com": {"api_keys": ["new-secret"]}},
+        "shop_domains": ["store-a.myshopify.com", "store-b.myshopify.com"],
+        "api_key": "legacy-secret",
+    })
+    assert shops.get("store-a.myshopify.com").api_keys == ("new-secret",)
+    assert shops.get("store-b.myshopify.com").api_keys == ("legacy-secret",)
+
+
+def test_missing_api_key():
+    with pytest.raises(ImproperlyConfigured, match="store-a.myshopify.com"):
+        registry({"shops": {"store-a.myshopify.com": {}}})
+    with pytest.raises(ImproperlyConfigured, match="store-b.myshopify.com"):
+        registry({"shop_domain": "store-b.myshopify.com"})
+
+
+def test_not_configured():
+    shops = registry({})
+    assert list(shops) == []
+    assert shops.default is None
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` retention module.
+"""
+import os
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from shopify_webhook import retention
+from shopify_webhook.models import JSONWebhookData, ShopifyOrder, ShopifyOrderItem
+
+
+def days_ago(days):
+    return timezone.now() - timedelta(days=days)
+
+
+def create_webhook(webhook_id, status=JSONWebhookData.PROCESSED, days=100):
+    data = JSONWebhookData(
+        headers={"X-Shopify-Topic": "orders/create"},
+        body=b'{"id": 1}',
+        webhook_id=webhook_id,
+        status=status,
+        received=days_ago(days),
+    )
+    data.content = {"id": 1}
+    data.save()
+    return data
+
+
+def create_order(order_id, webhook, status=ShopifyOrder.PROCESSED, days=100):
+    order = ShopifyOrder.objects.create(
+        id=order_id, email="ada@example.com", first_name="Ada", last_name="Lovelace",
+        webhook=webhook, status=status, received=days_ago(days),
+    )
+    ShopifyOrderItem.objects.create(order=order, sku="a", email=order.email, status=ShopifyOrderItem.PROCESSED)
+    return order
+
+
+def segments(archive_dir):
+    return sorted(os.path.join(archive_dir, name) for name in os.listdir(archive_dir))
+
+
+@pytest.mark.django_db
+def test_archive_and_restore(tmp_path):
+    old = create_webhook("1")
+    create_order(1, old)
+    recent = create_webhook("2", days=10)
+    failed = create_webhook("3", status=JSONWebhookData.ERROR)
+
+    call_command("archive_webhook_data", archive_dir=str(tmp_path), days=90, include_orders=True)
+
+    assert list(JSONWebhookData.objects.values_list("id", flat=True).order_by("id")) == [recent.id, failed.id]
+    assert not ShopifyOrder.objects.exists()
+    assert not ShopifyOrderItem.objects.exists()
+    paths = segments(tmp_path)
+    assert [os.path.basename(path).split("-")[0] for path in paths] == [retention.WEBHOOK, retention.ORDER]
+    assert not [path for path in paths if path.endswith(".tmp")]
+
+    call_command("restore_webhook_data", *paths)
+
+    restored = JSONWebhookData.objects.get(id=old.id)
+    assert restored.status == JSONWebhookData.PROCESSED
+    assert restored.webhook_id == "1"
+    assert restored.received == old.received
+    assert restored.body == b'{"id": 1}'
+    assert restored.content == {"id": 1}
+    order = ShopifyOrder.objects.get(id=1)
+    assert order.webhook_id == old.id
+    assert order.status == ShopifyOrder.PROCESSED
+    assert list(ShopifyOrderItem.objects.filter(order=order).values_list("sku", flat=True)) == ["a"]
+
+    # Restoring twice is harmless
+    call_command("restore_webhook_data", *paths)
+    assert JSONWebhookData.objects.count() == 3
+    assert ShopifyOrderItem.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_archive_skips_unprocessed_orders(tmp_path):
+    retry = create_webhook("1")
+    create_order(1, retry, status=ShopifyOrder.ERROR)
+    done = create_webhook("2")
+    create_order(2, done)
+
+    archived = retention.archive(str(tmp_path), days=90)
+
+    assert archived == {retention.WEBHOOK: 1, retention.ORDER: 0}
+    # Left for process_failed_orders to retry
+    assert list(JSONWebhookData.objects.values_list("id", flat=True)) == [retry.id]
+    assert ShopifyOrder.objects.get(id=1).webhook_id == retry.id
+    # Kept, without its webhook
+    assert ShopifyOrder.objects.get(id=2).webhook_id is None
+
+
+@pytest.mark.django_db
+def test_archive_resumes(tmp_path):
+    webhooks = [create_webhook(str(i)) for i in range(5)]
+
+    assert retention.archive(str(tmp_path), batch_size=2, max_batches=1)[retention.WEBHOOK] == 2
+    # Interrupted while writing the next segment
+    with mock.patch("shopify_webhook.retention.os.replace", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            retention.archive(str(tmp_path), batch_size=2)
+    assert JSONWebhookData.objects.count() == 3
+
+    assert retention.archive(str(tmp_path), batch_size=2)[retention.WEBHOOK] == 3
+    assert not JSONWebhookData.objects.exists()
+
+    # Every webhook is archived exactly once
+    paths = [path for path in segments(tmp_path) if not path.endswith(".tmp")]
+    records = [record for path in paths for record in retention.read_segment(path)]
+    assert sorted(record["id"] for record in records) == [data.id for data in webhooks]
+
+
+@pytest.mark.django_db
+def test_restore_webhook_id_conflict(tmp_path):
+    old = create_webhook("1")
+    create_order(1, old)
+    retention.archive(str(tmp_path), days=90)
+    # Shopify delivered the webhook again since
+    redelivered = create_webhook("1", days=0)
+
+    assert retention.restore(segments(tmp_path)[0]) == 1
+
+    # The archived webhook is not restored, and its order is left alone
+    assert list(JSONWebhookData.objects.values_list("id", flat=True)) == [redelivered.id]
+    assert ShopifyOrder.objects.get(id=1).webhook_id is None
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` shopify_admin module.
+"""
+import asyncio
+from unittest import mock
+
+import pytest
+import requests
+from django.core.cache import cache
+from django.test import override_settings
+
+from shopify_webhook.registry import Shop
+from shopify_webhook.shopify_admin import (
+    MAX_BACKOFF,
+    AdminClient,
+    CostLimiter,
+    get_async_admin_client,
+    retry_delay,
+)
+
+ADMIN_API_URL = "https://store-a.myshopify.com/admin/api/2024-10/graphql.json"
+
+SHOP = Shop("store-a.myshopify.com", ["secret"], ADMIN_API_URL, "token")
+
+PAYLOAD = {"query": "{ shop { id } }"}
+
+
+def response(status_code, data=None, headers=None):
+    return mock.Mock(status_code=status_code, headers=headers or {}, **{"json.return_value": data or {}})
+
+
+@pytest.mark.parametrize("attempt, retry_after, expected", [
+    (0, None, 0.5),
+    (1, None, 1),
+    (3, None, 4),
+    # Capped
+    (10, None, MAX_BACKOFF),
+    (0, "2", 2),
+    (0, "2.5", 2.5),
+    (0, "-1", 0),
+    (0, "3600", MAX_BACKOFF),
+    # An HTTP date is ignored
+    (1, "Wed, 21 Oct 2015 07:28:00 GMT", 1),
+])
+def test_retry_delay(attempt, retry_after, expected):
+    assert retry_delay(attempt, retry_after) == expected
+
+
+@pytest.fixture(autouse=True)
+def clear_buckets():
+    CostLimiter._local_states.clear()
+    cache.clear()
+
+
+@pytest.fixture
+def client():
+    return AdminClient(SHOP)
+
+
+@mock.patch("shopify_webhook.shopify_admin.time.sleep")
+def test_post_retries(sleep, client):
+    with mock.patch.object(client.session, "post", side_effect=[
+        requests.ConnectionError(),
+        response(503, headers={"Retry-After": "2"}),
+        response(200, {"data": {}}),
+    ]) as post:
+        assert client.post(PAYLOAD).status_code == 200
+
+    assert post.call_count == 3
+    assert post.call_args.kwargs["timeout"] == 10
+    assert [call.args[0] for call in sleep.call_args_list] == [0.5, 2]
+
+
+@mock.patch("shopify_webhook.shopify_admin.time.sleep")
+def test_post_gives_up(sleep, client):
+    with mock.patch.object(client.session, "post", return_value=response(502)) as post:
+        assert client.post(PAYLOAD).status_code == 502
+    # The first attempt, and 3 retries
+    assert post.call_count == 4
+
+    with mock.patch.object(client.session, "post", side_effect=requests.Timeout()):
+        with pytest.raises(requests.Timeout):
+            client.post(PAYLOAD)
+
+
+def cost(available, requested=100, rate=50, size=1000, throttled=False):
+    data = {"extensions": {"cost": {
+        "requestedQueryCost": requested,
+        "throttleStatus": {"currentlyAvailable": available, "restoreRate": rate, "maximumAvailable": size},
+    }}}
+    if throttled:
+        data["errors"] = [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}]
+    return data
+
+
+@mock.patch("shopify_webhook.shopify_admin.time.time", return_value=1000.0)
+def test_cost_limiter(time):
+    limiter = CostLimiter(SHOP)
+    # A full bucket
+    assert limiter.acquire(PAYLOAD) == 0
+    assert limiter.update(PAYLOAD, cost(available=120)) is None
+
+    # The last requested cost of the query is taken from the bucket
+    assert limiter.acquire(PAYLOAD) == 0
+    # 20 available, 80 more needed at 50 per second
+    assert limiter.acquire(PAYLOAD) == pytest.approx(1.6)
+    # Restored over time, minus what is already reserved
+    time.return_value = 1004.0
+    assert limiter.acquire(PAYLOAD) == 0
+
+
+@mock.patch("shopify_webhook.shopify_admin.time.time", return_value=1000.0)
+def test_cost_limiter_throttled(time):
+    limiter = CostLimiter(SHOP)
+    assert limiter.update(PAYLOAD, cost(available=20, requested=120, throttled=True)) == pytest.approx(2)
+    assert limiter.update(PAYLOAD, {"data": {}}) is None
+
+
+@override_settings(WEBHOOK_RECEIVER_SHOPIFY_RATE_LIMIT_CACHE="default")
+def test_cost_limiter_shared():
+    limiter = CostLimiter(SHOP)
+    limiter.update(PAYLOAD, cost(available=100))
+    # Another process
+    assert CostLimiter(SHOP).acquire(PAYLOAD) == 0
+    assert CostLimiter._local_states == {}
+    assert limiter.acquire(PAYLOAD) > 0
+    # The lock is released
+    assert cache.get(limiter.key + ":lock") is None
+
+
+@override_settings(WEBHOOK_RECEIVER_SHOPIFY_RATE_LIMIT_CACHE="default")
+@mock.patch("shopify_webhook.shopify_admin.LOCK_TIMEOUT", 0.05)
+def test_cost_limiter_lock_expires():
+    limiter = CostLimiter(SHOP)
+    # Held by a process that died
+    cache.set(limiter.key + ":lock", 1)
+    assert limiter.acquire(PAYLOAD) == 0
+    # Not released by another process
+    assert cache.get(limiter.key + ":lock") == 1
+
+
+def test_shared_async_client():
+    other_shop = Shop("store-b.myshopify.com", ["secret"], ADMIN_API_URL.replace("store-a", "store-b"), "token")
+
+    async def get_clients():
+        return [get_async_admin_client(SHOP), get_async_admin_client(SHOP), get_async_admin_client(other_shop)]
+
+    loop = asyncio.new_event_loop()
+    try:
+        first, second, other = loop.run_until_complete(get_clients())
+        again = loop.run_until_complete(get_clients())[0]
+    finally:
+        loop.close()
+
+    # One client per shop, kept for the next requests
+    assert first is second is again
+    assert first.client is again.client
+    assert other is not first
+    # Another event loop cannot use the connections of the first
+    assert asyncio.run(get_clients())[0].client is not first.client
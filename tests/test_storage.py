@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` storage module.
+"""
+import json
+from unittest import mock
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import RequestFactory, override_settings
+
+from shopify_webhook import storage
+from shopify_webhook.models import JSONWebhookData, ShopifyOrder
+from shopify_webhook.tasks import process
+from shopify_webhook.utils import build_webhook_data, handle_order_cancel
+
+BODY = json.dumps({"id": 1, "line_items": [{"sku": "course-v1:org+course+run"}] * 20}).encode("utf-8")
+
+CODECS = [
+    storage.ZLIB,
+    pytest.param(
+        storage.ZSTD, marks=pytest.mark.skipif(storage.zstandard is None, reason="zstandard is not installed")
+    ),
+]
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip(codec):
+    compressed = storage.compress_body(BODY, codec)
+    assert len(compressed) < len(BODY)
+    assert storage.decompress_body(compressed, codec) == BODY
+    # As returned for a BinaryField by some database backends
+    assert storage.decompress_body(memoryview(compressed), codec) == BODY
+
+
+def test_uncompressed():
+    assert storage.decompress_body(memoryview(BODY), "") == BODY
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        storage.compress_body(BODY, "lzma")
+    with pytest.raises(ValueError):
+        storage.decompress_body(BODY, "lzma")
+
+
+@override_settings(WEBHOOK_RECEIVER_BODY_COMPRESSION="lzma")
+def test_unknown_codec_setting():
+    with pytest.raises(ImproperlyConfigured):
+        storage.get_codec()
+
+
+def test_filter_headers():
+    headers = {
+        "Content-Type": "application/json",
+        "X-Shopify-Topic": "orders/create",
+        "x-shopify-webhook-id": "1",
+    }
+    assert storage.filter_headers(headers) == {"X-Shopify-Topic": "orders/create", "x-shopify-webhook-id": "1"}
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("codec", CODECS)
+def test_compact_webhook(codec):
+    request = RequestFactory().post(
+        "/webhooks/shopify/order/create",
+        data=BODY,
+        content_type="application/json",
+        HTTP_X_SHOPIFY_TOPIC="orders/create",
+    )
+    with override_settings(WEBHOOK_RECEIVER_COMPACT_STORAGE=True, WEBHOOK_RECEIVER_BODY_COMPRESSION=codec):
+        data = build_webhook_data(request)
+    data.parse_body()
+    data.save()
+
+    stored = JSONWebhookData.objects.get(id=data.id)
+    assert stored.body_codec == codec
+    assert stored.stored_content is None
+    assert stored.headers == {"X-Shopify-Topic": "orders/create"}
+    assert stored.raw_body == BODY
+    assert stored.content == json.loads(BODY)
+
+
+@pytest.mark.django_db
+def test_plain_webhook():
+    data = JSONWebhookData(headers={}, body=BODY)
+    data.content = json.loads(BODY)
+    data.save()
+
+    stored = JSONWebhookData.objects.get(id=data.id)
+    assert stored.body_codec == ""
+    assert stored.stored_content == json.loads(BODY)
+    assert stored.raw_body == BODY
+
+
+CANCELLATION = {"customerId": "gid://shopify/Customer/1", "occurredAt": "2024-10-01T12:00:00Z"}
+
+
+def cancellation_webhook(compact):
+    data = JSONWebhookData(headers={}, body=json.dumps(CANCELLATION).encode("utf-8"))
+    if compact:
+        data.body = storage.compress_body(data.body, storage.ZLIB)
+        data.body_codec = storage.ZLIB
+    data.parse_body()
+    data.start_processing()
+    data.save()
+    return data
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("compact", [True, False])
+def test_cancellation_content(compact):
+    data = cancellation_webhook(compact)
+    assert data.stored_content is (None if compact else data.content)
+
+    order = handle_order_cancel(data, ("ada@example.com", ["course-v1:org+course+run"]))
+
+    # The order data added to the content is stored, and replayed
+    stored = JSONWebhookData.objects.get(id=data.id)
+    assert stored.content["id"] == order.id
+    assert stored.content["email"] == "ada@example.com"
+    assert stored.content["line_items"] == [{"id": 1, "sku": "course-v1:org+course+run", "variant_title": ""}]
+    assert stored.raw_body == json.dumps(CANCELLATION).encode("utf-8")
+
+    ShopifyOrder.objects.filter(id=order.id).update(status=ShopifyOrder.ERROR)
+    with mock.patch.object(process, "delay", lambda data, **kwargs: process.apply(args=[data], kwargs=kwargs)), \
+            mock.patch("shopify_webhook.tasks.process_order") as process_order:
+        call_command("process_failed_orders")
+
+    process_order.assert_called_once()
+    replayed_order, replayed_data = process_order.call_args.args
+    assert replayed_order.id == order.id
+    assert replayed_data["subscription_cancellation"]
+
+
+@pytest.mark.django_db
+def test_compact_webhook_data_command():
+    plain = JSONWebhookData(headers={"Content-Type": "application/json"}, body=BODY)
+    plain.parse_body()
+    plain.save()
+    cancellation = cancellation_webhook(compact=False)
+    handle_order_cancel(cancellation, ("ada@example.com", []))
+
+    call_command("compact_webhook_data", stdout=mock.Mock())
+
+    plain = JSONWebhookData.objects.get(id=plain.id)
+    assert plain.body_codec == storage.ZLIB
+    assert plain.stored_content is None
+    assert plain.headers == {}
+    assert plain.content == json.loads(BODY)
+    # The derived content of the cancellation is kept
+    cancellation = JSONWebhookData.objects.get(id=cancellation.id)
+    assert cancellation.body_codec == storage.ZLIB
+    assert cancellation.stored_content["email"] == "ada@example.com"
+    assert cancellation.raw_body == json.dumps(CANCELLATION).encode("utf-8")
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` tasks module.
+"""
+import json
+from unittest import mock
+
+import pytest
+import requests
+
+from shopify_webhook.models import JSONWebhookData, ShopifyOrder
+from shopify_webhook.tasks import process_webhook
+
+ORDER = {
+    "id": 7,
+    "tags": "",
+    "email": "learner@example.com",
+    "customer": {"email": "learner@example.com", "first_name": "Ada", "last_name": "Lovelace"},
+}
+
+
+@pytest.fixture
+def webhook():
+    data = JSONWebhookData(headers={}, body=json.dumps(ORDER).encode("utf-8"))
+    data.save()
+    return data
+
+
+@pytest.mark.django_db
+def test_process_webhook(webhook):
+    with mock.patch("shopify_webhook.utils.provision_user"), \
+            mock.patch("shopify_webhook.tasks.schedule_order") as schedule_order:
+        process_webhook.apply(args=[webhook.id])
+
+    assert JSONWebhookData.objects.get(id=webhook.id).status == JSONWebhookData.PROCESSED
+    order = ShopifyOrder.objects.get(id=ORDER["id"])
+    assert order.webhook_id == webhook.id
+    schedule_order.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_process_webhook_retries_then_fails(webhook):
+    error = requests.ConnectionError("LMS unavailable")
+    with mock.patch("shopify_webhook.utils.provision_user", side_effect=error) as provision_user:
+        process_webhook.apply(args=[webhook.id])
+
+    # One attempt and three retries, after which the webhook is left in
+    # the ERROR state, without an order.
+    assert provision_user.call_count == 4
+    assert JSONWebhookData.objects.get(id=webhook.id).status == JSONWebhookData.ERROR
+    assert not ShopifyOrder.objects.exists()
+
+
+@pytest.mark.django_db
+def test_process_webhook_retry_after_partial_failure(webhook):
+    with mock.patch("shopify_webhook.utils.provision_user"), \
+            mock.patch("shopify_webhook.utils.record_order", side_effect=requests.Timeout), \
+            mock.patch("shopify_webhook.tasks.process_webhook.retry", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            process_webhook(webhook.id)
+
+    # The first attempt stopped before the order was recorded, so the
+    # webhook is not marked as processed, and a retry records the order.
+    assert JSONWebhookData.objects.get(id=webhook.id).status == JSONWebhookData.PROCESSING
+    with mock.patch("shopify_webhook.utils.provision_user"), \
+            mock.patch("shopify_webhook.tasks.schedule_order"):
+        process_webhook(webhook.id)
+
+    assert JSONWebhookData.objects.get(id=webhook.id).status == JSONWebhookData.PROCESSED
+    assert ShopifyOrder.objects.filter(id=ORDER["id"]).exists()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` utils module.
+"""
+import asyncio
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import RequestFactory, override_settings
+from django_fsm import ConcurrentTransition
+from django_fsm.signals import post_transition
+
+from shopify_webhook.models import JSONWebhookData, ShopifyOrder, ShopifyOrderItem
+from shopify_webhook.registry import Shop
+from shopify_webhook.shopify_admin import AdminAPIError
+from shopify_webhook.utils import (
+    aget_shopify_customer_email_and_order_skus,
+    enrollment_context,
+    get_shopify_customer_email_and_order_skus,
+    process_line_items,
+    process_line_items_concurrently,
+    receive_json_webhook_single_write,
+    save_line_item_states,
+    skip_enrolled_line_items,
+    start_line_items,
+)
+
+SHOP = Shop("store-a.myshopify.com", ["secret"], "https://store-a.myshopify.com/admin/api/2024-10/graphql.json")
+
+
+@pytest.fixture
+def transitions():
+    received = []
+
+    def receiver(sender, instance, name, source, target, **kwargs):
+        received.append((instance.id, name, source, target))
+
+    post_transition.connect(receiver, sender=JSONWebhookData)
+    yield received
+    post_transition.disconnect(receiver, sender=JSONWebhookData)
+
+
+def webhook_request(body):
+    return RequestFactory().post("/webhooks/shopify/order/create", data=body, content_type="application/json")
+
+
+@pytest.mark.django_db
+def test_single_write_ingestion(django_assert_num_queries, transitions):
+    # The INSERT, in a savepoint
+    with django_assert_num_queries(3) as queries:
+        data = receive_json_webhook_single_write(webhook_request(b'{"id": 1}'))
+    assert [query["sql"].split()[0] for query in queries.captured_queries].count("INSERT") == 1
+
+    stored = JSONWebhookData.objects.get(id=data.id)
+    assert stored.status == JSONWebhookData.PROCESSING
+    assert stored.content == {"id": 1}
+    assert stored.source == "127.0.0.1"
+    assert transitions == [(data.id, "start_processing", JSONWebhookData.NEW, JSONWebhookData.PROCESSING)]
+
+
+@pytest.mark.django_db
+def test_single_write_ingestion_invalid(django_assert_num_queries, transitions):
+    with django_assert_num_queries(3):
+        with pytest.raises(ValueError):
+            receive_json_webhook_single_write(webhook_request(b'{"id": '))
+
+    stored = JSONWebhookData.objects.get()
+    assert stored.status == JSONWebhookData.ERROR
+    assert transitions == [
+        (stored.id, "start_processing", JSONWebhookData.NEW, JSONWebhookData.PROCESSING),
+        (stored.id, "fail", JSONWebhookData.PROCESSING, JSONWebhookData.ERROR),
+    ]
+
+
+def create_order():
+    return ShopifyOrder.objects.create(id=1, email="ada@example.com", first_name="Ada", last_name="Lovelace")
+
+
+def statuses(order):
+    return dict(ShopifyOrderItem.objects.filter(order=order).values_list("sku", "status"))
+
+
+@pytest.mark.django_db(transaction=True)
+@override_settings(WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY=2)
+def test_process_line_items_concurrently():
+    order = create_order()
+    items = [{"sku": "a"}, {"sku": "b"}, {"sku": "c"}]
+
+    def resolve_line_item(order_item, item, subscription_cancellation=False, context=None):
+        if item["sku"] == "b":
+            raise ValueError("b")
+        order_item.finish_processing()
+
+    with mock.patch("shopify_webhook.utils.resolve_line_item", side_effect=resolve_line_item), \
+            mock.patch.object(connections, "close_all") as close_all:
+        with pytest.raises(ValueError):
+            process_line_items_concurrently(order, items, subscription_cancellation=True)
+
+    # The items that succeeded are saved, despite the failure of another
+    assert statuses(order) == {
+        "a": ShopifyOrderItem.PROCESSED,
+        "b": ShopifyOrderItem.PROCESSING,
+        "c": ShopifyOrderItem.PROCESSED,
+    }
+    # Once per worker thread
+    assert close_all.call_count == 2
+
+
+@pytest.mark.django_db
+def test_start_line_items(django_assert_num_queries):
+    order = create_order()
+    ShopifyOrderItem.objects.create(order=order, sku="done", email=order.email, status=ShopifyOrderItem.PROCESSED)
+    ShopifyOrderItem.objects.create(order=order, sku="retry", email=order.email, status=ShopifyOrderItem.PROCESSING)
+    items = [{"sku": "a"}, {"sku": "b"}, {"sku": "a"}, {"sku": "done"}, {"sku": "retry"}]
+
+    # Insert, select, and one update in a savepoint
+    with django_assert_num_queries(5):
+        started = start_line_items(order, items)
+
+    assert [item["sku"] for item, order_item in started] == ["a", "b", "retry"]
+    assert statuses(order) == {
+        "a": ShopifyOrderItem.PROCESSING,
+        "b": ShopifyOrderItem.PROCESSING,
+        "done": ShopifyOrderItem.PROCESSED,
+        "retry": ShopifyOrderItem.PROCESSING,
+    }
+
+
+class FakeBackend:
+    """Enroll a user in the fake LMS, in the audit mode."""
+
+    def __init__(self, lms, user):
+        self.lms = lms
+        self.user = user
+
+    def enroll(self, enrollments, **kwargs):
+        for course_id, email in enrollments:
+            self.lms.enroll(self.user, course_id)
+        return {enrollment: True for enrollment in enrollments}
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("count", [1, 5])
+def test_process_line_items_queries(count, fake_lms, django_assert_num_queries):
+    order = create_order()
+    user = User.objects.create(username="ada", email=order.email)
+    items = [{"sku": "course-v1:org+%s+run" % i, "variant_title": "verified"} for i in range(count)]
+
+    # However many items: the OrderItems are started, the user is looked
+    # up, and the items are saved in a savepoint
+    with mock.patch("shopify_webhook.utils.course_exists", return_value=True), \
+            mock.patch("shopify_webhook.utils.get_enrollment_backend", return_value=FakeBackend(fake_lms, user)), \
+            django_assert_num_queries(9):
+        process_line_items(order, items)
+
+    # The enrollments are loaded once, and once more after enrolling
+    assert fake_lms.queries == 2
+    assert [enrollment.mode for enrollment in fake_lms.enrollments] == ["verified"] * count
+    assert set(statuses(order).values()) == {ShopifyOrderItem.PROCESSED}
+
+
+COURSE_A = "course-v1:org+a+run"
+COURSE_B = "course-v1:org+b+run"
+
+
+def skipped_skus(order, items, subscription_cancellation=False):
+    started = start_line_items(order, items)
+    context = enrollment_context(order, started, subscription_cancellation)
+    remaining, skipped = skip_enrolled_line_items(order, started, context)
+    assert [order_item.status for order_item in skipped] == [ShopifyOrderItem.PROCESSED] * len(skipped)
+    return [order_item.sku for order_item in skipped]
+
+
+@pytest.mark.django_db
+def test_skip_enrolled_line_items(fake_lms):
+    order = create_order()
+    user = User.objects.create(username="ada", email=order.email)
+    fake_lms.enroll(user, COURSE_A, mode="verified")
+    fake_lms.enroll(user, COURSE_B, mode="audit")
+    items = [
+        {"sku": COURSE_A, "variant_title": "verified"},
+        # Bought in another mode
+        {"sku": COURSE_B, "variant_title": "verified"},
+        {"sku": "course-v1:org+c+run", "variant_title": "verified"},
+        {"sku": "not a course"},
+    ]
+
+    assert skipped_skus(order, items) == [COURSE_A]
+    # With one query for all the enrollments
+    assert fake_lms.queries == 1
+    # Not saved yet
+    assert statuses(order)[COURSE_A] == ShopifyOrderItem.PROCESSING
+
+
+@pytest.mark.django_db
+def test_skip_enrolled_line_items_any_mode(fake_lms):
+    order = create_order()
+    user = User.objects.create(username="ada", email=order.email)
+    fake_lms.enroll(user, COURSE_A, mode="verified")
+    fake_lms.enroll(user, COURSE_B, mode="audit", is_active=False)
+
+    # No mode bought, but only an active enrollment counts
+    assert skipped_skus(order, [{"sku": COURSE_A}, {"sku": COURSE_B}]) == [COURSE_A]
+
+
+@pytest.mark.django_db
+def test_skip_enrolled_line_items_no_account(fake_lms):
+    order = create_order()
+    fake_lms.allow(order.email, COURSE_A, mode="verified")
+
+    assert skipped_skus(order, [{"sku": COURSE_A, "variant_title": "verified"}]) == []
+
+
+@pytest.mark.django_db
+def test_skip_enrolled_line_items_cancellation(fake_lms):
+    order = create_order()
+    user = User.objects.create(username="ada", email=order.email)
+    fake_lms.enroll(user, COURSE_A, mode="verified")
+
+    assert skipped_skus(order, [{"sku": COURSE_A, "variant_title": ""}], subscription_cancellation=True) == []
+    # Without even looking
+    assert fake_lms.queries == 0
+
+
+@pytest.mark.django_db
+def test_save_line_item_states():
+    order = create_order()
+    order_items = [order_item for item, order_item in start_line_items(order, [{"sku": "a"}, {"sku": "b"}])]
+    order_items[0].finish_processing()
+    order_items[1].fail()
+
+    save_line_item_states(order_items)
+
+    assert statuses(order) == {"a": ShopifyOrderItem.PROCESSED, "b": ShopifyOrderItem.ERROR}
+    # The FSM concurrency check expects the saved status
+    order_items[0].save()
+
+
+@pytest.mark.django_db
+def test_save_line_item_states_concurrent_transition():
+    order = create_order()
+    order_items = [order_item for item, order_item in start_line_items(order, [{"sku": "a"}, {"sku": "b"}])]
+    ShopifyOrderItem.objects.filter(sku="b").update(status=ShopifyOrderItem.ERROR)
+    for order_item in order_items:
+        order_item.finish_processing()
+
+    with pytest.raises(ConcurrentTransition):
+        save_line_item_states(order_items)
+
+    # Rolled back
+    assert statuses(order) == {"a": ShopifyOrderItem.PROCESSING, "b": ShopifyOrderItem.ERROR}
+
+
+def line_items_page(skus, cursor=None):
+    return {
+        "edges": [{"node": {"variant": {"sku": sku}}} for sku in skus],
+        "pageInfo": {"hasNextPage": cursor is not None, "endCursor": cursor},
+    }
+
+
+def orders_page(skus, cursor=None, line_items_cursor=None):
+    return {"data": {"customer": {"email": "ada@example.com", "orders": {
+        "edges": [
+            {"node": {"id": "gid://shopify/Order/%s" % sku, "lineItems": line_items_page([sku], line_items_cursor)}}
+            for sku in skus
+        ],
+        "pageInfo": {"hasNextPage": cursor is not None, "endCursor": cursor},
+    }}}}
+
+
+def response(status_code, data=None):
+    result = mock.Mock(status_code=status_code, text="")
+    if isinstance(data, Exception):
+        result.json.side_effect = data
+    else:
+        result.json.return_value = data
+    return result
+
+
+def test_get_customer_email_and_order_skus():
+    client = mock.Mock()
+    client.post.side_effect = [response(200, orders_page(["a", "b"], "next")), response(200, orders_page(["c"]))]
+    with mock.patch("shopify_webhook.utils.get_admin_client", return_value=client):
+        email, skus = get_shopify_customer_email_and_order_skus("gid://shopify/Customer/1", SHOP)
+
+    assert email == "ada@example.com"
+    assert sorted(skus) == ["a", "b", "c"]
+    assert client.post.call_args.args[0]["variables"] == {"customerId": "gid://shopify/Customer/1", "cursor": "next"}
+
+
+@pytest.mark.parametrize("failed_page", [
+    response(500),
+    response(200, ValueError("Expecting value")),
+    response(200, {"errors": [{"message": "Internal error"}]}),
+    response(200, {"data": {"customer": None}}),
+])
+def test_get_customer_order_skus_failed_page(failed_page):
+    # Rather than return the SKUs of the first page only
+    client = mock.Mock()
+    client.post.side_effect = [response(200, orders_page(["a"], "next")), failed_page]
+    with mock.patch("shopify_webhook.utils.get_admin_client", return_value=client):
+        with pytest.raises(AdminAPIError):
+            get_shopify_customer_email_and_order_skus("gid://shopify/Customer/1", SHOP)
+
+
+def test_get_customer_order_skus_more_line_items():
+    client = mock.Mock()
+    client.post.side_effect = [
+        response(200, orders_page(["a"], line_items_cursor="a1")),
+        response(200, {"data": {"order": {"lineItems": line_items_page(["b", "c"], "a2")}}}),
+        response(200, {"data": {"order": {"lineItems": line_items_page(["d"])}}}),
+    ]
+    with mock.patch("shopify_webhook.utils.get_admin_client", return_value=client):
+        email, skus = get_shopify_customer_email_and_order_skus("gid://shopify/Customer/1", SHOP)
+
+    assert sorted(skus) == ["a", "b", "c", "d"]
+    assert [call.args[0]["variables"] for call in client.post.call_args_list[1:]] == [
+        {"orderId": "gid://shopify/Order/a", "cursor": "a1"},
+        {"orderId": "gid://shopify/Order/a", "cursor": "a2"},
+    ]
+
+
+def test_aget_customer_order_skus_more_line_items():
+    admin_client = mock.Mock()
+    admin_client.post = mock.AsyncMock(side_effect=[
+        response(200, orders_page(["a", "b"], line_items_cursor="1")),
+        response(200, {"data": {"order": {"lineItems": line_items_page(["c"])}}}),
+        response(200, {"data": {"order": {"lineItems": line_items_page(["d"])}}}),
+    ])
+    with mock.patch("shopify_webhook.utils.AsyncAdminClient", return_value=admin_client):
+        email, skus = asyncio.run(
+            aget_shopify_customer_email_and_order_skus("gid://shopify/Customer/1", SHOP, client=mock.Mock())
+        )
+
+    assert email == "ada@example.com"
+    assert sorted(skus) == ["a", "b", "c", "d"]
+    assert [call.args[0]["variables"]["orderId"] for call in admin_client.post.call_args_list[1:]] == [
+        "gid://shopify/Order/a",
+        "gid://shopify/Order/b",
+    ]
+
+
+def test_aget_customer_order_skus_shared_client():
+    admin_client = mock.Mock()
+    admin_client.post = mock.AsyncMock(return_value=response(200, orders_page(["a"])))
+    with mock.patch("shopify_webhook.utils.get_async_admin_client", return_value=admin_client) as get_client:
+        asyncio.run(aget_shopify_customer_email_and_order_skus("gid://shopify/Customer/1", SHOP))
+
+    get_client.assert_called_once_with(SHOP)
+    # Left open for the next requests
+    admin_client.client.aclose.assert_not_called()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Tests for the `shopify_webhook` views module.
+"""
+import base64
+import hashlib
+import hmac
+import json
+from unittest import mock
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, override_settings
+from django.urls import path
+
+from shopify_webhook.models import JSONWebhookData, ShopifyOrder
+from shopify_webhook.registry import build_registry
+from shopify_webhook.views import checks, order_cancel_async, order_create_async, verify_request
+
+SHOP_DOMAIN = "store-a.myshopify.com"
+SECRET = "secret"
+BODY = b'{"id": 1, "tags": ""}'
+
+SHOPIFY_SETTINGS = {
+    "shopify": {
+        "shops": {
+            SHOP_DOMAIN: {"api_keys": [SECRET, "old-secret"]},
+        },
+    },
+}
+
+
+def sign(body, key=SECRET):
+    return base64.b64encode(hmac.new(key.encode("utf-8"), body, hashlib.sha256).digest()).decode()
+
+
+def webhook_request(body=BODY, **headers):
+    headers = {"HTTP_" + name.upper().replace("-", "_"): value for name, value in headers.items()}
+    return RequestFactory().post(
+        "/webhooks/shopify/order/create", data=body, content_type="application/json", **headers
+    )
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    with override_settings(WEBHOOK_RECEIVER_SETTINGS=SHOPIFY_SETTINGS):
+        yield build_registry()
+    build_registry()
+
+
+def test_valid_request():
+    request = webhook_request(**{
+        "X-Shopify-Shop-Domain": SHOP_DOMAIN,
+        "X-Shopify-Hmac-Sha256": sign(BODY),
+    })
+    assert verify_request(request) is None
+    assert request.shop.domain == SHOP_DOMAIN
+
+
+def test_rotated_secret():
+    request = webhook_request(**{
+        "X-Shopify-Shop-Domain": SHOP_DOMAIN,
+        "X-Shopify-Hmac-Sha256": sign(BODY, "old-secret"),
+    })
+    assert verify_request(request) is None
+
+
+def test_missing_shop_domain():
+    request = webhook_request(**{"X-Shopify-Hmac-Sha256": sign(BODY)})
+    assert verify_request(request) == (400, "missing_shop_domain")
+
+
+def test_unknown_shop_domain():
+    request = webhook_request(**{
+        "X-Shopify-Shop-Domain": "store-b.myshopify.com",
+        "X-Shopify-Hmac-Sha256": sign(BODY),
+    })
+    assert verify_request(request) == (403, "unknown_shop_domain")
+
+
+def test_missing_hmac():
+    request = webhook_request(**{"X-Shopify-Shop-Domain": SHOP_DOMAIN})
+    assert verify_request(request) == (400, "missing_hmac")
+
+
+@pytest.mark.parametrize("signature", [sign(BODY, "wrong-secret"), sign(BODY + b" "), "", "not base64"])
+def test_invalid_hmac(signature):
+    request = webhook_request(**{
+        "X-Shopify-Shop-Domain": SHOP_DOMAIN,
+        "X-Shopify-Hmac-Sha256": signature,
+    })
+    assert verify_request(request) == (403, "invalid_hmac")
+
+
+@pytest.mark.django_db
+def test_rejected_before_storing():
+    view = checks(lambda request: HttpResponse(status=200))
+    response = view(webhook_request(**{
+        "X-Shopify-Shop-Domain": SHOP_DOMAIN,
+        "X-Shopify-Hmac-Sha256": sign(BODY, "wrong-secret"),
+    }))
+    assert response.status_code == 403
+    assert not JSONWebhookData.objects.exists()
+
+
+ORDER = {
+    "id": 7,
+    "tags": "",
+    "email": "ada@example.com",
+    "customer": {"email": "ada@example.com", "first_name": "Ada", "last_name": "Lovelace"},
+}
+
+# Routes to the async views, whatever WEBHOOK_RECEIVER_ASYNC_VIEWS is
+urlpatterns = [
+    path("order/create", order_create_async),
+    path("order/cancel", order_cancel_async),
+]
+
+
+@async_to_sync
+async def post_async(url, body, webhook_id="1", signature=None):
+    # The async test client takes headers by their ASGI names
+    return await AsyncClient().post(url, data=body, content_type="application/json", **{
+        "x-shopify-shop-domain": SHOP_DOMAIN,
+        "x-shopify-hmac-sha256": signature or sign(body),
+        "x-shopify-webhook-id": webhook_id,
+    })
+
+
+@pytest.fixture
+def async_views():
+    with override_settings(ROOT_URLCONF=__name__, MIDDLEWARE=[]), \
+            mock.patch("shopify_webhook.utils.provision_user"), \
+            mock.patch("shopify_webhook.views.schedule_order") as schedule_order:
+        yield schedule_order
+
+
+@pytest.mark.django_db
+def test_async_order_create(async_views):
+    response = post_async("/order/create", json.dumps(ORDER).encode("utf-8"))
+
+    assert response.status_code == 200
+    data = JSONWebhookData.objects.get()
+    assert data.status == JSONWebhookData.PROCESSED
+    assert data.webhook_id == "1"
+    assert ShopifyOrder.objects.get().webhook_id == data.id
+    async_views.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_async_order_cancel(async_views):
+    body = json.dumps({"customerId": "gid://shopify/Customer/1", "occurredAt": "2024-10-01T12:00:00Z"})
+    with mock.patch(
+        "shopify_webhook.utils.aget_shopify_customer_email_and_order_skus",
+        mock.AsyncMock(return_value=("ada@example.com", ["course-v1:org+course+run"])),
+    ):
+        response = post_async("/order/cancel", body.encode("utf-8"))
+
+    assert response.status_code == 200
+    assert JSONWebhookData.objects.get().status == JSONWebhookData.PROCESSED
+    assert ShopifyOrder.objects.get().email == "ada@example.com"
+
+
+@pytest.mark.django_db
+def test_async_invalid_hmac(async_views):
+    body = json.dumps(ORDER).encode("utf-8")
+    response = post_async("/order/create", body, signature=sign(body, "wrong-secret"))
+
+    assert response.status_code == 403
+    assert not JSONWebhookData.objects.exists()
+    async_views.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_async_duplicate_delivery(async_views):
+    body = json.dumps(ORDER).encode("utf-8")
+    assert post_async("/order/create", body).status_code == 200
+    assert post_async("/order/create", body).status_code == 200
+
+    assert JSONWebhookData.objects.count() == 1
+    async_views.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_async_exception_abandons_webhook(async_views):
+    body = json.dumps(ORDER).encode("utf-8")
+    with mock.patch("shopify_webhook.views.handle_order_create", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            post_async("/order/create", body)
+
+    assert JSONWebhookData.objects.get().status == JSONWebhookData.ERROR
+    # So that Shopify's retry is processed
+    assert post_async("/order/create", body).status_code == 200
+    assert JSONWebhookData.objects.get(webhook_id="1").status == JSONWebhookData.PROCESSED